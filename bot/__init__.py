@@ -1,35 +1,43 @@
-from .bot import BOT, BotPlus
-from .config import CFG, LOCAL
-from .handlers import (
-    comm_handler_bingimage,
-    comm_handler_cancel,
-    comm_handler_echo,
-    comm_handler_hello,
-    comm_handler_help,
-    comm_handler_hhsh,
-    comm_handler_start,
-    conv_handler_fund,
-    conv_handler_settings,
-    mess_handler_unknown,
-    test_handler,
-)
-from .tools import get_logger
+# 导出的对象在首次访问时才导入相应模块, `import bot` 不读取配置和环境变量
+import importlib
+from typing import Any
 
-__all__ = (
-    BOT,
-    CFG,
-    LOCAL,
-    comm_handler_bingimage,
-    comm_handler_cancel,
-    comm_handler_echo,
-    comm_handler_hello,
-    comm_handler_help,
-    comm_handler_hhsh,
-    comm_handler_start,
-    conv_handler_fund,
-    conv_handler_settings,
-    mess_handler_unknown,
-    test_handler,
-    get_logger,
-    BotPlus,
-)
+# 名称: 所在模块
+_EXPORTS = {
+    'BOT': '.bot',
+    'BotPlus': '.bot',
+    'OutboundQueue': '.bot',
+    'CFG': '.config',
+    'LOCAL': '.config',
+    'comm_handler_bingimage': '.handlers',
+    'comm_handler_cancel': '.handlers',
+    'comm_handler_echo': '.handlers',
+    'comm_handler_hello': '.handlers',
+    'comm_handler_help': '.handlers',
+    'comm_handler_hhsh': '.handlers',
+    'comm_handler_start': '.handlers',
+    'command_router': '.handlers',
+    'conv_handler_fund': '.handlers',
+    'conv_handler_settings': '.handlers',
+    'error_handler': '.handlers',
+    'install_log_filters': '.handlers',
+    'mess_handler_unknown': '.handlers',
+    'start_fund_prefetch': '.handlers',
+    'test_handler': '.handlers',
+    'get_logger': '.tools',
+}
+
+__all__ = tuple(_EXPORTS)
+
+
+def __getattr__(name: str) -> Any:
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted([*globals(), *_EXPORTS])
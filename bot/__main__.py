@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Filename    :  __main__.py
+@Datatime    :  2021/11/25 20:18:44
+@Author      :  Kiyan Yang
+@Contact     :  KiyanYang@outlook.com
+@Version     :  v1.0
+@Description :  启动耗时基准: `python -m bot`, 在新的解释器中测量导入和冷启动耗时, 超出预算时返回非零状态
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# 在不设置任何 TOKEN 环境变量的新解释器中运行, 输出耗时(秒).
+# `import bot`只登记延迟导入的名称, 测量实际使用的模块: 读取配置的`bot.config`和依赖 PTB 的`bot.handlers`
+IMPORT_SCRIPT = '''
+import time
+t = time.perf_counter()
+import bot.config
+import bot.handlers
+print(time.perf_counter() - t)
+'''
+# 冷启动: 导入、读取配置和语言文本、创建所有 handler, 不访问网络
+COLD_START_SCRIPT = '''
+import time
+t = time.perf_counter()
+import bot
+from bot import handlers
+for name in handlers.HANDLER_FACTORIES:
+    getattr(bot.handlers, name)
+handlers.TEXTS.get('start', 'start')
+print(time.perf_counter() - t)
+'''
+# 默认预算(秒)
+IMPORT_BUDGET = 1.0
+COLD_START_BUDGET = 2.0
+
+
+def measure(script: str, repeat: int) -> list[float]:
+    env = {k: v for k, v in os.environ.items() if not k.startswith(('TOKEN_', 'DEVELOPER_'))}
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    times = []
+    for _ in range(repeat):
+        res = subprocess.run(
+            [sys.executable, '-c', script],
+            cwd=cwd,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        if res.returncode != 0:
+            raise RuntimeError(res.stderr)
+        times.append(float(res.stdout.strip().splitlines()[-1]))
+    return times
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m bot', description='测量 bot 包的导入和冷启动耗时')
+    parser.add_argument('--repeat', type=int, default=5, help='每项测量的次数, 取中位数')
+    parser.add_argument(
+        '--import-budget', type=float, default=IMPORT_BUDGET, help='导入 bot.config 和 bot.handlers 的预算(秒)'
+    )
+    parser.add_argument('--cold-start-budget', type=float, default=COLD_START_BUDGET, help='冷启动的预算(秒)')
+    args = parser.parse_args()
+
+    failed = False
+    for name, script, budget in (
+        ('import', IMPORT_SCRIPT, args.import_budget),
+        ('cold start', COLD_START_SCRIPT, args.cold_start_budget),
+    ):
+        times = measure(script, args.repeat)
+        median = statistics.median(times)
+        ok = median <= budget
+        failed |= not ok
+        print(f'{name:<10} median {median * 1000:8.1f} ms  max {max(times) * 1000:8.1f} ms  '
+              f'budget {budget * 1000:8.1f} ms  {"OK" if ok else "OVER BUDGET"}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
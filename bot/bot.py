@@ -6,33 +6,333 @@
 @Author      :  Kiyan Yang
 @Contact     :  KiyanYang@outlook.com
 @Version     :  v1.3
-@Description :  自定义 bot 相关工具: 获取配置, 发送文本, 发送超长文本
+@Description :  自定义 bot 相关工具: 获取配置, 发送文本, 发送超长文本, 限速发送队列
 """
 import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Any, Callable, Iterable
 
-from telegram import Bot, Message
+from telegram import Bot, Message, MessageId
+from telegram.error import RetryAfter
+from telegram.ext import Dispatcher
 from telegram.utils.request import Request
 
 from .config import CFG, LOCAL
-from .tools import MessageText, get_logger
+from .tools import LazyObject, MessageChunker, get_logger
 
 logger = get_logger(__name__)
 
 
+class TokenBucket:
+    """令牌桶: 每秒补充`rate`个令牌, 最多积累`capacity`个"""
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now: float) -> float:
+        """距离可以取出一个令牌的时间(秒)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+
+class OutboundQueue:
+    """限速发送队列
+
+    按 Telegram 的限制对整个 bot 和每个对话分别使用令牌桶限速, 同一对话的请求按加入顺序逐个发送,
+    高优先级(交互回复)先于低优先级(日志、广播)发送. 遇到`RetryAfter`时暂停该对话, 到时后重新发送.
+    Telegram 按 TOKEN 限速, 同一 TOKEN 的`BotPlus`通过`for_token`共用一个队列, 优先级只在同一 TOKEN 内起作用
+
+    Parameters
+    ----------
+    global_rate : float, optional
+        整个 bot 每秒最多发送数, by default 30
+    chat_rate : float, optional
+        私聊每秒最多发送数, by default 1
+    group_rate : float, optional
+        群组每秒最多发送数, by default 20 / 60
+    burst : int, optional
+        每个对话可以连续发送的数量, by default 3
+    workers : int, optional
+        发送线程数, by default 4
+    """
+    HIGH = 0
+    LOW = 1
+    PRUNE_INTERVAL = 60  # 清理已补满的对话令牌桶和已到期的暂停的间隔(秒)
+    __instances = {}  # token: OutboundQueue
+    __instances_lock = threading.Lock()
+
+    def __init__(
+        self,
+        global_rate: float = 30,
+        chat_rate: float = 1,
+        group_rate: float = 20 / 60,
+        burst: int = 3,
+        workers: int = 4,
+    ) -> None:
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.workers = workers
+        self.__global = TokenBucket(global_rate, global_rate)
+        self.__chats = {}  # chat_id: TokenBucket
+        self.__paused = {}  # chat_id: RetryAfter 解除的时间
+        self.__lanes = {self.HIGH: OrderedDict(), self.LOW: OrderedDict()}  # priority: {chat_id: deque}
+        self.__inflight = set()  # 正在发送的对话, 保证同一对话按顺序发送
+        self.__pruned = time.monotonic()
+        self.__condition = threading.Condition()
+        self.__threads = []
+        self.__counts = {'sent': 0, 'retry_after': 0, 'errors': 0}
+
+    @classmethod
+    def for_token(cls, token: str, **kwargs) -> 'OutboundQueue':
+        """返回`token`共用的发送队列, 第一次调用时用`kwargs`创建"""
+        with cls.__instances_lock:
+            if token not in cls.__instances:
+                cls.__instances[token] = cls(**kwargs)
+            return cls.__instances[token]
+
+    def __bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self.__chats.get(chat_id)
+        if bucket is None:
+            is_group = str(chat_id).startswith(('-', '@'))
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self.__chats[chat_id] = TokenBucket(rate, self.burst)
+        return bucket
+
+    def put(self, chat_id: int | str, func: Callable[..., Any], *args, priority: int = HIGH, **kwargs) -> Future:
+        """加入发送队列
+
+        Parameters
+        ----------
+        chat_id : int | str
+            对话 id, 用于限速和排序
+        func : Callable[..., Any]
+            实际发送的函数, 如`Bot.send_message`
+        priority : int, optional
+            优先级, `OutboundQueue.HIGH`或`OutboundQueue.LOW`, by default HIGH
+
+        Returns
+        -------
+        Future
+            发送完成后结果为`func`的返回值, 如发送的`Message`
+        """
+        future = Future()
+        with self.__condition:
+            if not self.__threads:
+                for i in range(self.workers):
+                    t = threading.Thread(target=self.__run, name=f'OutboundQueue-{i}', daemon=True)
+                    t.start()
+                    self.__threads.append(t)
+            lane = self.__lanes[priority]
+            lane.setdefault(chat_id, deque()).append((func, args, kwargs, future))
+            self.__condition.notify()
+        return future
+
+    def __prune(self, now: float) -> None:
+        """删除空闲且已补满的对话令牌桶(再次使用时重新创建, 结果相同)和已到期的暂停, 避免随对话数增长"""
+        if now - self.__pruned < self.PRUNE_INTERVAL:
+            return
+        self.__pruned = now
+        busy = self.__inflight.union(*self.__lanes.values())
+        for chat_id, bucket in list(self.__chats.items()):
+            if chat_id not in busy and bucket.wait_time(now) == 0 and bucket.tokens >= bucket.capacity:
+                del self.__chats[chat_id]
+        for chat_id, until in list(self.__paused.items()):
+            if until <= now:
+                del self.__paused[chat_id]
+
+    def __next(self) -> tuple[tuple | None, float | None]:
+        """取出下一条可以发送的请求, 没有时返回需要等待的时间"""
+        now = time.monotonic()
+        self.__prune(now)
+        soonest = None
+        global_wait = self.__global.wait_time(now)
+        for priority in sorted(self.__lanes):
+            lane = self.__lanes[priority]
+            for chat_id, items in lane.items():
+                if chat_id in self.__inflight:
+                    continue
+                wait = max(global_wait, self.__bucket(chat_id).wait_time(now), self.__paused.get(chat_id, 0) - now)
+                if wait > 0:
+                    soonest = wait if soonest is None else min(soonest, wait)
+                    continue
+                item = items.popleft()
+                if items:
+                    lane.move_to_end(chat_id)  # 轮流发送各对话的消息
+                else:
+                    del lane[chat_id]
+                self.__global.consume()
+                self.__bucket(chat_id).consume()
+                self.__inflight.add(chat_id)
+                return (priority, chat_id, item), 0
+        return None, soonest
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                task, wait = self.__next()
+                while task is None:
+                    self.__condition.wait(wait)
+                    task, wait = self.__next()
+            priority, chat_id, (func, args, kwargs, future) = task
+            retry_after = None
+            try:
+                result = func(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                outcome = 'retry_after'
+                logger.warning(f'对话 {chat_id} 触发限速, {e.retry_after} 秒后重新发送')
+            except Exception as e:
+                future.set_exception(e)
+                outcome = 'errors'
+            else:
+                future.set_result(result)
+                outcome = 'sent'
+            with self.__condition:  # 多个发送线程共用计数
+                self.__counts[outcome] += 1
+                if retry_after is not None:
+                    self.__paused[chat_id] = time.monotonic() + retry_after
+                    lane = self.__lanes[priority]
+                    lane.setdefault(chat_id, deque()).appendleft((func, args, kwargs, future))
+                self.__inflight.discard(chat_id)
+                self.__condition.notify_all()
+
+    def stats(self) -> dict:
+        with self.__condition:
+            depth = {p: sum(len(x) for x in lane.values()) for p, lane in self.__lanes.items()}
+            return self.__counts | {
+                'queued_high': depth[self.HIGH],
+                'queued_low': depth[self.LOW],
+                'chats': len(self.__chats),
+                'paused': len(self.__paused),
+            }
+
+
 class BotPlus(Bot):
-    def __init__(self, token: str) -> None:
+    """带限速发送队列的 Bot
+
+    `send_message` `send_photo` `copy_message`经由`OutboundQueue`发送, 与`Bot`相同, 等待发送完成后返回结果,
+    发送失败时抛出异常. 对应的`*_async`方法不等待发送完成, 返回`Future`, 发送失败时交给 dispatcher 的
+    error handler 处理(没有 dispatcher 或`dispatch_errors`为 False 时记录日志). 可以传入`priority`参数改变优先级.
+    同步方法在对话限速时会等待, 在 dispatcher 线程中(未经`run_in_pool`的 handler)应使用`*_async`方法,
+    `Message.reply_text`等快捷方法调用的是同步方法, 同样不应在 dispatcher 线程中使用
+
+    Parameters
+    ----------
+    token : str
+        bot 的 TOKEN
+    priority : int, optional
+        默认优先级, 交互回复使用`OutboundQueue.HIGH`, 日志和广播使用`OutboundQueue.LOW`. 同一 TOKEN 的
+        `BotPlus`共用发送队列, 只有这时低优先级才会让路给高优先级, by default OutboundQueue.HIGH
+    con_pool_size : int, optional
+        请求连接池大小, by default 8
+    queued : bool, optional
+        是否使用限速发送队列, by default True
+    dispatch_errors : bool, optional
+        `*_async`方法发送失败时是否交给 dispatcher 的 error handler, by default True
+    """
+    def __init__(
+        self,
+        token: str,
+        priority: int = OutboundQueue.HIGH,
+        con_pool_size: int = 8,
+        queued: bool = True,
+        dispatch_errors: bool = True,
+    ) -> None:
         if LOCAL:
-            super().__init__(token, request=Request(proxy_url=CFG[0]['PROXY_URL']))
+            request = Request(con_pool_size=con_pool_size, proxy_url=CFG[0]['PROXY_URL'])
+        else:
+            request = Request(con_pool_size=con_pool_size)
+        super().__init__(token, request=request)
+        self.priority = priority
+        self.dispatch_errors = dispatch_errors
+        self.outbound = None
+        if queued:
+            # 多进程模式下每个 worker 都有自己的发送队列, 整个 bot 的限速由各 worker 平分
+            cfg = CFG[0]['OUTBOUND']
+            global_rate = cfg['global_rate'] / CFG[0]['SHARDING']['processes']
+            self.outbound = OutboundQueue.for_token(token, **cfg | {'global_rate': global_rate})
+
+    def enqueue(self, func: Callable[..., Any], chat_id: int | str, *args, priority: int | None = None, **kwargs) -> Future:
+        """将`func(chat_id, *args, **kwargs)`加入限速发送队列"""
+        priority = self.priority if priority is None else priority
+        return self.outbound.put(chat_id, func, self, chat_id, *args, priority=priority, **kwargs)
+
+    def __send(self, func: Callable[..., Any], chat_id: int | str, *args, priority: int | None = None, **kwargs) -> Any:
+        if self.outbound is None:
+            return func(self, chat_id, *args, **kwargs)
+        return self.enqueue(func, chat_id, *args, priority=priority, **kwargs).result()
+
+    def __send_async(
+        self,
+        func: Callable[..., Any],
+        chat_id: int | str,
+        *args,
+        priority: int | None = None,
+        **kwargs,
+    ) -> Future:
+        if self.outbound is None:
+            future = Future()
+            try:
+                future.set_result(func(self, chat_id, *args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
         else:
-            super().__init__(token)
+            future = self.enqueue(func, chat_id, *args, priority=priority, **kwargs)
+        future.add_done_callback(self.__dispatch_error)  # 无人等待结果, 发送失败时交给 error handler
+        return future
+
+    def __dispatch_error(self, future: Future) -> None:
+        error = future.exception()
+        if error is None:
+            return
+        try:
+            dispatcher = Dispatcher.get_instance() if self.dispatch_errors else None
+        except RuntimeError:  # 本进程没有 dispatcher
+            dispatcher = None
+        if dispatcher is None:
+            logger.error(f'发送失败: {error!r}')
+        else:
+            dispatcher.dispatch_error(None, error)
+
+    def send_message(self, chat_id: int | str, *args, **kwargs) -> Message:
+        return self.__send(Bot.send_message, chat_id, *args, **kwargs)
+
+    def send_photo(self, chat_id: int | str, *args, **kwargs) -> Message:
+        return self.__send(Bot.send_photo, chat_id, *args, **kwargs)
+
+    def copy_message(self, chat_id: int | str, *args, **kwargs) -> MessageId:
+        return self.__send(Bot.copy_message, chat_id, *args, **kwargs)
+
+    def send_message_async(self, chat_id: int | str, *args, **kwargs) -> Future:
+        """不等待发送完成的`send_message`, 返回结果为`Message`的`Future`"""
+        return self.__send_async(Bot.send_message, chat_id, *args, **kwargs)
+
+    def send_photo_async(self, chat_id: int | str, *args, **kwargs) -> Future:
+        """不等待发送完成的`send_photo`, 返回结果为`Message`的`Future`"""
+        return self.__send_async(Bot.send_photo, chat_id, *args, **kwargs)
+
+    def copy_message_async(self, chat_id: int | str, *args, **kwargs) -> Future:
+        """不等待发送完成的`copy_message`, 返回结果为`MessageId`的`Future`"""
+        return self.__send_async(Bot.copy_message, chat_id, *args, **kwargs)
 
     def send_too_long_message(
         self,
         chat_id: str | int,
-        text: list[str],
+        text: Iterable[str],
         joiner: str = '\n',
         parse_mode: str | None = 'MarkdownV2',
-    ) -> Message:
+        priority: int | None = None,
+    ) -> Message | None:
         """
         过长消息转多条消息发送
 
@@ -42,40 +342,44 @@ class BotPlus(Bot):
             传入参数
         chat_id: `str | int`
             对话id
-        text: `list[str]`
-            要转换的文本, 以`list`形式传入
+        text: `Iterable[str]`
+            要转换的文本, 以`list`或生成器形式传入, 边分割边发送
         joiner: `str` = '\\n'
             参数`text`在转换时各元素之间的连接符
         parse_mode: `str | None` = 'MarkdownV2'
             仅支持 MarkdownV2, 且`text`中任何元素均为单一实体, 即形如 ``str``, *str*, _str_,\n
             支持的修饰符有 [ * | _ | __ | ~ | `` | *_ | *__ | *~ | _~ | __~ | `````` ]
+        priority: `int | None` = None
+            发送队列的优先级, 为 None 时使用 bot 的默认优先级
 
         Returns
         -------
-        `Message`
-            Message(TelegramObject)
+        `Message | None`
+            最后发送的 Message(TelegramObject), 没有发送任何消息时返回 None
 
         """
-        # 构建分割后的字符串列表
-        text = MessageText.split_too_long_message(text, parse_mode=parse_mode, joiner=joiner)
-        text = MessageText.short2long_message(text)
+        # 按 UTF-16 长度流式分割, 每得到一条消息就发送
+        chunker = MessageChunker(joiner=joiner, parse_mode=parse_mode)
         reply_to_message_id = None
-        for line in text:
+        bsr = None
+        for line in chunker.chunks(text):
             if reply_to_message_id:
                 bsr = self.send_message(
                     chat_id,
                     line,
                     parse_mode=parse_mode,
                     reply_to_message_id=reply_to_message_id,
+                    priority=priority,
                 )
             else:
-                bsr = self.send_message(chat_id, line, parse_mode=parse_mode)
+                bsr = self.send_message(chat_id, line, parse_mode=parse_mode, priority=priority)
             reply_to_message_id = bsr['message_id']
         return bsr
 
 
 # 日志机器人相关 ================================================================
-BOT = BotPlus(os.environ['DEVELOPER_TOKEN'])
+# 开发者 bot 的 TOKEN 与交互 bot 相同时两者共用发送队列, 错误日志不会挤占交互回复; 不同时各自按自己的限制发送
+BOT = LazyObject(lambda: BotPlus(os.environ['DEVELOPER_TOKEN'], priority=OutboundQueue.LOW, dispatch_errors=False))
 
 if __name__ == '__main__':
     pass
@@ -6,23 +6,37 @@
 @Author      :  Kiyan Yang
 @Contact     :  KiyanYang@outlook.com
 @Version     :  v1.1.1
-@Description :  配置文件热加载
+@Description :  配置文件热加载, 配置、GitHub API、语言文本表均在首次使用时创建
 """
 import os
 
-from .tools import Configs, GitHubAPIv4
+from .tools import HTTP, Configs, GitHubAPIv4, LazyObject, TextTable
 
 LOCAL = os.environ.get('LOCAL', False) == 'True'
-DEVELOPER_CHAT_ID = os.environ['DEVELOPER_CHAT_ID']
 file_path = {0: 'bot/configs/config.yaml', 1: 'bot/configs/languages.yaml'}
 
+
+def developer_chat_id() -> str:
+    return os.environ['DEVELOPER_CHAT_ID']
+
+
+# 依赖配置的对象, 相应配置重新加载时随之重建
+def configure_http() -> None:
+    cfg = CFG[0]
+    HTTP.configure(**cfg['HTTP'], proxy=cfg['PROXY_URL'] if LOCAL else None)
+
+
+def setup_configs(cfg: Configs) -> None:
+    configure_http()
+    cfg.subscribe(0, configure_http, sections=('HTTP', 'PROXY_URL'))
+
+
 # 对本地环境开启热加载
-if LOCAL:
-    CFG = Configs(file_path, hot=True)
-    GITHUB = GitHubAPIv4(os.environ['TOKEN_GITHUB'], proxy=CFG[0]['PROXY_URL'])
-else:
-    CFG = Configs(file_path, hot=False)
-    GITHUB = GitHubAPIv4(os.environ['TOKEN_GITHUB'])
+CFG = LazyObject(lambda: Configs(file_path, hot=LOCAL), setup=setup_configs)
+GITHUB = LazyObject(lambda: GitHubAPIv4(os.environ['TOKEN_GITHUB']))
+
+# 语言文本表
+TEXTS = LazyObject(lambda: TextTable(CFG[1]), setup=lambda texts: CFG.subscribe(1, lambda: texts.load(CFG[1])))
 
 if __name__ == '__main__':
     pass
@@ -8,30 +8,50 @@
 @Version     :  v1.2
 @Description :  telegram bot 所需要的 handler 模块
 """
+import logging
+import threading
+import time
+import traceback
+import uuid
 from functools import wraps
 from typing import Any
 
-import requests
 from telegram import (
     BotCommandScopeChat,
     BotCommandScopeDefault,
     ChatAction,
     InlineKeyboardButton,
-    Message,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
     Update,
 )
+from telegram.error import BadRequest
 from telegram.ext import (
     CallbackContext,
     CommandHandler,
     ConversationHandler,
     Filters,
+    Job,
+    JobQueue,
     MessageHandler,
 )
-
-from .config import CFG, DEVELOPER_CHAT_ID, GITHUB
-from .tools import Fund, MarkdownV2, get_logger
+from telegram.ext.utils.promise import Promise
+
+from .bot import BOT
+from .config import CFG, GITHUB, TEXTS, developer_chat_id
+from .router import CommandRouter, TextRouter
+from .tools import (
+    HTTP,
+    ChatExecutor,
+    Fund,
+    FundQuotes,
+    LazyObject,
+    LRUCache,
+    MarkdownV2,
+    datetime_now,
+    get_logger,
+    pending_work,
+)
 
 logger = get_logger(__name__)
 
@@ -57,35 +77,139 @@ def build_keyboard(
     return keyboard
 
 
-def get_text(topkey: str, subkey: str, update: Update = None, language_code: str = None):
+def get_text(
+    topkey: str,
+    subkey: str,
+    update: Update = None,
+    language_code: str = None,
+    escape: bool = False,
+):
+    code = None
     if update is not None:
         code = update.effective_user.language_code
     if language_code is not None:
         code = language_code
     # code = 'en'  # 测试语言使用
-    if (code is None) or (code not in ('zh-hans', 'en')):
-        code = 'zh-hans'
-    return CFG[1][topkey][subkey][code]
+    return TEXTS.get(topkey, subkey, code, escape=escape)
+
 
+def end_conversation(handler: ConversationHandler, update: Update) -> None:
+    """结束 update 所属对话者在 handler 中的对话
 
-def stop(*args, **kwargs) -> int:
-    return END
+    PTB 没有结束对话的公开接口, 这里使用 ConversationHandler 的私有方法计算 key 和结束状态, 保证加锁和持久化
+    与 PTB 一致. 已在 python-telegram-bot 13.8.1 中确认, 升级 PTB 时需检查`_get_key`和`_update_state`
+    """
+    handler._update_state(END, handler._get_key(update))
+
+
+class ConversationRegistry:
+    """对话注册表, 用于直接结束同一对话者的其他对话
+
+    新的 ConversationHandler 只需通过`register`注册, 即可被`stop_other_conversation`结束
+    """
+    def __init__(self) -> None:
+        self.conversations = {}  # name: ConversationHandler
+
+    def register(self, name: str, handler: ConversationHandler) -> ConversationHandler:
+        self.conversations[name] = handler
+        return handler
+
+    def stop_others(self, name: str, update: Update) -> None:
+        """结束 update 所属对话者除 name 以外的所有对话"""
+        for other, handler in self.conversations.items():
+            if other != name:
+                end_conversation(handler, update)
 
 
 # 装饰器 =======================================================================
-def send_action(action) -> Any:
-    """Sends `action` while processing func command."""
+def run_in_pool(func: callable) -> Any:
+    """在`HANDLER_POOL`中执行 func, 不阻塞 dispatcher 线程
+
+    同一对话的 update 按到达顺序执行, 不同对话并行执行. 返回`Promise`,
+    ConversationHandler 会在 func 执行完成后切换到其返回的状态. 队列已满时提示用户稍后再试.
+    执行登记在`pending_work`中, update 的确认在 func 执行完成后才进行
+    """
+    @wraps(func)
+    def run_in_pool_(self, update: Update, context: CallbackContext, *args, **kwargs) -> Promise | None:
+        promise = Promise(func, (self, update, context, *args), kwargs, update=update)
+        finish = pending_work(context).begin()
+
+        def run() -> None:
+            try:
+                promise.run()
+                if promise.exception is None:
+                    context.dispatcher.update_persistence(update=update)
+                else:
+                    context.dispatcher.dispatch_error(update, promise.exception, promise=promise)
+            finally:
+                finish()
+
+        chat_id = update.effective_chat.id
+        if HANDLER_POOL.submit(chat_id, run):
+            return promise
+        finish()
+        logger.warning(f'处理队列已满, 对话 {chat_id} 的请求被拒绝: {HANDLER_POOL.stats()}')
+        text = get_text('busy', 'busy', update=update)
+        context.bot.send_message_async(chat_id, text)  # 不等待发送完成, 不阻塞 dispatcher 线程
+        return None
+
+    return run_in_pool_
+
+
+def send_action(action, delay: float = 0.5, interval: float = 5) -> Any:
+    """Sends `action` while processing func command.
+
+    `action`由 JobQueue 中的定时任务发送, 不占用 func 的时间: func 在 delay 秒内完成时不发送,
+    否则每 interval 秒重复发送一次(Telegram 显示`action`约 5 秒), func 返回后取消任务
+    """
     def decorator(func: callable):
         @wraps(func)
         def send_action_(self, update: Update, context: CallbackContext, *args, **kwargs) -> Any:
-            context.bot.send_chat_action(chat_id=update.effective_message.chat_id, action=action)
-            return func(self, update, context, *args, **kwargs)
+            chat_id = update.effective_message.chat_id
+            if context.job_queue is None:
+                return func(self, update, context, *args, **kwargs)
+
+            def send(job_context: CallbackContext) -> None:
+                try:
+                    job_context.bot.send_chat_action(chat_id=chat_id, action=action)
+                except Exception as e:
+                    logger.warning(f'对话 {chat_id} 发送 {action} 失败: {e!r}')
+
+            name = f'{SEND_ACTION_JOB}{chat_id}'
+            job = context.job_queue.run_repeating(
+                send, interval, first=delay, name=name, job_kwargs={'id': f'{name}-{uuid.uuid4().hex}'}
+            )
+            try:
+                return func(self, update, context, *args, **kwargs)
+            finally:
+                job.schedule_removal()
 
         return send_action_
 
     return decorator
 
 
+def quiet_send_action_logs(record: logging.LogRecord) -> bool:
+    """过滤 apscheduler 关于`send_action`任务的 INFO 日志(每次调用都会添加、执行和移除一个任务)
+
+    按日志参数中的任务(或任务名称、id, 均以`SEND_ACTION_JOB`开头)判断, 不依赖日志文本;
+    其他任务的日志和所有警告、错误照常记录. 由`install_log_filters`安装
+    """
+    if record.levelno >= logging.WARNING or not isinstance(record.args, tuple):
+        return True
+    for arg in record.args:
+        job_id = getattr(arg, 'id', arg)
+        if isinstance(job_id, str) and job_id.startswith(SEND_ACTION_JOB):
+            return False
+    return True
+
+
+def install_log_filters() -> None:
+    """在配置日志时调用, 安装本模块的日志过滤器(重复调用不会重复安装)"""
+    for name in ('apscheduler.scheduler', 'apscheduler.executors.default'):
+        logging.getLogger(name).addFilter(quiet_send_action_logs)
+
+
 def cancel(topkey: str, subkey: str, language_code: str = None) -> Any:
     '''执行取消命令，发送消息，移除键盘'''
     def decorator(func: callable):
@@ -95,7 +219,7 @@ def cancel(topkey: str, subkey: str, language_code: str = None) -> Any:
             chat_id = update.effective_message.chat_id
             language_code = update.effective_user.language_code
             text = get_text(topkey, subkey, language_code=language_code)
-            context.bot.send_message(chat_id, text, reply_markup=ReplyKeyboardRemove())
+            context.bot.send_message_async(chat_id, text, reply_markup=ReplyKeyboardRemove())
             return res
 
         return cancel_
@@ -103,58 +227,160 @@ def cancel(topkey: str, subkey: str, language_code: str = None) -> Any:
     return decorator
 
 
-def stop_other_conversation(func: callable) -> Any:
-    """停止其他对话"""
-    @wraps(func)
-    def stop_(self, update: Update, context: CallbackContext, *args, **kwargs):
-        stop_keys = STOP_KEYS.copy()
-        del stop_keys[func.__name__]
-        for stop_key in stop_keys.values():
-            message = Message(
-                message_id=0,
-                date=update.message.date,
-                chat=update.message.chat,
-                from_user=update.message.from_user,
-                text=stop_key,
-            )
-            context.dispatcher.process_update(Update(update.update_id, message=message))
-        return func(self, update, context, *args, **kwargs)
+def stop_other_conversation(name: str) -> Any:
+    """停止除`name`(在`CONVERSATIONS`中注册的对话名)以外的其他对话"""
+    def decorator(func: callable):
+        @wraps(func)
+        def stop_(self, update: Update, context: CallbackContext, *args, **kwargs):
+            CONVERSATIONS.stop_others(name, update)
+            return func(self, update, context, *args, **kwargs)
 
-    return stop_
+        return stop_
+
+    return decorator
 
 
 # 快捷别名/全局变量 =============================================================
 send_action_typing = send_action(ChatAction.TYPING)
 send_action_upload_photo = send_action(ChatAction.UPLOAD_PHOTO)
+SEND_ACTION_JOB = 'send_action-'  # `send_action`任务名称和 id 的前缀
 END = ConversationHandler.END
-STOP_KEYS = {'fund': '_stop_fund_', 'settings': '_stop_settings_'}
-STOP_HANDLERS = {k: MessageHandler(Filters.regex(f'^{v}$'), stop) for k, v in STOP_KEYS.items()}
+CONVERSATIONS = ConversationRegistry()
+HANDLER_POOL = LazyObject(lambda: ChatExecutor(**CFG[0]['HANDLER_POOL']))  # 执行耗时 handler 的线程池, 见`run_in_pool`
+
+
+# 错误处理 =====================================================================
+def error_handler(update: object, context: CallbackContext) -> None:
+    """记录 handler 和发送队列中的异常, 并通过开发者 bot 发送给开发者(不等待发送完成, 不阻塞 dispatcher 线程)"""
+    error = context.error
+    logger.error(f'处理 update 时发生异常: {error!r}', exc_info=error)
+    tb = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+    text = f'{error!r}\n\nupdate: {update.to_dict() if isinstance(update, Update) else update}\n\n{tb}'
+    try:
+        BOT.send_message_async(developer_chat_id(), text[-4000:])  # 保留最后的调用栈
+    except Exception as e:
+        logger.warning(f'向开发者发送错误日志失败: {e!r}')
+
+
+# 定时任务 =====================================================================
+def update_fund_quotes(quotes: FundQuotes) -> None:
+    """配置变化后更新缓存的刷新间隔(判断行情是否过期), 不预取行情的进程也需要"""
+    quotes.interval = CFG[0]['FUND_PREFETCH']['interval']
+
+
+def update_fund_prefetch() -> None:
+    """配置变化后按新的间隔重新安排`start_fund_prefetch`创建的任务"""
+    cfg = CFG[0]['FUND_PREFETCH']
+    for name, key in (('load_fund_holdings', 'holdings_interval'), ('refresh_fund_quotes', 'interval')):
+        job = FUND_PREFETCH_JOBS.get(name)
+        if job is not None and not job.removed:
+            job.job.reschedule(trigger='interval', seconds=cfg[key])
+
+
+FUND_PREFETCH_JOBS: dict[str, Job] = {}  # 任务名: `start_fund_prefetch`创建的任务
+FUND_QUOTES = LazyObject(
+    lambda: FundQuotes(interval=CFG[0]['FUND_PREFETCH']['interval']),
+    setup=lambda quotes: CFG.subscribe(0, lambda: update_fund_quotes(quotes), sections=('FUND_PREFETCH',)),
+)
+
+
+def load_fund_holdings(context: CallbackContext = None) -> None:
+    """读取持仓文件, 更新需要预取行情的持仓基金"""
+    FUND_QUOTES.set_holdings(GITHUB.get_raw(CFG[0]['GitHub']['fund'], type='yaml'))
+
+
+def refresh_fund_quotes(context: CallbackContext = None) -> None:
+    """刷新关注的基金的行情"""
+    FUND_QUOTES.refresh()
+
+
+def start_fund_prefetch(job_queue: JobQueue) -> None:
+    """在 JobQueue 中定时读取持仓文件和刷新基金行情, 配置变化后按新的间隔重新安排"""
+    cfg = CFG[0]['FUND_PREFETCH']
+    if not FUND_PREFETCH_JOBS:
+        CFG.subscribe(0, update_fund_prefetch, sections=('FUND_PREFETCH',))
+    FUND_PREFETCH_JOBS['load_fund_holdings'] = job_queue.run_repeating(
+        load_fund_holdings, cfg['holdings_interval'], first=0, name='load_fund_holdings'
+    )
+    FUND_PREFETCH_JOBS['refresh_fund_quotes'] = job_queue.run_repeating(
+        refresh_fund_quotes, cfg['interval'], first=10, name='refresh_fund_quotes'
+    )
 
 
 # CommandHandler ==============================================================
 class CommHandlerBingimage:
     """命令`/bing_image` => 必应日图"""
+    # 日期变更后 Bing 尚未更新图片时, 两次请求 Bing 的最小间隔(秒)
+    REFRESH_INTERVAL = 600
+
     def __init__(self) -> None:
         self.handler = CommandHandler('bing_image', self.bing_image)
+        # 当日图片缓存: {'date', 'url', 'url_uhd', 'copyright', 'file_id', 'checked'}
+        self.cache = None
+        self.lock = threading.Lock()
 
-    def get_bingimage(self) -> tuple[str, str, str]:
+    def get_bingimage(self) -> tuple[str, str, str, str]:
         base_url = 'https://cn.bing.com/HPImageArchive.aspx?format=js&n=1&mkt=zh-CN'
-        r_json = requests.get(base_url).json()
+        r_json = HTTP.get(base_url).json()
         url_image = r_json['images'][0]
+        image_date = url_image['startdate']
         image_url = f"https://www.bing.com{url_image['urlbase']}_1920x1080.jpg"
         image_url_uhd = f"https://www.bing.com{url_image['urlbase']}_UHD.jpg"
         image_copyright = url_image['copyright']
-        return image_url, image_url_uhd, image_copyright
-
+        return image_date, image_url, image_url_uhd, image_copyright
+
+    def is_fresh(self, cache: dict | None) -> bool:
+        if cache is None:
+            return False
+        if cache['date'] == datetime_now().strftime('%Y%m%d'):
+            return True
+        return time.monotonic() - cache['checked'] < self.REFRESH_INTERVAL
+
+    def get_bingimage_cached(self) -> dict:
+        """获取当日必应日图信息, 缓存过期时才请求 Bing, 并发的请求共用同一次请求"""
+        cache = self.cache
+        if self.is_fresh(cache):
+            return cache
+        with self.lock:
+            cache = self.cache
+            if self.is_fresh(cache):  # 等待锁期间已由其他请求更新
+                return cache
+            image_date, image_url, image_url_uhd, image_copyright = self.get_bingimage()
+            if cache is not None and cache['date'] == image_date:
+                cache['checked'] = time.monotonic()  # 图片未更新, 保留 file_id
+            else:
+                cache = {
+                    'date': image_date,
+                    'url': image_url,
+                    'url_uhd': image_url_uhd,
+                    'copyright': image_copyright,
+                    'file_id': None,
+                    'checked': time.monotonic(),
+                }
+                self.cache = cache
+            return cache
+
+    @run_in_pool
     @send_action_upload_photo
     def bing_image(self, update: Update, context: CallbackContext) -> None:
         """获取必应今日高清壁纸，包含高清图链接、超高清图链接、版权信息"""
         chat_id = update.effective_message.chat_id
-        image_url, image_url_uhd, image_copyright = self.get_bingimage()
+        image = self.get_bingimage_cached()
         text_view_uhd_image = get_text('bing_image', 'bing_image', update=update)
-        text = (f'{image_copyright}', f'\[{text_view_uhd_image}\]\({image_url_uhd}\)')
+        text = (f'{image["copyright"]}', rf'\[{text_view_uhd_image}\]\({image["url_uhd"]}\)')
         text = MarkdownV2.sub_auto('\n'.join(text))
-        context.bot.send_photo(chat_id, image_url, caption=text, parse_mode='MarkdownV2')
+        # 已发送过的图片使用 file_id 发送, Telegram 无需重新下载
+        file_id = image['file_id']
+        photo = file_id or image['url']
+        try:
+            message = context.bot.send_photo(chat_id, photo, caption=text, parse_mode='MarkdownV2')
+        except BadRequest:
+            if file_id is None:
+                raise
+            image['file_id'] = None
+            message = context.bot.send_photo(chat_id, image['url'], caption=text, parse_mode='MarkdownV2')
+        if image['file_id'] is None and message.photo:
+            image['file_id'] = message.photo[-1].file_id
 
 
 # CommandHandler ==============================================================
@@ -181,13 +407,12 @@ class CommHandlerEcho:
         if 'reply_to_message' in message.to_dict().keys():
             try:
                 message_id = message.reply_to_message.message_id
-                context.bot.copy_message(chat_id, chat_id, message_id)
+                context.bot.copy_message_async(chat_id, chat_id, message_id)
             except Exception as e:
                 ...
         else:
-            text = get_text('echo', 'echo', update=update)
-            text = MarkdownV2.sub_auto(text)
-            context.bot.send_message(chat_id, text, parse_mode='MarkdownV2')
+            text = get_text('echo', 'echo', update=update, escape=True)
+            context.bot.send_message_async(chat_id, text, parse_mode='MarkdownV2')
 
 
 # CommandHandler ==============================================================
@@ -201,7 +426,7 @@ class CommHandlerHello:
         first_name = update.effective_user.first_name
         text_hello = get_text('hello', 'hello', update=update)
         text = f'{text_hello}{first_name}'
-        context.bot.send_message(chat_id, text)
+        context.bot.send_message_async(chat_id, text)
 
 
 # CommandHandler ==============================================================
@@ -212,50 +437,64 @@ class CommHandlerHelp:
 
     def help(self, update: Update, context: CallbackContext) -> None:
         chat_id = update.effective_message.chat_id
-        if chat_id == DEVELOPER_CHAT_ID:
-            text = get_text('help', 'help_1', update=update)
+        if chat_id == developer_chat_id():
+            text = get_text('help', 'help_1', update=update, escape=True)
         else:
-            text = get_text('help', 'help_1', update=update)
-        text = MarkdownV2.sub_auto(text)
-        context.bot.send_message(chat_id, text, parse_mode='MarkdownV2')
+            text = get_text('help', 'help_1', update=update, escape=True)
+        context.bot.send_message_async(chat_id, text, parse_mode='MarkdownV2')
 
 
 # CommandHandler ==============================================================
 class CommHandlerHhsh:
     """命令`/hhsh` => 好好说话"""
+    # 单个缩写释义的缓存条目数和过期时间(秒)
+    CACHE_SIZE = 4096
+    CACHE_TTL = 6 * 3600
+
     def __init__(self) -> None:
         self.handler = CommandHandler('hhsh', self.hhsh)
+        self.cache = LRUCache(self.CACHE_SIZE, self.CACHE_TTL)
 
     def get_nbnhhsh(self, text: list[str] = None) -> list[dict[str:list[str]]]:
-        payload = {'text': ','.join(text)}
-        res = requests.post(CFG[0]['API']['nbnhhsh'], json=payload).json()
+        # 命中缓存的缩写直接使用, 其余缩写合并为一次请求
+        res, missing = [], []
+        for x in dict.fromkeys(text):
+            cached = self.cache.get(x)
+            if cached is None:
+                missing.append(x)
+            else:
+                res.append(cached)
+        if missing:
+            payload = {'text': ','.join(missing)}
+            res_missing = HTTP.post(CFG[0]['API']['nbnhhsh'], json=payload, idempotent=True).json()
+            for x in res_missing:
+                self.cache.set(x['name'], x)
+            res.extend(res_missing)
         # 反序再反序可以使重复的数据按首次出现的位置排序
         rule = {x: i for i, x in enumerate(text[::-1])}
         res_sorted = sorted(res, key=lambda x: rule[x['name']], reverse=True)
         return res_sorted
 
+    @run_in_pool
     @send_action_typing
     def hhsh(self, update: Update, context: CallbackContext) -> None:
         def trans(nbnhhsh: dict) -> str:
             if 'trans' in nbnhhsh.keys():
-                trans = nbnhhsh['trans']
-                trans.insert(0, '')
-                trans_text = '\n    '.join(trans)
+                # 释义列表来自缓存, 不能原地修改
+                trans_text = '\n    '.join(['', *nbnhhsh['trans']])
             else:
                 trans_text = '\n    ' + text_hhsh_2
-            return f'\*{nbnhhsh["name"]}：\*{trans_text}\n'
+            return f'\\*{nbnhhsh["name"]}：\\*{trans_text}\n'
 
         chat_id = update.effective_message.chat_id
         args_hhsh = context.args
-        text_hhsh_1 = get_text('hhsh', 'hhsh_1', update=update)
         text_hhsh_2 = get_text('hhsh', 'hhsh_2', update=update)
         if args_hhsh == [] or args_hhsh is None:
-            text = text_hhsh_1
+            text = get_text('hhsh', 'hhsh_1', update=update, escape=True)
         else:
             nbnhhsh = self.get_nbnhhsh(args_hhsh)
             text = [trans(x) for x in nbnhhsh]
-            text = '\n'.join(text)
-        text = MarkdownV2.sub_auto(text)
+            text = MarkdownV2.sub_auto('\n'.join(text))
         context.bot.send_message(chat_id, text, parse_mode='MarkdownV2')
 
 
@@ -268,7 +507,7 @@ class CommHandlerStart:
     def start(self, update: Update, context: CallbackContext) -> None:
         chat_id = update.effective_message.chat_id
         text = get_text('start', 'start', update=update)
-        context.bot.send_message(chat_id, text)
+        context.bot.send_message_async(chat_id, text)
 
 
 # ConversationHandler =========================================================
@@ -277,24 +516,32 @@ class ConvHandlerFund:
     def __init__(self) -> None:
         self.CHOOSING, self.FUNDINFO = range(2)
         self.fund_url = CFG[0]['GitHub']['fund']
+        self.quotes = FUND_QUOTES  # 基金行情缓存, 获取基金信息时通过 self.quotes.get / get_many 读取
         _states = {
             self.CHOOSING: [
-                MessageHandler(Filters.regex('^基金信息$'), self.show_fund_code),
-                MessageHandler(Filters.regex('^今日操作$'), self.send_today_action),
-                MessageHandler(Filters.regex('^估计收益$'), self.send_all_fund_income),
+                TextRouter({
+                    '基金信息': self.show_fund_code,
+                    '今日操作': self.send_today_action,
+                    '估计收益': self.send_all_fund_income,
+                }),
             ],
             self.FUNDINFO: [
                 MessageHandler(Filters.regex(r'^\d{6}$'), self.send_fund_info),
             ],
         }
-        self.handler = ConversationHandler(
-            entry_points=[CommandHandler('fund', self.fund)],
-            states=_states,
-            fallbacks=[CommandHandler('cancel', self.cancel), STOP_HANDLERS['fund']],
-            allow_reentry=True,
+        self.handler = CONVERSATIONS.register(
+            'fund',
+            ConversationHandler(
+                entry_points=[CommandHandler('fund', self.fund)],
+                states=_states,
+                fallbacks=[CommandHandler('cancel', self.cancel)],
+                allow_reentry=True,
+                name='fund',
+                persistent=True,
+            ),
         )
 
-    @stop_other_conversation
+    @stop_other_conversation('fund')
     def fund(self, update: Update, context: CallbackContext):
         ...
         return self.CHOOSING
@@ -305,18 +552,21 @@ class ConvHandlerFund:
         return self.FUNDINFO
 
     # fund选择 基金信息_2, 根据输入的基金代码获取相关信息
+    @run_in_pool
     @send_action_typing
     def send_fund_info(self, update: Update, context: CallbackContext):
         ...
         return self.FUNDINFO
 
     # myfund选择“今日操作”
+    @run_in_pool
     @send_action_typing
     def send_today_action(self, update: Update, context: CallbackContext):
         ...
         return END
 
     # myfund选择“估计收益”
+    @run_in_pool
     @send_action_typing
     def send_all_fund_income(self, update: Update, context: CallbackContext) -> int:
         ...
@@ -334,18 +584,25 @@ class ConvHandlerSettings:
         self.SETTINGS = range(1)
         _states = {
             self.SETTINGS: [
-                MessageHandler(Filters.regex('^设置命令$'), self.set_my_commands),
-                MessageHandler(Filters.regex('^删除命令$'), self.del_my_commands),
+                TextRouter({
+                    '设置命令': self.set_my_commands,
+                    '删除命令': self.del_my_commands,
+                }),
             ]
         }
-        self.handler = ConversationHandler(
-            entry_points=[CommandHandler('settings', self.settings)],
-            states=_states,
-            fallbacks=[CommandHandler('cancel', self.cancel), STOP_HANDLERS['settings']],
-            allow_reentry=True,
+        self.handler = CONVERSATIONS.register(
+            'settings',
+            ConversationHandler(
+                entry_points=[CommandHandler('settings', self.settings)],
+                states=_states,
+                fallbacks=[CommandHandler('cancel', self.cancel)],
+                allow_reentry=True,
+                name='settings',
+                persistent=True,
+            ),
         )
 
-    @stop_other_conversation
+    @stop_other_conversation('settings')
     def settings(self, update: Update, context: CallbackContext) -> int:
         chat_id = update.effective_message.chat_id
         markup = ReplyKeyboardMarkup(
@@ -354,27 +611,27 @@ class ConvHandlerSettings:
             one_time_keyboard=True,
         )
         text = get_text('settings', 'settings', update=update)
-        context.bot.send_message(chat_id, text, reply_markup=markup)
+        context.bot.send_message_async(chat_id, text, reply_markup=markup)
         return self.SETTINGS
 
     def set_my_commands(self, update: Update, context: CallbackContext) -> int:
-        scope_1 = BotCommandScopeChat(DEVELOPER_CHAT_ID)
+        scope_1 = BotCommandScopeChat(developer_chat_id())
         scope_2 = BotCommandScopeDefault()
         context.bot.set_my_commands(CFG[0]['MY_COMMANDS_1'], scope=scope_1)
         context.bot.set_my_commands(CFG[0]['MY_COMMANDS_2'], scope=scope_2)
         chat_id = update.effective_message.chat_id
         text = get_text('settings', 'set_my_commands', update=update)
-        context.bot.send_message(chat_id, text, reply_markup=ReplyKeyboardRemove())
+        context.bot.send_message_async(chat_id, text, reply_markup=ReplyKeyboardRemove())
         return END
 
     def del_my_commands(self, update: Update, context: CallbackContext) -> int:
-        scope_1 = BotCommandScopeChat(DEVELOPER_CHAT_ID)
+        scope_1 = BotCommandScopeChat(developer_chat_id())
         scope_2 = BotCommandScopeDefault()
         context.bot.delete_my_commands(scope=scope_1)
         context.bot.delete_my_commands(scope=scope_2)
         chat_id = update.effective_message.chat_id
         text = get_text('settings', 'del_my_commands', update=update)
-        context.bot.send_message(chat_id, text, reply_markup=ReplyKeyboardRemove())
+        context.bot.send_message_async(chat_id, text, reply_markup=ReplyKeyboardRemove())
         return END
 
     @cancel('settings', 'cancel')
@@ -384,17 +641,14 @@ class ConvHandlerSettings:
 
 # MessageHandler ==============================================================
 class MessHandlerUnknown:
-    """消息 => 未知指令"""
+    """消息 => 未知指令, 由`command_router`在命令未命中时调用"""
     def __init__(self) -> None:
-        commands = [x[0] for x in CFG[0]['MY_COMMANDS_1']]
-        commands_filter = Filters.regex(f'^({"|".join(commands)})')
-        filters = ~commands_filter & Filters.command & Filters.chat_type.private
-        self.handler = MessageHandler(filters, self.unknown)
+        self.handler = MessageHandler(Filters.command & Filters.chat_type.private, self.unknown)
 
     def unknown(self, update: Update, context: CallbackContext) -> None:
         chat_id = update.effective_message.chat_id
         text = get_text('unknown', 'unknown', update=update)
-        context.bot.send_message(chat_id, text)
+        context.bot.send_message_async(chat_id, text)
 
 
 # TestHandler =================================================================
@@ -410,15 +664,65 @@ class TestHandler:
         pass
 
 
-# handlers
-comm_handler_bingimage = CommHandlerBingimage().handler
-comm_handler_cancel = CommHandlerCancel().handler
-comm_handler_echo = CommHandlerEcho().handler
-comm_handler_hello = CommHandlerHello().handler
-comm_handler_help = CommHandlerHelp().handler
-comm_handler_hhsh = CommHandlerHhsh().handler
-comm_handler_start = CommHandlerStart().handler
-conv_handler_fund = ConvHandlerFund().handler
-conv_handler_settings = ConvHandlerSettings().handler
-mess_handler_unknown = MessHandlerUnknown().handler
-test_handler = TestHandler().handler
+# handlers, 首次访问时创建 ========================================================
+def create_command_router() -> CommandRouter:
+    """命令路由, 代替逐个检查 CommandHandler; 未知命令为路由的未命中"""
+    # 先创建对话, 使其入口命令不被视为未知命令
+    get_handler('conv_handler_fund')
+    get_handler('conv_handler_settings')
+    router = CommandRouter(
+        [
+            get_handler('comm_handler_bingimage'),
+            get_handler('comm_handler_cancel'),
+            get_handler('comm_handler_echo'),
+            get_handler('comm_handler_hello'),
+            get_handler('comm_handler_help'),
+            get_handler('comm_handler_hhsh'),
+            get_handler('comm_handler_start'),
+        ],
+        unknown=get_handler('mess_handler_unknown'),
+    )
+
+    def update_known_commands() -> None:
+        """命令列表和对话入口中的命令不视为未知命令"""
+        known = {x[0].lstrip('/').lower() for x in CFG[0]['MY_COMMANDS_1']}
+        for handler in CONVERSATIONS.conversations.values():
+            for entry_point in handler.entry_points:
+                if isinstance(entry_point, CommandHandler):
+                    known.update(entry_point.command)
+        router.known = frozenset(known)
+
+    update_known_commands()
+    CFG.subscribe(0, update_known_commands, sections=('MY_COMMANDS_1',))
+    return router
+
+
+HANDLER_FACTORIES = {
+    'comm_handler_bingimage': lambda: CommHandlerBingimage().handler,
+    'comm_handler_cancel': lambda: CommHandlerCancel().handler,
+    'comm_handler_echo': lambda: CommHandlerEcho().handler,
+    'comm_handler_hello': lambda: CommHandlerHello().handler,
+    'comm_handler_help': lambda: CommHandlerHelp().handler,
+    'comm_handler_hhsh': lambda: CommHandlerHhsh().handler,
+    'comm_handler_start': lambda: CommHandlerStart().handler,
+    'conv_handler_fund': lambda: ConvHandlerFund().handler,
+    'conv_handler_settings': lambda: ConvHandlerSettings().handler,
+    'mess_handler_unknown': lambda: MessHandlerUnknown().handler,
+    'test_handler': lambda: TestHandler().handler,
+    'command_router': create_command_router,
+}
+_handlers_lock = threading.RLock()
+
+
+def get_handler(name: str) -> Any:
+    """创建并缓存 handler, 之后可以直接作为模块属性访问"""
+    with _handlers_lock:
+        if name not in globals():
+            globals()[name] = HANDLER_FACTORIES[name]()
+        return globals()[name]
+
+
+def __getattr__(name: str) -> Any:
+    if name in HANDLER_FACTORIES:
+        return get_handler(name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Filename    :  persistence.py
+@Datatime    :  2021/11/22 21:05:36
+@Author      :  Kiyan Yang
+@Contact     :  KiyanYang@outlook.com
+@Version     :  v1.0
+@Description :  基于 SQLite(WAL) 的对话状态、user_data、chat_data 持久化
+"""
+import atexit
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Hashable
+
+from telegram.ext import BasePersistence, ConversationHandler
+from telegram.ext.utils.promise import Promise
+
+from .tools import get_logger, is_ephemeral
+
+logger = get_logger(__name__)
+
+
+class LazyDataDict(defaultdict):
+    """首次访问某个 id 时才从数据库读取其数据的 user_data/chat_data"""
+    def __init__(self, loader: Callable[[Hashable], dict | None]) -> None:
+        super().__init__(dict)
+        self.loader = loader
+
+    def __missing__(self, key: Hashable) -> dict:
+        value = self.loader(key)
+        self[key] = {} if value is None else value
+        return self[key]
+
+
+class SQLitePersistence(BasePersistence):
+    """基于 SQLite(WAL) 的持久化
+
+    - 每个 user_data/chat_data/对话状态为一行, 只写入内容发生变化的行
+    - handler 只把变化暂存在内存中, 由后台线程每隔 flush_interval 秒在一个事务中批量写入
+    - 对话步骤异步执行(`run_in_pool`)时先保存原来的状态, 执行完成后的新状态在下一次批量写入时暂存并写入,
+      不需要等待该对话的下一个 update
+    - 后台线程每隔 compact_interval 秒将 WAL 合并回数据库并截断
+    - user_data/chat_data 在首次访问某个 id 时才读取, 对话状态在 ConversationHandler 注册时读取
+    - 多进程时各 worker 共用一个数据库(各自写入自己的对话), 写入时最多等待其他进程的写锁`busy_timeout`秒,
+      超时后此次写入失败, 暂存的数据保留到下次批量写入时重试
+    - 数据库位于临时文件系统(如 heroku dyno)时, `require_durable`为 True 时拒绝启动, 为 False 时只发出警告
+
+    Parameters
+    ----------
+    path : str
+        数据库文件路径
+    flush_interval : float, optional
+        批量写入的间隔(秒), by default 5
+    compact_interval : float, optional
+        合并 WAL 的间隔(秒), by default 600
+    busy_timeout : float, optional
+        等待其他连接的写锁的时间(秒), by default 5
+    require_durable : bool | None, optional
+        数据库位于临时文件系统时是否抛出`RuntimeError`, 为 None 时在 heroku dyno 中为 True, by default None
+    store_user_data : bool, optional
+        by default True
+    store_chat_data : bool, optional
+        by default True
+    store_bot_data : bool, optional
+        by default True
+    """
+    def __init__(
+        self,
+        path: str,
+        flush_interval: float = 5,
+        compact_interval: float = 600,
+        busy_timeout: float = 5,
+        require_durable: bool | None = None,
+        store_user_data: bool = True,
+        store_chat_data: bool = True,
+        store_bot_data: bool = True,
+    ) -> None:
+        super().__init__(store_user_data, store_chat_data, store_bot_data)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        if is_ephemeral():
+            message = f'持久化数据库 {path} 位于临时文件系统, dyno 重启后对话状态和用户数据会丢失, 需设置 DATA_DIR'
+            if require_durable is not False:
+                raise RuntimeError(message)
+            logger.warning(message)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.__db = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False, isolation_level=None)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('PRAGMA synchronous=NORMAL')
+        self.__db.execute(
+            'CREATE TABLE IF NOT EXISTS state ('
+            'kind TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, PRIMARY KEY (kind, key)'
+            ') WITHOUT ROWID'
+        )
+        self.__db_lock = threading.Lock()
+        self.__lock = threading.Lock()
+        self.__pending = {}  # (kind, key): 待写入的数据, None 表示删除
+        self.__written = {}  # (kind, key): 数据库中数据的摘要
+        self.__promises = {}  # (kind, key): (执行中的对话步骤的 Promise, 原来的状态)
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name='SQLitePersistence', daemon=True)
+        self.__thread.start()
+        atexit.register(self.close)
+
+    # 读取 ====================================================================
+    def __select(self, sql: str, params: tuple) -> list[tuple[str, bytes]]:
+        with self.__db_lock:
+            return self.__db.execute(sql, params).fetchall()
+
+    def __load(self, kind: str, key: Hashable) -> Any:
+        k = (kind, json.dumps(key))
+        with self.__lock:
+            if k in self.__pending:  # 尚未写入数据库
+                blob = self.__pending[k]
+                return None if blob is None else pickle.loads(blob)
+        rows = self.__select('SELECT key, value FROM state WHERE kind = ? AND key = ?', k)
+        if not rows:
+            return None
+        blob = rows[0][1]
+        with self.__lock:
+            self.__written.setdefault(k, hashlib.blake2b(blob).digest())
+        return pickle.loads(blob)
+
+    def insert_bot(self, obj: object) -> object:
+        # 惰性字典在读取每个 id 时才插入 bot, 不能整体复制
+        if isinstance(obj, LazyDataDict):
+            return obj
+        return super().insert_bot(obj)
+
+    def get_user_data(self) -> LazyDataDict:
+        return LazyDataDict(lambda user_id: self.insert_bot(self.__load('user', user_id)))
+
+    def get_chat_data(self) -> LazyDataDict:
+        return LazyDataDict(lambda chat_id: self.insert_bot(self.__load('chat', chat_id)))
+
+    def get_bot_data(self) -> dict:
+        data = self.__load('bot', None)
+        return {} if data is None else data
+
+    def get_conversations(self, name: str) -> dict:
+        kind = f'conv:{name}'
+        rows = self.__select('SELECT key, value FROM state WHERE kind = ?', (kind,))
+        with self.__lock:
+            for key, blob in rows:
+                self.__written.setdefault((kind, key), hashlib.blake2b(blob).digest())
+        return {tuple(json.loads(key)): pickle.loads(blob) for key, blob in rows}
+
+    # 写入 ====================================================================
+    def __stage(self, kind: str, key: Hashable, value: Any, promise: Promise | None = None) -> None:
+        """暂存变化的数据, 与数据库中相同的数据不写入; value 为 None 时删除.
+        `promise`为对话步骤的 Promise 时, 执行完成后由`__stage_promises`暂存其结果
+        """
+        k = (kind, json.dumps(key))
+        blob = None if value is None else pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.__lock:
+            if promise is None:
+                self.__promises.pop(k, None)  # 之后的状态更新取代执行中的步骤
+            else:
+                self.__promises[k] = (promise, value)
+            self.__put(k, blob)
+
+    def __put(self, k: tuple[str, str], blob: bytes | None) -> None:
+        """需持有`__lock`"""
+        digest = None if blob is None else hashlib.blake2b(blob).digest()
+        if k not in self.__pending and self.__written.get(k) == digest:
+            return
+        self.__pending[k] = blob
+
+    @staticmethod
+    def __resolve(promise: Promise, old_state: object | None) -> object | None:
+        """与`ConversationHandler`相同: 步骤返回 None 或抛出异常时保持原来的状态, 结束对话时删除"""
+        res = old_state if promise.exception is not None or promise.result(0) is None else promise.result(0)
+        return None if res == ConversationHandler.END else res
+
+    def __stage_promises(self) -> None:
+        """暂存已执行完成的对话步骤的新状态"""
+        with self.__lock:
+            done = [(k, v) for k, v in self.__promises.items() if v[0].done.is_set()]
+        for k, (promise, old_state) in done:
+            state = self.__resolve(promise, old_state)
+            blob = None if state is None else pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+            with self.__lock:
+                if self.__promises.get(k, (None,))[0] is promise:  # 期间没有新的状态更新
+                    del self.__promises[k]
+                    self.__put(k, blob)
+
+    def update_conversation(self, name: str, key: tuple[int, ...], new_state: object | None) -> None:
+        # 异步执行中的状态不能序列化, 先保存原来的状态, 执行完成后由`flush`暂存新状态;
+        # 连续的异步步骤会产生嵌套的 ((old_state, promise), promise), 最外层为最新的步骤, 需逐层展开
+        promise = None
+        if isinstance(new_state, tuple) and len(new_state) == 2 and isinstance(new_state[1], Promise):
+            promise = new_state[1]
+        while isinstance(new_state, tuple) and len(new_state) == 2 and isinstance(new_state[1], Promise):
+            new_state = new_state[0]
+        self.__stage(f'conv:{name}', list(key), new_state, promise)
+
+    def update_user_data(self, user_id: int, data: dict) -> None:
+        self.__stage('user', user_id, data or None)  # 空的数据不保存
+
+    def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self.__stage('chat', chat_id, data or None)
+
+    def update_bot_data(self, data: dict) -> None:
+        self.__stage('bot', None, data or None)
+
+    def flush(self) -> None:
+        """在一个事务中写入所有暂存的数据(包括已执行完成的对话步骤的新状态)"""
+        self.__stage_promises()
+        with self.__lock:
+            pending, self.__pending = self.__pending, {}
+        if not pending:
+            return
+        upserts = [(kind, key, blob) for (kind, key), blob in pending.items() if blob is not None]
+        deletes = [(kind, key) for (kind, key), blob in pending.items() if blob is None]
+        try:
+            with self.__db_lock:
+                self.__db.execute('BEGIN IMMEDIATE')  # 开始时即取得写锁, 在 busy_timeout 内等待其他进程
+                self.__db.executemany(
+                    'INSERT INTO state (kind, key, value) VALUES (?, ?, ?) '
+                    'ON CONFLICT (kind, key) DO UPDATE SET value = excluded.value',
+                    upserts,
+                )
+                self.__db.executemany('DELETE FROM state WHERE kind = ? AND key = ?', deletes)
+                self.__db.execute('COMMIT')
+        except sqlite3.Error:
+            logger.exception('持久化数据写入失败, 下次重试')
+            with self.__db_lock:
+                if self.__db.in_transaction:
+                    self.__db.execute('ROLLBACK')
+            with self.__lock:
+                self.__pending = pending | self.__pending  # 期间新暂存的数据更新, 优先保留
+            return
+        with self.__lock:
+            for k, blob in pending.items():
+                self.__written[k] = None if blob is None else hashlib.blake2b(blob).digest()
+
+    def compact(self) -> None:
+        """将 WAL 合并回数据库并截断"""
+        with self.__db_lock:
+            busy, log, checkpointed = self.__db.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        logger.info(f'持久化 WAL 合并完成: busy={busy}, log={log}, checkpointed={checkpointed}')
+
+    def __run(self) -> None:
+        last_compact = time.monotonic()
+        while not self.__stopped.wait(self.flush_interval):
+            self.flush()
+            if time.monotonic() - last_compact >= self.compact_interval:
+                last_compact = time.monotonic()
+                try:
+                    self.compact()
+                except sqlite3.Error:
+                    logger.exception('持久化 WAL 合并失败')
+
+    def close(self) -> None:
+        """停止后台线程, 写入暂存的数据并关闭数据库, 可重复调用"""
+        if self.__stopped.is_set():
+            return
+        self.__stopped.set()
+        if self.__thread is not threading.current_thread():
+            self.__thread.join()
+        self.flush()
+        with self.__db_lock:
+            self.__db.close()
+        atexit.unregister(self.close)
+
+    def stats(self) -> dict[str, int]:
+        with self.__lock:
+            return {'pending': len(self.__pending), 'written': len(self.__written), 'promises': len(self.__promises)}
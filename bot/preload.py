@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Filename    :  preload.py
+@Datatime    :  2021/11/26 20:05:12
+@Author      :  Kiyan Yang
+@Contact     :  KiyanYang@outlook.com
+@Version     :  v1.0
+@Description :  多进程模式下由 forkserver 预先导入: 读取配置和语言文本并创建所有 handler, worker 通过写时复制共享
+"""
+from . import handlers
+from .config import CFG, LOCAL, TEXTS
+
+# 本地环境的配置开启热加载, 读取配置会启动 FileWatcher 线程, forkserver 将不再是单线程的,
+# 其他线程持有的锁(如 yaml 解析锁)和重新加载到一半的配置可能被复制到 worker 中. 此时只导入模块,
+# 配置、语言文本和 handler 由各 worker 在 fork 后自行创建
+if not LOCAL:
+    CFG.resolve()
+    TEXTS.resolve()
+    for name in handlers.HANDLER_FACTORIES:
+        handlers.get_handler(name)
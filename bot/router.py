@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Filename    :  router.py
+@Datatime    :  2021/11/21 15:12:40
+@Author      :  Kiyan Yang
+@Contact     :  KiyanYang@outlook.com
+@Version     :  v1.0
+@Description :  路由 handler: 命令和键盘回复通过 dict 查找, 代替逐个检查 handler
+"""
+from typing import Any, Callable, Iterable
+
+from telegram import Message, MessageEntity, Update
+from telegram.ext import CallbackContext, CommandHandler, Dispatcher, Handler
+
+
+def parse_command(message: Message | None) -> tuple[str, list[str]] | None:
+    """解析消息开头的命令, 返回小写的命令名(不含`/`)和参数; 不是命令或命令指向其他 bot 时返回 None"""
+    if message is None or not message.text or not message.entities:
+        return None
+    entity = message.entities[0]
+    if entity.type != MessageEntity.BOT_COMMAND or entity.offset != 0:
+        return None
+    command, _, username = message.text[1:entity.length].partition('@')
+    if username and message.bot is not None and username.lower() != message.bot.username.lower():
+        return None
+    return command.lower(), message.text.split()[1:]
+
+
+class CommandRouter(Handler):
+    """命令路由
+
+    每个 update 只解析一次命令, 再通过 dict 查找对应的 CommandHandler, 查找的开销不随命令数增加.
+    未命中且不在`known`中的命令交给`unknown`处理
+
+    Parameters
+    ----------
+    handlers : Iterable[CommandHandler]
+        路由的 CommandHandler, 命中后检查其 filters 并调用其 callback
+    unknown : Handler | None, optional
+        处理未知命令的 handler, 命中后检查其 filters 并调用其 callback, by default None
+    known : Iterable[str], optional
+        由其他 handler(如 ConversationHandler 的入口)处理的命令, 不视为未知命令, by default ()
+    """
+    def __init__(
+        self,
+        handlers: Iterable[CommandHandler],
+        unknown: Handler | None = None,
+        known: Iterable[str] = (),
+    ) -> None:
+        super().__init__(self.route)
+        self.commands = {}  # command: CommandHandler
+        for handler in handlers:
+            self.add_handler(handler)
+        self.unknown = unknown
+        self.known = frozenset(known)
+
+    def add_handler(self, handler: CommandHandler) -> None:
+        for command in handler.command:
+            self.commands[command.lower()] = handler
+
+    def check_update(self, update: object) -> tuple[Handler, list[str]] | None:
+        if not isinstance(update, Update):
+            return None
+        parsed = parse_command(update.effective_message)
+        if parsed is None:
+            return None
+        command, args = parsed
+        handler = self.commands.get(command)
+        if handler is None:
+            if self.unknown is None or command in self.known:
+                return None
+            handler = self.unknown
+        if not handler.filters(update):
+            return None
+        return handler, args
+
+    def handle_update(
+        self,
+        update: Update,
+        dispatcher: Dispatcher,
+        check_result: tuple[Handler, list[str]],
+        context: CallbackContext = None,
+    ) -> Any:
+        handler, args = check_result
+        context.args = args
+        return handler.callback(update, context)
+
+    def route(self, update: Update, context: CallbackContext) -> Any:
+        """单独调用时的入口, 与 dispatcher 调用的结果一致"""
+        check_result = self.check_update(update)
+        if check_result is not None:
+            return self.handle_update(update, context.dispatcher, check_result, context)
+
+
+class TextRouter(Handler):
+    """文本路由, 用于对话状态中的键盘回复
+
+    以消息全文在 dict 中查找 callback, 代替多个`Filters.regex('^文本$')`的 MessageHandler
+
+    Parameters
+    ----------
+    routes : dict[str, Callable]
+        文本: callback
+    """
+    def __init__(self, routes: dict[str, Callable[[Update, CallbackContext], Any]]) -> None:
+        super().__init__(self.route)
+        self.routes = routes
+
+    def check_update(self, update: object) -> Callable | None:
+        if not isinstance(update, Update) or update.effective_message is None:
+            return None
+        return self.routes.get(update.effective_message.text)
+
+    def handle_update(
+        self,
+        update: Update,
+        dispatcher: Dispatcher,
+        check_result: Callable,
+        context: CallbackContext = None,
+    ) -> Any:
+        return check_result(update, context)
+
+    def route(self, update: Update, context: CallbackContext) -> Any:
+        callback = self.check_update(update)
+        if callback is not None:
+            return callback(update, context)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Filename    :  sharding.py
+@Datatime    :  2021/11/24 21:36:52
+@Author      :  Kiyan Yang
+@Contact     :  KiyanYang@outlook.com
+@Version     :  v1.0
+@Description :  多进程: 按 chat_id 一致性哈希将 update 分配给 worker 进程, 监控并重启 worker
+"""
+import bisect
+import hashlib
+import multiprocessing
+import queue
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.connection import Connection, wait
+from typing import Callable, Sequence
+
+from telegram import Update
+from telegram.ext import CallbackContext, Dispatcher, TypeHandler
+
+from .tools import FILE_WATCHER, get_logger, pending_work
+
+logger = get_logger(__name__)
+
+
+class HashRing:
+    """一致性哈希环, worker 数量变化时只有少量 chat 改变所属的 worker
+
+    Parameters
+    ----------
+    nodes : int
+        节点(worker)数量
+    replicas : int, optional
+        每个节点在环上的虚拟节点数, by default 64
+    """
+    def __init__(self, nodes: int, replicas: int = 64) -> None:
+        points = sorted((self.hash(f'{node}:{i}'), node) for node in range(nodes) for i in range(replicas))
+        self.__hashes = [h for h, _ in points]
+        self.__nodes = [node for _, node in points]
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def get(self, key: int | str) -> int:
+        i = bisect.bisect(self.__hashes, self.hash(str(key))) % len(self.__hashes)
+        return self.__nodes[i]
+
+
+def shard_key(data: dict) -> int:
+    """update 的分片键: chat_id, 没有 chat 时(如 inline_query)使用 user_id, 都没有时使用 update_id"""
+    for key, value in data.items():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat is not None:
+            return chat['id']
+        user = value.get('from') or value.get('user')
+        if user is not None:
+            return user['id']
+    return data['update_id']
+
+
+class ShardSupervisor:
+    """在 ingress 进程中管理 worker 进程
+
+    worker 由 forkserver 进程 fork: forkserver 是单线程的, 在其中预先导入`preload`模块,
+    worker 通过写时复制共享这部分内存; 启动和重启 worker 都不会从多线程的 ingress 进程 fork.
+    每个 worker 在 fork 后调用`setup`建立自己的 bot 和 dispatcher.
+    worker 处理完 update 后回报确认, 并在 dispatcher 正常处理 update 时定时回报健康状态;
+    退出或超时未回报健康状态的 worker 会被重启, 其未确认的 update 重新发送给新的 worker
+
+    Parameters
+    ----------
+    processes : int
+        worker 进程数
+    setup : Callable[[int], Dispatcher]
+        worker 中调用, 参数为 worker 序号, 返回已添加 handler 的 dispatcher(尚未启动);
+        需要能够 pickle, 如模块级函数或其`functools.partial`
+    on_ack : Callable[[int], None] | None, optional
+        update 处理完成后在 ingress 中调用, 参数为 update_id, by default None
+    health_interval : float, optional
+        worker 回报健康状态的间隔(秒), by default 5
+    health_timeout : float, optional
+        超过此时间(秒)未回报健康状态的 worker 会被重启, by default 30
+    preload : Sequence[str], optional
+        forkserver 进程预先导入的模块, by default ()
+    stop_timeout : float, optional
+        重启时等待 worker 响应 SIGTERM 退出的时间(秒), 超时后强制结束, by default 10
+    """
+    def __init__(
+        self,
+        processes: int,
+        setup: Callable[[int], Dispatcher],
+        on_ack: Callable[[int], None] | None = None,
+        health_interval: float = 5,
+        health_timeout: float = 30,
+        preload: Sequence[str] = (),
+        stop_timeout: float = 10,
+    ) -> None:
+        self.processes = processes
+        self.setup = setup
+        self.on_ack = on_ack
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.stop_timeout = stop_timeout
+        self.ring = HashRing(processes)
+        self.__context = multiprocessing.get_context('forkserver')
+        self.__context.set_forkserver_preload(list(preload))
+        # ingress 持有写端, ingress 退出后 worker 从读端读到 EOF
+        self.__alive, self.__alive_writer = self.__context.Pipe(duplex=False)
+        # 每个 worker 一个回报管道, worker 被强制结束时不影响其他 worker 的回报:
+        # ('ack', update_id) | ('health', stats)
+        self.__reports = {}  # Connection: index
+        self.__workers = [None] * processes  # index: (Process, Queue)
+        self.__inflight = [OrderedDict() for _ in range(processes)]  # index: {update_id: data}
+        self.__health = [{} for _ in range(processes)]  # index: 最近一次回报的状态
+        self.__seen = [0.0] * processes  # index: 最近一次回报的时间
+        self.__restarts = [0] * processes
+        self.__lock = threading.Lock()
+
+    def start(self) -> None:
+        for index in range(self.processes):
+            self.__spawn(index)
+        threading.Thread(target=self.__collect, name='ShardSupervisor-collect', daemon=True).start()
+        threading.Thread(target=self.__monitor, name='ShardSupervisor-monitor', daemon=True).start()
+
+    def __spawn(self, index: int) -> None:
+        inbox = self.__context.Queue()
+        reader, writer = self.__context.Pipe(duplex=False)
+        process = self.__context.Process(
+            target=run_worker,
+            args=(index, self.setup, inbox, writer, self.__alive, self.health_interval),
+            name=f'worker-{index}',
+            daemon=True,
+        )
+        process.start()
+        writer.close()  # 只由 worker 持有写端, worker 退出后读端读到 EOF, 由`__collect`关闭
+        with self.__lock:
+            self.__reports[reader] = index
+            self.__workers[index] = (process, inbox)
+            self.__seen[index] = time.monotonic()
+            inflight = list(self.__inflight[index].values())
+        for data in inflight:  # 重新发送上一个 worker 未确认的 update
+            inbox.put(data)
+        logger.info(f'worker {index} 已启动, pid={process.pid}, 重新发送 {len(inflight)} 个 update')
+
+    def put(self, data: dict) -> None:
+        """按 chat_id 将 update 发送给对应的 worker"""
+        index = self.ring.get(shard_key(data))
+        with self.__lock:
+            self.__inflight[index][data['update_id']] = data
+            inbox = self.__workers[index][1]
+        inbox.put(data)
+
+    def __collect(self) -> None:
+        while True:
+            with self.__lock:
+                readers = list(self.__reports)
+            for reader in wait(readers, timeout=1):  # 超时后重新读取管道列表, 加入新 worker 的管道
+                index = self.__reports[reader]
+                try:
+                    kind, value = reader.recv()
+                except (EOFError, OSError):  # worker 已退出
+                    with self.__lock:
+                        del self.__reports[reader]
+                    reader.close()
+                    continue
+                self.__handle(index, kind, value)
+
+    def __handle(self, index: int, kind: str, value) -> None:
+        with self.__lock:
+            if kind == 'ack':
+                self.__inflight[index].pop(value, None)
+            elif kind == 'health':
+                self.__seen[index] = time.monotonic()
+                self.__health[index] = value
+        if kind == 'ack' and self.on_ack is not None:
+            self.on_ack(value)
+
+    def __monitor(self) -> None:
+        while True:
+            time.sleep(self.health_interval)
+            now = time.monotonic()
+            for index in range(self.processes):
+                process, _ = self.__workers[index]
+                if process.is_alive() and now - self.__seen[index] < self.health_timeout:
+                    continue
+                logger.warning(f'worker {index} (pid={process.pid}) 已退出或无响应, exitcode={process.exitcode}, 重启')
+                if process.is_alive():  # 先请求退出, 超时后再强制结束
+                    process.terminate()
+                    process.join(self.stop_timeout)
+                if process.is_alive():
+                    process.kill()
+                process.join(1)
+                self.__restarts[index] += 1
+                self.__spawn(index)
+
+    def stats(self) -> list[dict]:
+        with self.__lock:
+            return [
+                {
+                    'pid': self.__workers[i][0].pid,
+                    'alive': self.__workers[i][0].is_alive(),
+                    'inflight': len(self.__inflight[i]),
+                    'restarts': self.__restarts[i],
+                    'last_report': round(time.monotonic() - self.__seen[i], 1),
+                    **self.__health[i],
+                }
+                for i in range(self.processes)
+            ]
+
+
+def run_worker(
+    index: int,
+    setup: Callable[[int], Dispatcher],
+    inbox: multiprocessing.Queue,
+    reports: Connection,
+    alive: Connection,
+    health_interval: float,
+) -> None:
+    """worker 进程: 从 inbox 读取 update 交给自己的 dispatcher, 处理完后回报确认"""
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # 由 ingress 负责停止
+    FILE_WATCHER.after_fork()  # 配置文件的热更新
+    dispatcher = setup(index)
+    report_lock = threading.Lock()  # 确认和健康状态从不同线程回报
+    handled = [0]  # 已确认的 update 数
+    started = [0]  # dispatcher 开始处理的 update 数
+
+    def count(update: Update, context: CallbackContext) -> None:
+        started[0] += 1
+
+    def ack(update: Update, context: CallbackContext) -> None:
+        def report() -> None:
+            with report_lock:
+                handled[0] += 1
+                reports.send(('ack', update.update_id))
+
+        pending_work(context).when_done(report)  # 等待 run_in_pool 等后台工作结束
+
+    def report_health() -> None:
+        # dispatcher 线程退出, 或有等待处理的 update 而一个周期内没有开始处理新的 update 时停止回报,
+        # 由 ingress 在`health_timeout`后重启 worker
+        last = None
+        while True:
+            queued = dispatcher.update_queue.qsize()
+            if dispatcher_thread.is_alive() and (queued == 0 or started[0] != last):
+                with report_lock:
+                    reports.send(('health', {'handled': handled[0], 'queued': queued}))
+            last = started[0]
+            time.sleep(health_interval)
+
+    dispatcher.add_handler(TypeHandler(Update, count), group=-100)
+    dispatcher.add_handler(TypeHandler(Update, ack), group=100)
+    dispatcher_thread = threading.Thread(target=dispatcher.start, name=f'dispatcher-{index}', daemon=True)
+    dispatcher_thread.start()
+    threading.Thread(target=report_health, name=f'health-{index}', daemon=True).start()
+    try:
+        while True:
+            try:
+                data = inbox.get(timeout=1)
+            except queue.Empty:
+                if alive.poll():  # ingress 已退出
+                    break
+                continue
+            dispatcher.update_queue.put(Update.de_json(data, dispatcher.bot))
+    finally:
+        dispatcher.stop()
+        if dispatcher.job_queue is not None:
+            dispatcher.job_queue.stop()
+        if dispatcher.persistence is not None:
+            dispatcher.persistence.close()
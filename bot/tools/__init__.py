@@ -1,17 +1,50 @@
-from .config import ConfigManager, Configs
-from .fund import Fund
-from .github import GitHubAPIv4
-from .other import FileWatchDog, datetime_now, get_logger
-from .text import MarkdownV2, MessageText
+from .config import ConfigManager, Configs, freeze, load_snapshot, yaml_load_plain
+from .fund import Fund, FundQuotes
+from .github import CommitQueue, GitHubAPIv4, RateBudget
+from .httpclient import HTTP, HTTPClient
+from .other import (
+    FILE_WATCHER,
+    ChatExecutor,
+    FileWatchDog,
+    FileWatcher,
+    LazyObject,
+    LRUCache,
+    PendingWork,
+    data_path,
+    datetime_now,
+    get_logger,
+    is_ephemeral,
+    pending_work,
+)
+from .text import MarkdownV2, MessageChunker, MessageText, TextTable
 
 __all__ = (
     Configs,
     ConfigManager,
+    freeze,
+    load_snapshot,
+    yaml_load_plain,
     Fund,
+    FundQuotes,
+    CommitQueue,
     GitHubAPIv4,
+    RateBudget,
+    HTTP,
+    HTTPClient,
+    FILE_WATCHER,
+    ChatExecutor,
     FileWatchDog,
+    FileWatcher,
+    LazyObject,
+    LRUCache,
+    PendingWork,
+    data_path,
     datetime_now,
     get_logger,
+    is_ephemeral,
+    pending_work,
     MarkdownV2,
+    MessageChunker,
     MessageText,
+    TextTable,
 )
@@ -8,10 +8,17 @@
 @Version     :  v1.1
 @Description :  配置文件热加载
 """
+import hashlib
+import os
+import pickle
+import sys
+import threading
 from io import StringIO
 from pathlib import Path
-from typing import Any, Callable, Hashable
+from types import MappingProxyType
+from typing import Any, Callable, Hashable, Iterable
 
+import ruamel.yaml
 from ruamel.yaml import YAML
 
 from .other import FileWatchDog, get_logger
@@ -61,16 +68,91 @@ class ConfigManager:
         return self.__yaml_dumps(self.__yaml.dump_all, data, path)
 
 
+# 只读场景使用 safe 加载器, 得到普通的 dict/list, 比保留注释和格式的 round-trip 加载器更快
+_safe_yaml = YAML(typ='safe')
+_safe_yaml_lock = threading.Lock()
+
+
+def yaml_load_plain(path: str = None, text: str = None) -> Any:
+    """以 safe 加载器读取 YAML, 返回普通的 dict/list, 用于不需要写回的数据"""
+    if path is not None:
+        text = Path(path).read_text(encoding='UTF-8')
+    elif text is None:
+        raise TypeError("需要 'path' 或 'text' 参数")
+    with _safe_yaml_lock:
+        return _safe_yaml.load(text)
+
+
+def freeze(data: Any) -> Any:
+    """将 dict/list 递归转换为只读的 MappingProxyType/tuple"""
+    if isinstance(data, dict):
+        return MappingProxyType({k: freeze(v) for k, v in data.items()})
+    if isinstance(data, (list, tuple)):
+        return tuple(freeze(x) for x in data)
+    return data
+
+
+# 快照格式版本, 修改`yaml_load_plain`或快照内容的格式后加 1, 使旧快照失效
+SNAPSHOT_VERSION = 1
+
+
+def load_snapshot(path: str, cache_dir: str | None = None) -> Any:
+    """读取 YAML 配置文件的编译快照
+
+    快照以文件内容、`SNAPSHOT_VERSION`、Python 和 ruamel.yaml 版本的哈希值命名并保存在`cache_dir`中,
+    它们都未变化时直接读取快照, 否则解析 YAML 后写入新快照并删除此文件的旧快照
+
+    Parameters
+    ----------
+    path : str
+        YAML 文件路径
+    cache_dir : str, optional
+        快照目录, 为 None 时使用文件所在目录下的`.cache`, by default None
+
+    Returns
+    -------
+    Any
+        解析后的普通 dict/list 数据
+    """
+    raw = Path(path).read_bytes()
+    cache_dir = Path(cache_dir or Path(path).parent / '.cache')
+    prefix = f'{Path(path).name}.'
+    key = hashlib.sha1(f'{SNAPSHOT_VERSION}:{sys.version_info}:{ruamel.yaml.__version__}:'.encode())
+    key.update(raw)
+    snapshot = cache_dir / f'{prefix}{key.hexdigest()}.pickle'
+    try:
+        with snapshot.open('rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+    data = yaml_load_plain(text=raw.decode('UTF-8'))
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = snapshot.with_suffix(f'.{os.getpid()}.tmp')
+        with tmp.open('wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, snapshot)
+        for old in cache_dir.glob(f'{prefix}*.pickle'):
+            if old != snapshot:
+                old.unlink(missing_ok=True)
+    except OSError as e:
+        logger.warning(f'{path} 快照写入失败: {e}')
+    return data
+
+
 class _BaseConfig:
     __values = {}
     __counts = {}
+    __subscribers = {}
 
     def __init__(self, name: str, key: Hashable, path: str, hot: bool = True) -> None:
         if name not in self.__values.keys():  # 当前变量的名称不在名称库
             _BaseConfig.__values[name] = {}  # 初始化
             _BaseConfig.__counts[name] = {}  # 初始化
+            _BaseConfig.__subscribers[name] = {}  # 初始化
         if key not in self.__counts[name].keys():
             _BaseConfig.__counts[name][key] = 0
+            _BaseConfig.__subscribers[name][key] = []
         self.name = name  # 记录当前变量的名称
         self.key = key  # 记录当前变量的 key
         self.path = path  # 记录当前变量的 path
@@ -79,32 +161,86 @@ class _BaseConfig:
         if hot:
             FileWatchDog(self.path, {'modified': self.__get_config})
 
+    @staticmethod
+    def diff(old: Any, new: Any) -> set:
+        """比较新旧配置, 返回发生变化的一级键"""
+        if not (hasattr(old, 'keys') and hasattr(new, 'keys')):
+            return set() if old == new else {None}
+        return {k for k in old.keys() | new.keys() if old.get(k) != new.get(k)}
+
     def __get_config(self) -> None:
-        config_load = ConfigManager().yaml_load(path=self.path)  # 读取配置文件, 可更改格式
+        config_load = freeze(load_snapshot(self.path))  # 读取配置文件快照, 以只读的普通 dict 提供
+        # 新快照构建完成后整体替换旧快照, 读取时无需加锁
+        config_old = self.__values[self.name].get(self.key)
         _BaseConfig.__values[self.name][self.key] = config_load
         if self.__counts[self.name][self.key] > 0:
             count = self.__counts[self.name][self.key]
-            logger.info(f'{self.path} 重新加载完毕：第{count}次重新加载')
+            changed = self.diff(config_old, config_load)
+            logger.info(f'{self.path} 重新加载完毕：第{count}次重新加载, 变化的配置: {sorted(map(str, changed))}')
         else:
+            changed = set()
             logger.info(f'{self.path} 首次加载完毕')
         _BaseConfig.__counts[self.name][self.key] += 1
+        # 只通知依赖已变化配置的对象重新构建
+        for sections, func in self.__subscribers[self.name][self.key]:
+            if not changed or (sections is not None and sections.isdisjoint(changed)):
+                continue
+            try:
+                func()
+            except Exception:
+                logger.exception(f'{self.path} 重新加载后回调 {func} 执行失败')
 
     # TODO @property 使用此装饰器进行访问更改
     @classmethod  # 使用类方法可以直接外部访问
     def get(cls, name: str) -> dict:
         return cls.__values[name]
 
+    @classmethod
+    def subscribe(
+        cls,
+        name: str,
+        key: Hashable,
+        func: Callable[[], Any],
+        sections: Iterable[Hashable] | None = None,
+    ) -> None:
+        sections = None if sections is None else frozenset(sections)
+        cls.__subscribers[name][key].append((sections, func))
+
 
 class Configs:
+    """配置集合, `Configs[key]`为配置文件`key`当前的只读快照
+
+    热加载时构建新快照后整体替换, 同一次`Configs[key]`得到的快照不会被修改,
+    需要多次读取且前后一致时, 先保存`Configs[key]`再读取
+    """
     def __init__(self, key_path: dict[Hashable, str], hot: bool = False) -> None:
-        __id = str(id(self))
+        self.__id = str(id(self))
         for key, path in key_path.items():
-            _BaseConfig(__id, key, path, hot)
-        self.__item = _BaseConfig.get(__id)
+            _BaseConfig(self.__id, key, path, hot)
+        self.__item = _BaseConfig.get(self.__id)
 
     def __getitem__(self, key):
         return self.__item[key]
 
+    def subscribe(
+        self,
+        key: Hashable,
+        func: Callable[[], Any],
+        sections: Iterable[Hashable] | None = None,
+    ) -> None:
+        """注册配置`key`重新加载后的回调函数, 用于重建依赖此配置的对象
+
+        Parameters
+        ----------
+        key : Hashable
+            配置文件的 key
+        func : Callable[[], Any]
+            回调函数
+        sections : Iterable[Hashable] | None, optional
+            依赖的一级键, 只有这些键的内容变化时才调用`func`; 为 None 时任何变化都调用, by default None
+        """
+        _BaseConfig.subscribe(self.__id, key, func, sections)
+
 
 if __name__ == '__main__':
     pass
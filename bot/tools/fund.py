@@ -9,8 +9,17 @@
 @Description :  基金相关工具
 """
 import json
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from typing import Any
 
-import requests
+from .httpclient import HTTP
+from .other import LRUCache, datetime_now, get_logger
+
+logger = get_logger(__name__)
 
 
 class Fund:
@@ -38,7 +47,7 @@ class Fund:
             基金信息
         """
         url = 'https://fund.eastmoney.com/Data/FundCompare_Interface.aspx?bzdm='
-        url_json = requests.get(url + str(code))
+        url_json = HTTP.get(url + str(code))
         url_text = url_json.text[17:-3]
         url_list = url_text.split(',')
         fund_info = url_list[0:2] + url_list[4:12]
@@ -68,7 +77,7 @@ class Fund:
             基金信息
         """
         url = f'http://fundgz.1234567.com.cn/js/{code}.js'
-        result = requests.get(url)
+        result = HTTP.get(url)
         fund_info_dict = json.loads(result.text[8:-2])
         fund_info_keys = ['fundcode', 'name', 'jzrq', 'dwjz', 'gsz', 'gszzl', 'gztime']
         fund_info = []
@@ -77,6 +86,127 @@ class Fund:
         fund_info[5] += '%'
         return fund_info
 
+    # 批量获取基金信息时的默认最大并发数
+    MAX_WORKERS = 8
+
+    @classmethod
+    def get_fund_info_batch(cls, codes: list[str], source: int = 1, max_workers: int | None = None):
+        """批量并发获取基金信息, 单个基金获取失败不影响其他基金
+
+        Parameters
+        ----------
+        codes : list[str]
+            基金代码列表
+        source : int, optional
+            数据源, 0 为`get_fund_info_hedged`, 1 为`get_fund_info_1`, 2 为`get_fund_info_2`, by default 1
+        max_workers : int, optional
+            最大并发数, 为 None 时使用`MAX_WORKERS`, by default None
+
+        Returns
+        -------
+        list[tuple[str, list | None, Exception | None]]
+            与`codes`顺序一致的`(基金代码, 基金信息, 错误)`, 获取成功时错误为 None, 失败时基金信息为 None
+        """
+        get_fund_info = {0: cls.get_fund_info_hedged, 1: cls.get_fund_info_1, 2: cls.get_fund_info_2}[source]
+
+        def fetch(code: str):
+            try:
+                return code, get_fund_info(code), None
+            except Exception as e:
+                return code, None, e
+
+        if not codes:
+            return []
+        max_workers = min(max_workers or cls.MAX_WORKERS, len(codes))
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fund') as executor:
+            return list(executor.map(fetch, codes))
+
+    # 对冲查询 =================================================================
+    # 两个数据源统一后的基金信息表头
+    FUNDINFO_HEADER_HEDGED = ['基金代码', '基金名称', '盘中估值', '估值涨幅', '最新净值', '净值日期', '估值时间']
+    # 各数据源结果在统一表头中对应的位置
+    _HEDGED_INDEX = {1: (0, 1, 2, 3, 4, 5, 9), 2: (0, 1, 4, 5, 3, 2, 6)}
+    # 首选数据源超过此时间(秒)未返回时, 同时查询另一数据源
+    HEDGE_DELAY = 0.5
+    # 数据源响应时间的指数移动平均(秒), 用于选择首选数据源; 失败时额外计入惩罚时间
+    LATENCY = {1: None, 2: None}
+    LATENCY_ALPHA = 0.2
+    FAILURE_PENALTY = 5.0
+    _hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='fund-hedge')
+    _latency_lock = threading.Lock()  # 对冲查询的多个线程同时更新`LATENCY`
+
+    @classmethod
+    def preferred_source(cls) -> int:
+        """当前平均响应时间最短的数据源, 尚无记录的数据源优先, 以便得到其响应时间"""
+        with cls._latency_lock:
+            return min(cls.LATENCY, key=lambda x: cls.LATENCY[x] or 0)
+
+    @classmethod
+    def _record_latency(cls, source: int, seconds: float) -> None:
+        with cls._latency_lock:
+            last = cls.LATENCY[source]
+            cls.LATENCY[source] = seconds if last is None else last + cls.LATENCY_ALPHA * (seconds - last)
+
+    @classmethod
+    def _get_fund_info_timed(cls, source: int, code: str) -> list:
+        start = time.monotonic()
+        try:
+            fund_info = cls.get_fund_info_1(code) if source == 1 else cls.get_fund_info_2(code)
+            fund_info = [fund_info[i] for i in cls._HEDGED_INDEX[source]]
+            if fund_info[0] != str(code) or not fund_info[1]:
+                raise ValueError(f'数据源 {source} 返回无效的基金信息: {fund_info}')
+        except Exception:
+            cls._record_latency(source, time.monotonic() - start + cls.FAILURE_PENALTY)
+            raise
+        cls._record_latency(source, time.monotonic() - start)
+        return fund_info
+
+    @classmethod
+    def get_fund_info_hedged(cls, code: str, delay: float | None = None) -> list:
+        """对冲查询基金信息
+
+        先查询首选数据源, 超过`delay`秒未返回或查询失败时, 同时查询另一数据源, 返回最先得到的有效结果
+
+        ['基金代码', '基金名称', '盘中估值', '估值涨幅', '最新净值', '净值日期', '估值时间']
+
+        Parameters
+        ----------
+        code : str
+            基金代码
+        delay : float, optional
+            启动第二个数据源前的等待时间(秒), 为 None 时使用`HEDGE_DELAY`, by default None
+
+        Returns
+        -------
+        list
+            基金信息
+
+        Raises
+        ------
+        Exception
+            两个数据源均查询失败时, 抛出首选数据源的错误
+        """
+        delay = cls.HEDGE_DELAY if delay is None else delay
+        first = cls.preferred_source()
+        second = 2 if first == 1 else 1
+        sources = {cls._hedge_executor.submit(cls._get_fund_info_timed, first, code): first}  # future: 数据源
+        done, pending = wait(set(sources), timeout=delay)
+        hedged = False
+        errors = {}  # 数据源: 错误
+        while True:
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                errors[sources[future]] = future.exception()
+            if not hedged:
+                hedged = True
+                future = cls._hedge_executor.submit(cls._get_fund_info_timed, second, code)
+                sources[future] = second
+                pending.add(future)
+            if not pending:
+                raise errors[first]
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
     # 今日操作，以2维list返回[[基金代码,今日操作,估值涨幅],]
     @classmethod
     def get_fund_working(cls, code_jz_fe_w):
@@ -88,5 +218,189 @@ class Fund:
         ...
 
 
+class FundQuotes:
+    """基金行情缓存
+
+    交易时间内由`refresh`定时刷新关注的基金(持仓基金和最近查询的基金), 查询时直接读取内存;
+    非交易时间返回收盘后获取的行情, 不再请求网络; 收盘时获取的是盘中估值, 在`NAV_TIME`公布净值后过期,
+    之后的查询重新获取一次. 行情格式同`Fund.get_fund_info_hedged`
+
+    Parameters
+    ----------
+    interval : float, optional
+        交易时间内的刷新间隔(秒), 行情超过 2 倍间隔未刷新时视为过期, by default 60
+    recent_size : int, optional
+        记录最近查询基金的最大数量, by default 64
+    recent_ttl : float, optional
+        最近查询的基金保持关注的时间(秒), by default 3 * 3600
+    """
+    # 交易时间(UTC+8), 周一至周五
+    TRADING_HOURS = (((9, 30), (11, 30)), ((13, 0), (15, 0)))
+    # 交易日公布当日净值的时间(UTC+8), 多数基金在此之前公布, 之前获取的收盘估值视为过期
+    NAV_TIME = (21, 0)
+
+    def __init__(self, interval: float = 60, recent_size: int = 64, recent_ttl: float = 3 * 3600) -> None:
+        self.interval = interval
+        self.recent = LRUCache(recent_size, recent_ttl)
+        self.holdings = frozenset()
+        self.__quotes = {}  # code: (获取时间, 基金信息)
+        self.__lock = threading.Lock()
+        self.__counts = {'hits': 0, 'misses': 0}
+        self.__refresh = {'time': None, 'lag': None, 'codes': 0, 'errors': 0}
+
+    @classmethod
+    def is_trading_time(cls, dt: datetime | None = None) -> bool:
+        dt = dt or datetime_now()
+        if dt.weekday() >= 5:
+            return False
+        hm = (dt.hour, dt.minute)
+        return any(start <= hm < end for start, end in cls.TRADING_HOURS)
+
+    @classmethod
+    def last_close(cls, dt: datetime | None = None) -> datetime:
+        """`dt`之前最近一次行情变化(午间休市、收盘或公布净值)的时间"""
+        dt = dt or datetime_now()
+        times = [end for _, end in cls.TRADING_HOURS] + [cls.NAV_TIME]
+        for days in range(8):
+            day = dt - timedelta(days=days)
+            if day.weekday() >= 5:
+                continue
+            for hour, minute in sorted(times, reverse=True):
+                close = day.replace(hour=hour, minute=minute, second=0, microsecond=0)
+                if close <= dt:
+                    return close
+
+    def is_fresh(self, fetched: datetime, now: datetime) -> bool:
+        """交易时间内不超过 2 倍刷新间隔, 非交易时间在最近一次休市或公布净值之后获取"""
+        if self.is_trading_time(now):
+            return (now - fetched).total_seconds() < 2 * self.interval
+        return fetched >= self.last_close(now)
+
+    def set_holdings(self, data: Any) -> None:
+        """从持仓文件数据中找出全部 6 位基金代码(键或值), 作为持仓基金"""
+        codes = set()
+
+        def walk(node):
+            if isinstance(node, dict):
+                for k, v in node.items():
+                    walk(k)
+                    walk(v)
+            elif isinstance(node, (list, tuple)):
+                for v in node:
+                    walk(v)
+            elif re.fullmatch(r'\d{6}', str(node)):
+                codes.add(str(node))
+
+        walk(data)
+        self.holdings = frozenset(codes)
+
+    def watched(self) -> list[str]:
+        return sorted(self.holdings | set(self.recent.keys()))
+
+    def __store(self, code: str, fund_info: list, fetched: datetime) -> None:
+        with self.__lock:
+            self.__quotes[code] = (fetched, fund_info)
+
+    def get(self, code: str) -> list:
+        """获取基金行情, 缓存有效时不请求网络, 并将此基金加入最近查询
+
+        Parameters
+        ----------
+        code : str
+            基金代码
+
+        Returns
+        -------
+        list
+            基金信息
+        """
+        code = str(code)
+        self.recent.set(code, True)
+        now = datetime_now()
+        quote = self.__quotes.get(code)
+        hit = quote is not None and self.is_fresh(quote[0], now)
+        with self.__lock:
+            self.__counts['hits' if hit else 'misses'] += 1
+        if hit:
+            return quote[1]
+        fund_info = Fund.get_fund_info_hedged(code)
+        self.__store(code, fund_info, now)
+        return fund_info
+
+    def get_many(self, codes: list[str]) -> list[tuple[str, list | None, Exception | None]]:
+        """批量获取基金行情, 返回格式同`Fund.get_fund_info_batch`"""
+        fetched = {}  # code: 本次批量获取的基金信息
+
+        def get(code: str):
+            if str(code) in fetched:
+                self.recent.set(str(code), True)
+                return code, fetched[str(code)], None
+            try:
+                return code, self.get(code), None
+            except Exception as e:
+                return code, None, e
+
+        now = datetime_now()
+        quotes = self.__quotes
+        stale = list(dict.fromkeys(
+            str(x) for x in codes if str(x) not in quotes or not self.is_fresh(quotes[str(x)][0], now)
+        ))
+        if len(stale) > 1:  # 多个缓存缺失或过期时先并发获取, 失败的再由`get`逐个获取
+            for code, fund_info, error in Fund.get_fund_info_batch(stale, source=0):
+                if error is None:
+                    self.__store(code, fund_info, now)
+                    fetched[code] = fund_info
+            with self.__lock:
+                self.__counts['misses'] += len(fetched)
+        return [get(x) for x in codes]
+
+    def refresh(self, force: bool = False) -> None:
+        """刷新关注的基金的行情, 非交易时间只刷新收盘后尚未获取的行情"""
+        start = time.monotonic()
+        now = datetime_now()
+        codes = self.watched()
+        if not (force or self.is_trading_time(now)):
+            quotes = self.__quotes
+            codes = [x for x in codes if x not in quotes or not self.is_fresh(quotes[x][0], now)]
+        errors = 0
+        for code, fund_info, error in Fund.get_fund_info_batch(codes, source=0):
+            if error is None:
+                self.__store(code, fund_info, now)
+            else:
+                errors += 1
+                logger.warning(f'基金 {code} 行情刷新失败: {error!r}')
+        self.__refresh = {'time': now, 'lag': time.monotonic() - start, 'codes': len(codes), 'errors': errors}
+
+    def stats(self) -> dict:
+        """缓存统计
+
+        Returns
+        -------
+        dict
+            `hits` `misses` `hit_rate` 查询的命中数、未命中数、命中率
+
+            `refresh_time` `refresh_lag` `refresh_codes` `refresh_errors` 最近一次刷新的时间、耗时、基金数、失败数
+
+            `max_age` 缓存中最旧行情的时长(秒)
+
+            `watched` 关注的基金数
+        """
+        hits, misses = self.__counts['hits'], self.__counts['misses']
+        now = datetime_now()
+        ages = [(now - fetched).total_seconds() for fetched, _ in list(self.__quotes.values())]
+        refresh = self.__refresh
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else None,
+            'refresh_time': refresh['time'],
+            'refresh_lag': refresh['lag'],
+            'refresh_codes': refresh['codes'],
+            'refresh_errors': refresh['errors'],
+            'max_age': max(ages, default=None),
+            'watched': len(self.watched()),
+        }
+
+
 if __name__ == '__main__':
     pass
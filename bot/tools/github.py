@@ -6,23 +6,115 @@
 @Author      :  Kiyan Yang
 @Contact     :  KiyanYang@outlook.com
 @Version     :  v1.0
-@Description :  github API v4
+@Description :  github API v4, 提交队列
 """
+import atexit
 import base64
 import json
-
-import requests
-
-from .config import ConfigManager
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+
+from .config import yaml_load_plain
+from .httpclient import HTTP
+from .other import get_logger
+
+logger = get_logger(__name__)
+
+
+class RateBudget:
+    """GitHub GraphQL 速率限制预算
+
+    由每次查询返回的`rateLimit { cost remaining resetAt }`更新剩余点数,
+    剩余点数低于`reserve`时, 低优先级的调用等待到`resetAt`后再发送, 剩余点数留给高优先级的调用.
+    设置了`max_wait`时, 等待超过`max_wait`秒的调用放弃发送并抛出`TimeoutError`
+
+    Parameters
+    ----------
+    reserve : int, optional
+        为高优先级调用保留的点数, by default 500
+    max_wait : float | None, optional
+        低优先级调用的最长等待时间(秒), 为 None 时等待到重置时间, by default None
+    """
+    HIGH = 0  # 面向用户的读取
+    LOW = 1  # 后台写入等
+
+    def __init__(self, reserve: int = 500, max_wait: float | None = None) -> None:
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.remaining = None  # 未知时不限制
+        self.reset_at = None  # UTC 时间戳(秒)
+        self.__condition = threading.Condition()
+        self.__counts = {'calls': 0, 'cost': 0, 'waits': 0}
+
+    def acquire(self, priority: int = HIGH, cost: int = 1) -> None:
+        """发送调用前获取预算, 低优先级调用在预算不足时阻塞到重置时间或`max_wait`秒后超时"""
+        start = time.monotonic()
+        with self.__condition:
+            while (
+                priority != self.HIGH
+                and self.remaining is not None
+                and self.remaining - cost < self.reserve
+                and self.reset_at is not None
+                and self.reset_at > time.time()
+            ):
+                timeout = self.reset_at - time.time() + 1
+                if self.max_wait is not None:
+                    left = self.max_wait - (time.monotonic() - start)
+                    if left <= 0:
+                        raise TimeoutError(
+                            f'GitHub API 剩余 {self.remaining} 点, 低优先级调用等待超过 {self.max_wait} 秒, 放弃发送'
+                        )
+                    timeout = min(timeout, left)
+                self.__counts['waits'] += 1
+                logger.warning(f'GitHub API 剩余 {self.remaining} 点, 低优先级调用等待至 {datetime.fromtimestamp(self.reset_at)}')
+                self.__condition.wait(timeout)
+                if self.reset_at is not None and self.reset_at <= time.time():
+                    self.remaining = None  # 已重置, 下一次调用后更新
+            if self.remaining is not None:
+                self.remaining -= cost  # 预扣, 收到响应后以实际值更新
+            self.__counts['calls'] += 1
+
+    def limit_wait(self, max_wait: float | None) -> None:
+        """修改`max_wait`, 正在等待的调用按新的值重新计算等待时间"""
+        with self.__condition:
+            self.max_wait = max_wait
+            self.__condition.notify_all()
+
+    def update(self, rate_limit: dict) -> None:
+        """以响应中的`rateLimit`更新预算"""
+        reset_at = datetime.fromisoformat(rate_limit['resetAt'].replace('Z', '+00:00')).timestamp()
+        with self.__condition:
+            self.remaining = rate_limit['remaining']
+            self.reset_at = reset_at
+            self.__counts['cost'] += rate_limit.get('cost', 0)
+            self.__condition.notify_all()
+
+    def stats(self) -> dict:
+        with self.__condition:
+            return self.__counts | {'remaining': self.remaining, 'reset_at': self.reset_at}
 
 
 class GitHubAPIv4:
-    def __init__(self, token: str, proxy: str | None = None) -> None:
+    # query 中以此别名查询速率限制时, `query`从响应中取出此字段并更新`budget`
+    RATE_LIMIT_FIELD = '_rate_limit: rateLimit { cost remaining resetAt }'
+    DEFAULT_TEXT_SIZE = 16 * 1024  # `get_texts`估计未获取过的文件的大小(字节)
+    TEXT_CACHE_TTL = 60  # `get_text`的缓存在此时间(秒)内直接返回, 不查询 oid
+
+    def __init__(self, token: str, proxy: str | None = None, commit_window: float = 2.0) -> None:
         self.token = token
         self.headers = {'Authorization': f'token {token}'}
         self.base_url = 'https://api.github.com/graphql'
         self.proxy = proxy
         self.proxies = {'http': proxy, 'https': proxy}
+        self.head_oids = {}  # (owner, name, branch): 分支 head oid 缓存, 提交队列的定时器线程也会读写, 由`head_lock`保护
+        self.head_lock = threading.Lock()
+        self.commit_queue = CommitQueue(self, commit_window)
+        self.raw_cache = {}  # url: {'etag', 'res', 'parsed': {type: 解析后的数据}}
+        self.text_cache = {}  # (owner, name, expression): get_text 的结果, 以 oid 判断是否更新
+        self.text_checked = {}  # (owner, name, expression): 缓存最近一次获取或确认 oid 未变化的时间(monotonic)
+        self.budget = RateBudget()
 
     # 对文件进行base64编码，例如图片文件
     def _file_b64(self, data):
@@ -34,17 +126,20 @@ class GitHubAPIv4:
         text_b64 = base64.b64encode(text.encode('UTF-8')).decode('UTF-8')
         return text_b64
 
+    # 请求均通过共享的 HTTP 客户端发送, 未单独设置代理时使用客户端的代理
     def _get(self, *args, **kwargs):
+        headers = self.headers | kwargs.pop('headers', {})
         if self.proxy is None:
-            return requests.get(*args, **kwargs, headers=self.headers)
+            return HTTP.get(*args, **kwargs, headers=headers)
         else:
-            return requests.get(*args, **kwargs, headers=self.headers, proxies=self.proxies)
+            return HTTP.get(*args, **kwargs, headers=headers, proxies=self.proxies)
 
     def _post(self, *args, **kwargs):
+        headers = self.headers | kwargs.pop('headers', {})
         if self.proxy is None:
-            return requests.post(*args, **kwargs, headers=self.headers)
+            return HTTP.post(*args, **kwargs, headers=headers)
         else:
-            return requests.post(*args, **kwargs, headers=self.headers, proxies=self.proxies)
+            return HTTP.post(*args, **kwargs, headers=headers, proxies=self.proxies)
 
     # 将 dict 数据转换为格式化的 json 数据
     @staticmethod
@@ -54,6 +149,9 @@ class GitHubAPIv4:
     def get_raw(self, url: str, type: str | None = None):
         """获取数据
 
+        text | json | yaml 类型的结果按 ETag 缓存, 再次获取时发送条件请求, 文件未更新时直接返回
+        缓存中解析后的数据, 因此不要原地修改返回的数据
+
         Parameters
         ----------
         url : str
@@ -71,21 +169,40 @@ class GitHubAPIv4:
         Response
             其他类型返回 Response, 即 requests 的响应类型
         """
-        res = self._get(url)
-        match type:
-            case 'text':
-                return res.text
-            case 'json':
-                return res.json()
-            case 'yaml':
-                return ConfigManager().yaml_load(text=res.text)
-            case _:
-                return res
-
-    def query(self, query: str, operation_name: str | None = None, variables: dict | None = None):
+        if type not in ('text', 'json', 'yaml'):
+            return self._get(url)
+        cache = self.raw_cache.get(url)
+        headers = {'If-None-Match': cache['etag']} if cache else {}
+        res = self._get(url, headers=headers)
+        if cache is None or res.status_code != 304:
+            etag = res.headers.get('ETag')
+            cache = {'etag': etag, 'res': res, 'parsed': {}}
+            if etag is not None and res.ok:
+                self.raw_cache[url] = cache
+        parsed = cache['parsed']
+        if type not in parsed:
+            res = cache['res']
+            match type:
+                case 'text':
+                    parsed[type] = res.text
+                case 'json':
+                    parsed[type] = res.json()
+                case 'yaml':
+                    parsed[type] = yaml_load_plain(text=res.text)
+        return parsed[type]
+
+    def query(
+        self,
+        query: str,
+        operation_name: str | None = None,
+        variables: dict | None = None,
+        priority: int = RateBudget.HIGH,
+    ):
         """query
 
-        [extended_summary]
+        query 中包含`RATE_LIMIT_FIELD`(别名`_rate_limit`)时以响应中的此字段更新速率限制预算,
+        返回数据中不包含此字段. 低优先级调用在预算不足时等待到速率限制重置,
+        预算未知时(如只发送过 mutation)先发送一次只查询速率限制的 query
 
         Parameters
         ----------
@@ -95,6 +212,8 @@ class GitHubAPIv4:
             要执行的操作名称, 仅当查询中存在多个操作时才需要 operation_ame, by default None
         variables : dict, optional
             变量, by default None
+        priority : int, optional
+            优先级, `RateBudget.HIGH`或`RateBudget.LOW`, by default RateBudget.HIGH
 
         Returns
         -------
@@ -107,20 +226,39 @@ class GitHubAPIv4:
         Exception
             返回错误代码
         """
+        # query 可以重试, mutation 不能
+        idempotent = not query.lstrip().startswith('mutation')
+        if priority != RateBudget.HIGH and self.budget.remaining is None:
+            self.refresh_budget()
         payload = {'query': query}
         if operation_name is not None:
             payload |= {'operationName': operation_name}
         if variables is not None:
             payload |= {'variables': variables}
-        res = self._post(self.base_url, json=payload)
+        self.budget.acquire(priority)
+        res = self._post(self.base_url, json=payload, idempotent=idempotent)
         if res.status_code == 200:
-            return res.json()
+            res = res.json()
+            rate_limit = (res.get('data') or {}).pop('_rate_limit', None)
+            if rate_limit is not None:
+                self.budget.update(rate_limit)
+            return res
         else:
             raise Exception(f'Query failed. Returning code: {res.status_code}. {query}')
 
+    def refresh_budget(self) -> None:
+        """只查询速率限制以更新`budget`, 查询失败时保持未知"""
+        try:
+            self.query(f'query GetBudget {{ {self.RATE_LIMIT_FIELD} }}')
+        except Exception as e:
+            logger.warning(f'GitHub API 速率限制查询失败: {e!r}')
+
     def get_text(self, owner: str, name: str, expression: str):
         """获取文本文件大小和内容
 
+        结果按 oid 缓存, `TEXT_CACHE_TTL`秒内再次获取时直接返回缓存, 不发送请求;
+        超过后先查询文件的 oid, oid 未变化时返回缓存. 通过`add_files`修改文件后缓存失效
+
         Parameters
         ----------
         owner : str
@@ -133,7 +271,7 @@ class GitHubAPIv4:
         Returns
         -------
         dict
-            文本文件的大小`byteSize`和内容`text`
+            文本文件的大小`byteSize`、内容`text`和`oid`
 
         Raises
         ------
@@ -149,18 +287,122 @@ class GitHubAPIv4:
                   ... on Blob {
                     byteSize
                     text
+                    oid
                   }
                 }
               }
+              _rate_limit: rateLimit { cost remaining resetAt }
             }'''
+        key = (owner, name, expression)
+        cache = self.text_cache.get(key)
+        if cache is not None:
+            if time.monotonic() - self.text_checked.get(key, float('-inf')) < self.TEXT_CACHE_TTL:
+                return cache
+            if self.get_oid(owner, name, expression) == cache['oid']:
+                self.text_checked[key] = time.monotonic()
+                return cache
         vars = {'owner': owner, 'name': name, 'expression': expression}
         res = self.query(query_get_text, variables=vars)
         if ('data' in res.keys()) and ('errors' not in res.keys()):
-            return res['data']['repository']['object']
+            obj = res['data']['repository']['object']
+            if obj is not None:
+                self.text_cache[key] = obj
+                self.text_checked[key] = time.monotonic()
+            return obj
         else:
             raise Exception(f'Query succeed. But return "errors": {res}')
 
-    def get_oid(self, owner: str, name: str, branch: str):
+    def get_texts(
+        self,
+        targets: list[tuple[str, str, str]],
+        max_targets: int = 50,
+        max_bytes: int = 1024 * 1024,
+    ) -> list[dict | Exception]:
+        """批量获取文本文件的大小、内容和 oid
+
+        同一仓库的文件合并在一个`repository`字段下, 每个文件使用别名查询.
+        每个 GraphQL 请求最多包含`max_targets`个文件, 且估计的响应大小(上次获取的`byteSize`,
+        未获取过的文件按`DEFAULT_TEXT_SIZE`估计)不超过`max_bytes`, 超出时拆分为多个请求;
+        请求失败(如响应过大导致超时)时拆分为两半重试, 直到只剩一个文件
+
+        Parameters
+        ----------
+        targets : list[tuple[str, str, str]]
+            `(owner, name, expression)`组成的列表, 如`[('KiyanYang', 'MyData', 'main:fund.yaml')]`
+        max_targets : int, optional
+            每个请求的最大文件数, by default 50
+        max_bytes : int, optional
+            每个请求估计的最大响应大小(字节), 单个文件超过时单独请求, by default 1 MiB
+
+        Returns
+        -------
+        list[dict | Exception]
+            与`targets`顺序一致, 获取成功的元素为包含`byteSize` `text` `oid`的 dict,
+            获取失败的元素为 Exception (如请求出错、仓库或文件不存在)
+        """
+        results = [None] * len(targets)
+        chunk, size = [], 0
+        for i, target in enumerate(targets):
+            cache = self.text_cache.get(target)
+            n = self.DEFAULT_TEXT_SIZE if cache is None else cache['byteSize']
+            if chunk and (len(chunk) >= max_targets or size + n > max_bytes):
+                self._get_texts_split(chunk, results)
+                chunk, size = [], 0
+            chunk.append((i, target))
+            size += n
+        if chunk:
+            self._get_texts_split(chunk, results)
+        return results
+
+    def _get_texts_split(self, chunk: list[tuple[int, tuple[str, str, str]]], results: list) -> None:
+        """请求失败时拆分为两半分别重试, 单个文件仍失败时记录异常"""
+        try:
+            self._get_texts_chunk(chunk, results)
+        except Exception as e:
+            if len(chunk) == 1:
+                results[chunk[0][0]] = e
+                return
+            logger.warning(f'批量获取 {len(chunk)} 个文件失败, 拆分后重试: {e!r}')
+            half = len(chunk) // 2
+            self._get_texts_split(chunk[:half], results)
+            self._get_texts_split(chunk[half:], results)
+
+    def _get_texts_chunk(self, chunk: list[tuple[int, tuple[str, str, str]]], results: list) -> None:
+        targets = dict(chunk)
+        repos = {}  # (owner, name): [(index, expression)]
+        for i, (owner, name, expression) in chunk:
+            repos.setdefault((owner, name), []).append((i, expression))
+        params, fields, vars, aliases = [], [], {}, {}
+        for r, ((owner, name), files) in enumerate(repos.items()):
+            params += [f'$o{r}: String!', f'$n{r}: String!']
+            vars |= {f'o{r}': owner, f'n{r}': name}
+            objects = []
+            for i, expression in files:
+                params.append(f'$e{i}: String!')
+                vars[f'e{i}'] = expression
+                objects.append(f'f{i}: object(expression: $e{i}) {{ ... on Blob {{ byteSize text oid }} }}')
+                aliases[i] = (f'r{r}', f'f{i}')
+            fields.append(f'r{r}: repository(owner: $o{r}, name: $n{r}) {{ {" ".join(objects)} }}')
+        fields.append(self.RATE_LIMIT_FIELD)
+        query_get_texts = f'query GetTexts({", ".join(params)}) {{ {" ".join(fields)} }}'
+        res = self.query(query_get_texts, variables=vars)
+        data = res.get('data') or {}
+        errors = {}  # 以响应路径对应错误
+        for error in res.get('errors', []):
+            errors.setdefault(tuple(error.get('path') or ()), error)
+        for i, (repo_alias, file_alias) in aliases.items():
+            error = errors.get((repo_alias, file_alias)) or errors.get((repo_alias,)) or errors.get(())
+            repo = data.get(repo_alias)
+            obj = repo.get(file_alias) if repo else None
+            if error is not None:
+                results[i] = Exception(f'Query succeed. But return "errors": {error}')
+            elif obj is None:
+                results[i] = Exception(f'Object not found: {targets[i]}')
+            else:
+                results[i] = self.text_cache[targets[i]] = obj
+                self.text_checked[targets[i]] = time.monotonic()
+
+    def get_oid(self, owner: str, name: str, branch: str, priority: int = RateBudget.HIGH):
         """获取 oid
 
         Parameters
@@ -171,6 +413,8 @@ class GitHubAPIv4:
             仓库名
         branch : str
             分支, 如`main`
+        priority : int, optional
+            优先级, by default RateBudget.HIGH
 
         Returns
         -------
@@ -191,9 +435,10 @@ class GitHubAPIv4:
                   oid
                 }
               }
+              _rate_limit: rateLimit { cost remaining resetAt }
             }'''
         vars = {'owner': owner, 'name': name, 'expression': branch}
-        res = self.query(query_get_oid, variables=vars)
+        res = self.query(query_get_oid, variables=vars, priority=priority)
         if ('data' in res.keys()) and ('errors' not in res.keys()):
             return res['data']['repository']['object']['oid']
         else:
@@ -227,19 +472,25 @@ class GitHubAPIv4:
               }
             }'''
         res = self.query(query_rate_limit)
-        return res['data']['rateLimit']
+        rate_limit = res['data']['rateLimit']
+        self.budget.update(rate_limit)
+        return rate_limit
 
-    def add_text(
+    def add_files(
         self,
         owner: str,
         name: str,
         branch: str,
-        path: str,
-        contents: str,
+        files: dict[str, str],
         message_headline: str,
         message_body: str | None = None,
-    ):
-        """增加或修改文件
+        retries: int = 3,
+        priority: int = RateBudget.HIGH,
+    ) -> str:
+        """在一次提交中增加或修改多个文件
+
+        使用缓存的分支 head oid 作为`expectedHeadOid`, 如果分支已被其他提交更新,
+        则重新获取 oid 后重试
 
         Parameters
         ----------
@@ -249,48 +500,206 @@ class GitHubAPIv4:
             仓库名
         branch : str
             分支, 如`main`
-        path : str
-            路径, 如`docs/README.md`
-        contents : str
-            文件内容
+        files : dict[str, str]
+            路径和文件内容, 如`{'docs/README.md': '...'}`
         message_headline : str
             git 说明消息标题
         message_body : str, optional
             git 说明消息内容, 如果为空, 则与`message_headline`一样, by default None
+        retries : int, optional
+            head oid 冲突时的最大重试次数, by default 3
+        priority : int, optional
+            优先级, by default RateBudget.HIGH
+
+        Returns
+        -------
+        str
+            新提交的 oid
+
+        Raises
+        ------
+        Exception
+            如果请求出错, 则返回错误代码;
+
+            如果请求正常, 但响应包含 errors 条目且不是 head oid 冲突, 或重试后仍冲突, 则返回响应数据.
         """
-        query_change_file = '''
-            mutation ChangeFile(
+        query_change_files = '''
+            mutation ChangeFiles(
               $owner_name: String
               $branch: String
-              $head_oid: String
-              $path: String
-              $contents: String
-              $message_headline: String
+              $head_oid: GitObjectID!
+              $additions: [FileAddition!]
+              $message_headline: String!
               $message_body: String
             ) {
               createCommitOnBranch(
                 input: {
                   branch: { repositoryNameWithOwner: $owner_name, branchName: $branch }
                   expectedHeadOid: $head_oid
-                  fileChanges: { additions: [{ path: $path, contents: $contents }] }
+                  fileChanges: { additions: $additions }
                   message: { body: $message_body, headline: $message_headline }
                 }
               ) {
-                clientMutationId
+                commit {
+                  oid
+                }
               }
             }'''
         if message_body is None:
             message_body = message_headline
+        key = (owner, name, branch)
         vars = {
             'owner_name': f'{owner}/{name}',
             'branch': branch,
-            'head_oid': self.get_oid(owner, name, branch),
-            "path": path,
-            "contents": self._text_b64(contents),
-            "message_headline": message_headline,
-            "message_body": message_body,
+            'additions': [{'path': k, 'contents': self._text_b64(v)} for k, v in files.items()],
+            'message_headline': message_headline,
+            'message_body': message_body,
         }
-        self.query(query_change_file, variables=vars)
+        for attempt in range(retries + 1):
+            with self.head_lock:
+                head_oid = self.head_oids.get(key)
+            if head_oid is None:
+                head_oid = self.get_oid(owner, name, branch, priority)
+                with self.head_lock:
+                    self.head_oids.setdefault(key, head_oid)
+            res = self.query(query_change_files, variables=vars | {'head_oid': head_oid}, priority=priority)
+            if 'errors' not in res.keys():
+                oid = res['data']['createCommitOnBranch']['commit']['oid']
+                with self.head_lock:
+                    self.head_oids[key] = oid
+                for path in files:  # 修改的文件不再使用缓存
+                    self.text_cache.pop((owner, name, f'{branch}:{path}'), None)
+                return oid
+            # 分支已被其他提交更新, 丢弃缓存的 oid 后重试(其他线程已缓存更新的 oid 时保留)
+            with self.head_lock:
+                if self.head_oids.get(key) == head_oid:
+                    del self.head_oids[key]
+            if not self._is_stale_head(res) or attempt == retries:
+                raise Exception(f'Query succeed. But return "errors": {res}')
+
+    @staticmethod
+    def _is_stale_head(res: dict) -> bool:
+        for error in res.get('errors', []):
+            message = error.get('message', '').lower()
+            if error.get('type') == 'STALE_DATA' or 'expected branch to point to' in message:
+                return True
+        return False
+
+    def add_text(
+        self,
+        owner: str,
+        name: str,
+        branch: str,
+        path: str,
+        contents: str,
+        message_headline: str,
+        message_body: str | None = None,
+    ) -> Future:
+        """增加或修改文件
+
+        修改先写入提交队列, 同一分支在`commit_window`秒内的修改合并为一次提交
+
+        Parameters
+        ----------
+        owner : str
+            拥有者
+        name : str
+            仓库名
+        branch : str
+            分支, 如`main`
+        path : str
+            路径, 如`docs/README.md`
+        contents : str
+            文件内容
+        message_headline : str
+            git 说明消息标题
+        message_body : str, optional
+            git 说明消息内容, 如果为空, 则与`message_headline`一样, by default None
+
+        Returns
+        -------
+        Future
+            提交完成后结果为新提交的 oid, 需要等待提交完成时调用`result()`; 提交失败时即使不调用也会记录日志
+        """
+        return self.commit_queue.add(owner, name, branch, path, contents, message_headline, message_body)
+
+
+class CommitQueue:
+    """GitHub 提交队列
+
+    按分支收集文件修改, 第一个修改加入后等待`window`秒, 将期间的全部修改合并为一次
+    `GitHubAPIv4.add_files`提交. 同一文件的多次修改只保留最后一次. 进程退出时提交剩余修改,
+    速率限制预算不足时最多等待`exit_wait`秒, 超时则放弃提交并记录日志
+
+    Parameters
+    ----------
+    github : GitHubAPIv4
+        用于提交的客户端
+    window : float, optional
+        合并修改的时间窗口(秒), by default 2.0
+    exit_wait : float, optional
+        进程退出时等待速率限制预算的最长时间(秒), by default 10
+    """
+    def __init__(self, github: 'GitHubAPIv4', window: float = 2.0, exit_wait: float = 10) -> None:
+        self.github = github
+        self.window = window
+        self.exit_wait = exit_wait
+        self.__lock = threading.Lock()
+        self.__pending = {}  # (owner, name, branch): {'files', 'messages', 'futures', 'timer'}
+        atexit.register(self.__flush_at_exit)
+
+    def __flush_at_exit(self) -> None:
+        self.github.budget.limit_wait(self.exit_wait)
+        self.flush()
+
+    def add(
+        self,
+        owner: str,
+        name: str,
+        branch: str,
+        path: str,
+        contents: str,
+        message_headline: str,
+        message_body: str | None = None,
+    ) -> Future:
+        future = Future()
+        key = (owner, name, branch)
+        with self.__lock:
+            batch = self.__pending.get(key)
+            if batch is None:
+                timer = threading.Timer(self.window, self.flush, args=(key,))
+                timer.daemon = True
+                batch = self.__pending[key] = {'files': {}, 'messages': [], 'futures': [], 'timer': timer}
+                timer.start()
+            batch['files'][path] = contents
+            batch['messages'].append((message_headline, message_body or message_headline))
+            batch['futures'].append(future)
+        return future
+
+    def flush(self, key: tuple[str, str, str] | None = None) -> None:
+        """立即提交`key`分支(为 None 时为全部分支)中等待的修改"""
+        with self.__lock:
+            keys = list(self.__pending.keys()) if key is None else [key]
+            batches = [(k, self.__pending.pop(k)) for k in keys if k in self.__pending]
+        for (owner, name, branch), batch in batches:
+            batch['timer'].cancel()
+            messages = batch['messages']
+            if len(messages) == 1:
+                headline, body = messages[0]
+            else:
+                headline = f'Update {len(batch["files"])} files'
+                body = '\n'.join(x[0] for x in messages)
+            try:
+                oid = self.github.add_files(
+                    owner, name, branch, batch['files'], headline, body, priority=RateBudget.LOW
+                )
+            except Exception as e:  # 只在此记录一次, 等待 future 的调用方自行处理异常
+                logger.exception(f'{owner}/{name}@{branch} 提交失败, 未写入: {sorted(batch["files"])}')
+                for future in batch['futures']:
+                    future.set_exception(e)
+            else:
+                for future in batch['futures']:
+                    future.set_result(oid)
 
 
 if __name__ == '__main__':
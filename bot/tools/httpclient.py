@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Filename    :  httpclient.py
+@Datatime    :  2021/11/20 16:32:08
+@Author      :  Kiyan Yang
+@Contact     :  KiyanYang@outlook.com
+@Version     :  v1.0
+@Description :  共享 HTTP 客户端: 连接池复用, 默认超时, 幂等请求带抖动重试, 代理, 连接池统计
+"""
+import random
+import threading
+import time
+import weakref
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .other import get_logger
+
+logger = get_logger(__name__)
+
+
+class HTTPClient:
+    """共享 HTTP 客户端
+
+    所有请求共用一个`requests.Session`, 每个 host 一个 keep-alive 连接池
+
+    Parameters
+    ----------
+    pool_size : int, optional
+        每个 host 连接池的最大连接数, by default 10
+    connect_timeout : float, optional
+        默认连接超时(秒), by default 3.05
+    read_timeout : float, optional
+        默认读取超时(秒), by default 10
+    retries : int, optional
+        幂等请求失败后的最大重试次数, by default 2
+    backoff : float, optional
+        重试退避基数(秒), 第 n 次重试前等待 [0, backoff * 2^n) 内的随机时间;
+        响应带有`Retry-After`时按其等待, 超过`MAX_RETRY_AFTER`时不再重试, by default 0.3
+    proxy : str | None, optional
+        代理地址, by default None
+    """
+    IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'))
+    RETRY_STATUS = frozenset((429, 500, 502, 503, 504))
+    MAX_RETRY_AFTER = 30  # `Retry-After`超过此时间(秒)时直接返回响应, 不阻塞调用方
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 10,
+        retries: int = 2,
+        backoff: float = 0.3,
+        proxy: str | None = None,
+    ) -> None:
+        self.__lock = threading.Lock()
+        self.__counts = {}  # host: {'requests', 'retries', 'errors'}
+        self.__session = None
+        self.__adapter = None
+        self.configure(pool_size, connect_timeout, read_timeout, retries, backoff, proxy)
+
+    def configure(
+        self,
+        pool_size: int = 10,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 10,
+        retries: int = 2,
+        backoff: float = 0.3,
+        proxy: str | None = None,
+    ) -> None:
+        """重新设置参数, 并以新的连接池替换旧的连接池
+
+        其他线程中正在进行的请求仍持有旧的 session, 因此不在此关闭旧的连接池,
+        而是在旧的 session 不再被引用(进行中的请求全部结束)后由`weakref.finalize`关闭
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if proxy is not None:
+            session.proxies = {'http': proxy, 'https': proxy}
+        weakref.finalize(session, adapter.close)
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.proxy = proxy
+        self.__session, self.__adapter = session, adapter
+
+    def __count(self, host: str, key: str) -> None:
+        with self.__lock:
+            counts = self.__counts.setdefault(host, {'requests': 0, 'retries': 0, 'errors': 0})
+            counts[key] += 1
+
+    @staticmethod
+    def retry_after(res: requests.Response) -> float | None:
+        """解析`Retry-After`(秒数或 HTTP 日期), 没有或无法解析时返回 None"""
+        value = res.headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    def request(self, method: str, url: str, idempotent: bool | None = None, **kwargs) -> requests.Response:
+        """发送请求
+
+        Parameters
+        ----------
+        method : str
+            请求方法
+        url : str
+            链接
+        idempotent : bool | None, optional
+            请求是否幂等, 幂等请求在连接错误、超时或服务端错误时重试;
+            为 None 时由请求方法判断, by default None
+        **kwargs
+            传给`requests.Session.request`的其他参数, 未设置`timeout`时使用默认超时
+
+        Returns
+        -------
+        Response
+            requests 的响应类型
+        """
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in self.IDEMPOTENT_METHODS
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlsplit(url).netloc
+        session = self.__session
+        retries = self.retries if idempotent else 0
+        for attempt in range(retries + 1):
+            self.__count(host, 'requests' if attempt == 0 else 'retries')
+            try:
+                res = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == retries:
+                    self.__count(host, 'errors')
+                    raise
+            else:
+                if res.status_code not in self.RETRY_STATUS or attempt == retries:
+                    return res
+                delay = self.retry_after(res)
+                if delay is not None:
+                    if delay > self.MAX_RETRY_AFTER:
+                        return res
+                    res.close()
+                    logger.info(f'{method} {url} 第{attempt + 1}次重试, 按 Retry-After 等待 {delay:.2f}s')
+                    time.sleep(delay)
+                    continue
+                res.close()
+            delay = random.uniform(0, self.backoff * 2**attempt)
+            logger.info(f'{method} {url} 第{attempt + 1}次重试, 等待 {delay:.2f}s')
+            time.sleep(delay)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """连接池统计
+
+        Returns
+        -------
+        dict
+            以 host 为键, 值包含以下字段\n
+            `requests` 请求数\n
+            `retries` 重试数\n
+            `errors` 重试后仍失败的请求数\n
+            `connections` 已建立的连接数, 远小于请求数时说明连接得到复用\n
+            `idle` 连接池中空闲的连接数
+        """
+        with self.__lock:
+            stats = {host: counts.copy() for host, counts in self.__counts.items()}
+        managers = [self.__adapter.poolmanager, *self.__adapter.proxy_manager.values()]
+        for manager in managers:
+            pools = manager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                host = pool.host if pool.port in (None, 80, 443) else f'{pool.host}:{pool.port}'
+                item = stats.setdefault(host, {'requests': 0, 'retries': 0, 'errors': 0})
+                item['connections'] = item.get('connections', 0) + pool.num_connections
+                # 连接池队列中未建立的连接以 None 占位
+                item['idle'] = item.get('idle', 0) + sum(conn is not None for conn in list(pool.pool.queue))
+        return stats
+
+
+# 全局共享的 HTTP 客户端, 由`bot.config`根据配置文件调用`HTTP.configure`设置
+HTTP = HTTPClient()
+
+if __name__ == '__main__':
+    pass
@@ -6,13 +6,21 @@
 @Author      :  Kiyan Yang
 @Contact     :  KiyanYang@outlook.com
 @Version     :  v1.1
-@Description :  其他工具: 监控文件，日志
+@Description :  其他工具: 监控文件，日志，缓存，按对话排序的线程池，update 的后台工作，延迟创建的对象
 """
+import ctypes
+import hashlib
 import logging
 import os
+import queue
+import select
+import struct
+import sys
 import threading
 import time
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Hashable
 
 
 logging.basicConfig(
@@ -26,23 +34,429 @@ def get_logger(name: str | None = None):
     return logging.getLogger(name)
 
 
+logger = get_logger(__name__)
+
+
+class FileWatcher:
+    """文件监控服务
+
+    所有文件共用一个后台线程: Linux 下使用 inotify 监控文件所在目录的写入完成和移入事件,
+    其他情况下每`interval`秒检查一次全部文件的修改时间和大小.
+    文件在`debounce`秒内没有新的变化后才读取内容, 内容的哈希值与上次不同时才调用回调函数
+
+    Parameters
+    ----------
+    debounce : float, optional
+        防抖时间(秒), by default 0.3
+    interval : float, optional
+        不支持 inotify 时的轮询间隔(秒), by default 0.5
+    use_inotify : bool, optional
+        是否尝试使用 inotify, by default True
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    _EVENT = struct.Struct('iIII')  # struct inotify_event: wd, mask, cookie, len
+
+    def __init__(self, debounce: float = 0.3, interval: float = 0.5, use_inotify: bool = True) -> None:
+        self.debounce = debounce
+        self.interval = interval
+        self.use_inotify = use_inotify
+        self.__lock = threading.Lock()
+        self.__files = {}  # path: {'funcs', 'hash', 'stat'}
+        self.__dirs = {}  # wd: 目录
+        self.__pending = {}  # path: 到期时间
+        self.__libc = None
+        self.__fd = None
+        self.__wakeup = None  # (读端, 写端), 唤醒阻塞在 select 中的后台线程
+        self.__fallback = False  # 需要改为轮询, 由后台线程关闭 inotify
+        self.__thread = None
+
+    @property
+    def backend(self) -> str:
+        return 'inotify' if self.__fd is not None and not self.__fallback else 'polling'
+
+    @staticmethod
+    def _stat(path: str) -> tuple | None:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    @staticmethod
+    def _hash(path: str) -> str | None:
+        try:
+            with open(path, 'rb') as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        except OSError:
+            return None
+
+    def __inotify_init(self) -> None:
+        if not (self.use_inotify and sys.platform.startswith('linux')):
+            return
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd >= 0:
+            self.__libc, self.__fd = libc, fd
+            self.__wakeup = os.pipe()
+            os.set_blocking(self.__wakeup[0], False)
+
+    def __inotify_close(self) -> None:
+        for fd in (self.__fd, *(self.__wakeup or ())):
+            if fd is not None:
+                os.close(fd)
+        self.__fd, self.__wakeup, self.__fallback = None, None, False
+
+    def __inotify_add(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory in self.__dirs.values():
+            return
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO
+        wd = self.__libc.inotify_add_watch(self.__fd, directory.encode(), mask)
+        if wd < 0:
+            logger.warning(f'inotify 无法监控 {directory}, 改为轮询')
+            # 后台线程可能正阻塞在 select 中, 不能在此关闭 fd, 唤醒后台线程由其关闭并改为轮询
+            self.__fallback = True
+            os.write(self.__wakeup[1], b'\0')
+            return
+        self.__dirs[wd] = directory
+
+    def watch(self, path: str, func: Callable[[], Any]) -> None:
+        """监控文件`path`, 内容变化后调用`func`"""
+        path = os.path.abspath(path)
+        with self.__lock:
+            if self.__thread is None:
+                self.__inotify_init()
+            entry = self.__files.get(path)
+            if entry is None:
+                entry = self.__files[path] = {'funcs': [], 'hash': self._hash(path), 'stat': self._stat(path)}
+                if self.__fd is not None and not self.__fallback:
+                    self.__inotify_add(path)
+            entry['funcs'].append(func)
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name='FileWatcher', daemon=True)
+                self.__thread.start()
+
+    def after_fork(self) -> None:
+        """在 fork 出的子进程中调用: 子进程中没有后台线程, 且与父进程共用 inotify, 需重新建立"""
+        self.__lock = threading.Lock()
+        if self.__thread is None:
+            return
+        self.__inotify_close()
+        self.__libc, self.__dirs, self.__pending = None, {}, {}
+        self.__inotify_init()
+        if self.__fd is not None:
+            for path in self.__files:
+                if not self.__fallback:
+                    self.__inotify_add(path)
+        self.__thread = threading.Thread(target=self.__run, name='FileWatcher', daemon=True)
+        self.__thread.start()
+
+    def __run(self) -> None:
+        while True:
+            if self.__fallback:
+                with self.__lock:
+                    self.__inotify_close()
+            now = time.monotonic()
+            timeout = None if self.__fd is not None else self.interval
+            if self.__pending:
+                wait = max(0, min(self.__pending.values()) - now)
+                timeout = wait if timeout is None else min(timeout, wait)
+            fd = self.__fd
+            if fd is not None:
+                wakeup = self.__wakeup[0]
+                readable, _, _ = select.select([fd, wakeup], [], [], timeout)
+                if wakeup in readable:
+                    os.read(wakeup, 64)
+                if fd in readable:
+                    self.__read_events(fd)
+            else:
+                time.sleep(timeout)
+                self.__poll()
+            self.__fire()
+
+    def __read_events(self, fd: int) -> None:
+        try:
+            data = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        deadline = time.monotonic() + self.debounce
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            directory = self.__dirs.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+            if path in self.__files:
+                self.__pending[path] = deadline
+
+    def __poll(self) -> None:
+        deadline = time.monotonic() + self.debounce
+        with self.__lock:
+            files = list(self.__files.items())
+        for path, entry in files:
+            stat = self._stat(path)
+            if stat != entry['stat']:
+                entry['stat'] = stat
+                self.__pending[path] = deadline
+
+    def __fire(self) -> None:
+        now = time.monotonic()
+        for path in [k for k, v in self.__pending.items() if v <= now]:
+            del self.__pending[path]
+            entry = self.__files[path]
+            digest = self._hash(path)
+            if digest is None or digest == entry['hash']:  # 文件暂时不存在或内容未变化
+                continue
+            entry['hash'] = digest
+            for func in list(entry['funcs']):
+                try:
+                    func()
+                except Exception:
+                    logger.exception(f'{path} 变化后回调 {func} 执行失败')
+
+
+# 全局共享的文件监控服务
+FILE_WATCHER = FileWatcher()
+
+
 class FileWatchDog:
     def __init__(self, path: str, handler_func: dict) -> None:
         self.path = path
-        self.modified_time = os.stat(path).st_mtime  # 文件修改时间
         self.handler_func = handler_func  # 用户传入的函数
-        handlers = {'modified': self.__modified}
-        for handler in handler_func.keys():
-            t = threading.Thread(target=handlers[handler], name=handler, daemon=True)
-            t.start()
+        for handler, func in handler_func.items():
+            if handler == 'modified':
+                FILE_WATCHER.watch(path, func)
+
+
+class LRUCache:
+    """线程安全的 LRU 缓存, 可设置过期时间
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        最大条目数, 超出时淘汰最久未使用的条目, by default 1024
+    ttl : float | None, optional
+        条目过期时间(秒), 为 None 时不过期, by default None
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float | None = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.__data = OrderedDict()  # key: (expire, value)
+        self.__lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.__data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.__lock:
+            item = self.__data.get(key)
+            if item is None:
+                return default
+            expire, value = item
+            if expire is not None and expire < time.monotonic():
+                del self.__data[key]
+                return default
+            self.__data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expire = None if self.ttl is None else time.monotonic() + self.ttl
+        with self.__lock:
+            self.__data[key] = (expire, value)
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+
+    def keys(self) -> list:
+        """未过期的键, 按使用时间从旧到新排列"""
+        now = time.monotonic()
+        with self.__lock:
+            return [k for k, (expire, _) in self.__data.items() if expire is None or expire >= now]
 
-    def __modified(self):
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self.__lock:
+            item = self.__data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__data.clear()
+
+
+class ChatExecutor:
+    """按对话排序的有界线程池
+
+    同一对话的任务按提交顺序逐个执行, 不同对话的任务并行执行;
+    排队的任务数达到上限时`submit`返回 False, 由调用方提示用户稍后再试
+
+    Parameters
+    ----------
+    workers : int, optional
+        线程数, by default 8
+    max_pending : int, optional
+        所有对话排队任务数的上限, by default 64
+    max_pending_per_chat : int, optional
+        单个对话排队任务数的上限, by default 8
+    """
+    def __init__(self, workers: int = 8, max_pending: int = 64, max_pending_per_chat: int = 8) -> None:
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_pending_per_chat = max_pending_per_chat
+        self.__chats = {}  # key: deque, 存在即表示该对话已在就绪队列中或正在执行
+        self.__ready = queue.SimpleQueue()  # 有任务待执行的对话
+        self.__pending = 0
+        self.__rejected = 0
+        self.__lock = threading.Lock()
+        self.__threads = []
+
+    def submit(self, key: Hashable, func: Callable[..., Any], *args, **kwargs) -> bool:
+        """提交任务, 队列已满时返回 False"""
+        with self.__lock:
+            items = self.__chats.get(key)
+            if self.__pending >= self.max_pending or (items is not None and len(items) >= self.max_pending_per_chat):
+                self.__rejected += 1
+                return False
+            if not self.__threads:
+                for i in range(self.workers):
+                    t = threading.Thread(target=self.__run, name=f'ChatExecutor-{i}', daemon=True)
+                    t.start()
+                    self.__threads.append(t)
+            self.__pending += 1
+            if items is None:
+                self.__chats[key] = deque([(func, args, kwargs)])
+                self.__ready.put(key)
+            else:
+                items.append((func, args, kwargs))
+        return True
+
+    def __run(self) -> None:
         while True:
-            time.sleep(0.5)
-            mtime = os.stat(self.path).st_mtime
-            if self.modified_time < mtime:
-                self.modified_time = mtime
-                self.handler_func['modified']()
+            key = self.__ready.get()
+            with self.__lock:
+                func, args, kwargs = self.__chats[key].popleft()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception(f'对话 {key} 的任务执行出错')
+            with self.__lock:
+                self.__pending -= 1
+                if self.__chats[key]:
+                    self.__ready.put(key)  # 排到队尾, 让其他对话的任务先执行
+                else:
+                    del self.__chats[key]
+
+    def stats(self) -> dict[str, int]:
+        with self.__lock:
+            return {'pending': self.__pending, 'chats': len(self.__chats), 'rejected': self.__rejected}
+
+
+class PendingWork:
+    """一个 update 在后台执行的工作, 全部完成后调用`when_done`登记的函数"""
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__count = 0
+        self.__callbacks = []
+
+    def begin(self) -> Callable[[], None]:
+        """登记一项工作, 返回工作结束(无论成功与否)时调用的函数"""
+        with self.__lock:
+            self.__count += 1
+        return self.__finish
+
+    def __finish(self) -> None:
+        with self.__lock:
+            self.__count -= 1
+            callbacks = self.__callbacks if self.__count == 0 else []
+            if callbacks:
+                self.__callbacks = []
+        for callback in callbacks:
+            callback()
+
+    def when_done(self, callback: Callable[[], None]) -> None:
+        """所有工作结束后调用 callback, 没有未结束的工作时立即调用"""
+        with self.__lock:
+            if self.__count > 0:
+                self.__callbacks.append(callback)
+                return
+        callback()
+
+
+def pending_work(context: Any) -> PendingWork:
+    """update 的后台工作, 同一 update 的所有 handler 共用一个`CallbackContext`"""
+    work = context.__dict__.get('pending_work')
+    if work is None:
+        work = context.__dict__.setdefault('pending_work', PendingWork())
+    return work
+
+
+class LazyObject:
+    """首次使用时才创建的对象的代理, 属性访问、赋值和下标访问均转发给创建的对象
+
+    Parameters
+    ----------
+    factory : Callable[[], Any]
+        创建对象的函数
+    setup : Callable[[Any], None] | None, optional
+        对象创建后调用, 此时已可以通过代理使用对象(如订阅配置变化), by default None
+    """
+    __slots__ = ('_factory', '_setup', '_lock', '_obj')
+    __missing = object()
+
+    def __init__(self, factory: Callable[[], Any], setup: Callable[[Any], None] | None = None) -> None:
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_setup', setup)
+        object.__setattr__(self, '_lock', threading.RLock())
+        object.__setattr__(self, '_obj', LazyObject.__missing)
+
+    @property
+    def initialized(self) -> bool:
+        return self._obj is not LazyObject.__missing
+
+    def resolve(self) -> Any:
+        """返回创建的对象, 尚未创建时先创建"""
+        if self._obj is LazyObject.__missing:
+            with self._lock:
+                if self._obj is LazyObject.__missing:
+                    obj = self._factory()
+                    object.__setattr__(self, '_obj', obj)
+                    if self._setup is not None:
+                        self._setup(obj)
+        return self._obj
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.resolve(), name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self.resolve(), name, value)
+
+    def __getitem__(self, key: Any) -> Any:
+        return self.resolve()[key]
+
+    def __repr__(self) -> str:
+        if self.initialized:
+            return f'<LazyObject {self._obj!r}>'
+        return f'<LazyObject {self._factory!r} (未创建)>'
+
+
+# 状态数据目录 ==================================================================
+def data_path(path: str) -> str:
+    """状态数据(持久化数据库、update 日志等)的路径, 相对路径位于环境变量`DATA_DIR`指定的目录(默认`data`)中"""
+    return os.path.join(os.environ.get('DATA_DIR', 'data'), path)
+
+
+def is_ephemeral() -> bool:
+    """状态数据是否位于临时文件系统: heroku 的 dyno 重启(至少每天一次)后文件系统会被重置,
+    除非通过环境变量`DATA_DIR`指定挂载的持久存储
+    """
+    return 'DYNO' in os.environ and 'DATA_DIR' not in os.environ
 
 
 # 返回当前时间
@@ -6,11 +6,13 @@
 @Author      :  Kiyan Yang
 @Contact     :  KiyanYang@outlook.com
 @Version     :  v1.4.1
-@Description :  文本相关工具: MarkdownV2 转义, 判断是否为空消息, 判断字符串列表中元素是否过长,
+@Description :  文本相关工具: MarkdownV2 转义, 语言文本表, 判断是否为空消息, 判断字符串列表中元素是否过长,
                 短字符串列表转长字符串列表
 """
 import re
-from typing import Literal
+import unicodedata
+from types import MappingProxyType
+from typing import Any, Iterable, Iterator, Literal, Mapping
 
 
 class MarkdownV2:
@@ -40,6 +42,20 @@ class MarkdownV2:
         }  # 其他地方
         return re.sub(pattern[key], dash_repl, text)
 
+    # sub_auto 的单次替换表: 已转义的修饰符还原, 其余特殊字符转义
+    _AUTO_ESCAPED = '*_[]()~`'
+    _AUTO_SPECIAL = '\\_*[]()~`>#+-=|{}.!'
+    _AUTO_TABLE = {'\\' + c: c for c in _AUTO_ESCAPED} | {c: '\\' + c for c in _AUTO_SPECIAL}
+    _AUTO_PATTERN = re.compile(f'\\\\[{re.escape(_AUTO_ESCAPED)}]|[{re.escape(_AUTO_SPECIAL)}]')
+
+    @classmethod
+    def _auto_repl(cls, matchobj: re.Match) -> str:
+        return cls._AUTO_TABLE[matchobj.group(0)]
+
+    @classmethod
+    def _sub_auto_str(cls, text: str) -> str:
+        return cls._AUTO_PATTERN.sub(cls._auto_repl, text)
+
     @classmethod
     def sub_auto(cls, text: str | list[str] | tuple[str]) -> (str | list[str]):
         """Markdown V2 反规则字符串的自动替换\n
@@ -56,45 +72,92 @@ class MarkdownV2:
         Union[str,list[str]]
             符合 Markdown V2 规则的字符串或由其组成的列表
         """
-        def repl_2(matchobj):
-            return '\\' + matchobj.group(0)
-
-        def repl_1(matchobj):
-            data_pre = {
-                r'\*': 'To0g0o1',
-                r'\_': 'To0g0o2',
-                r'\[': 'To0g0o3',
-                r'\]': 'To0g0o4',
-                r'\(': 'To0g0o5',
-                r'\)': 'To0g0o6',
-                r'\~': 'To0g0o7',
-                r'\`': 'To0g0o8',
-            }
-            return data_pre[matchobj.group(0)]
-
-        def repl_3(matchobj):
-            data_post = {
-                'To0g0o1': '*',
-                'To0g0o2': '_',
-                'To0g0o3': '[',
-                'To0g0o4': ']',
-                'To0g0o5': '(',
-                'To0g0o6': ')',
-                'To0g0o7': '~',
-                'To0g0o8': '`',
-            }
-            return data_post[matchobj.group(0)]
-
-        escape_1 = r'\*|\_|\[|\]|\(|\)|\~|\`'.split('|')
-        escape_2 = r'\_*[]()~`>#+-=|{}.!'
-        escape_3 = r'To0g0o1|To0g0o2|To0g0o3|To0g0o4|To0g0o5|To0g0o6|To0g0o7|To0g0o8'.split('|')
-        repl = {repl_1: escape_1, repl_2: escape_2, repl_3: escape_3}
         if isinstance(text, str):
-            for i in repl:
-                text = re.sub('|'.join(map(re.escape, repl[i])), i, text)
-            return text
+            return cls._sub_auto_str(text)
         elif isinstance(text, (list, tuple)):
-            return [cls.sub_auto(x) for x in text]
+            return cls.sub_auto_batch(text)
+
+    @classmethod
+    def sub_auto_batch(cls, texts: list[str] | tuple[str]) -> list[str]:
+        """`sub_auto` 的批量版本, 逐个元素转换, 元素也可以是嵌套的列表或元组
+
+        Parameters
+        ----------
+        texts : `list[str] | tuple[str]`
+            使用 Markdown V2 反规则的字符串组成的列表或元组
+
+        Returns
+        -------
+        list[str]
+            符合 Markdown V2 规则的字符串组成的列表
+        """
+        sub, repl = cls._AUTO_PATTERN.sub, cls._auto_repl
+        return [sub(repl, x) if isinstance(x, str) else cls.sub_auto(x) for x in texts]
+
+
+class TextTable:
+    """语言文本表
+
+    将语言文件编译为以`(topkey, subkey, language_code)`为键的扁平只读表, 值为原始文本和
+    `MarkdownV2.sub_auto`转义后文本. 语言回退在构建时完成, 查询时只需一次 dict 查找
+    """
+    def __init__(
+        self,
+        languages: Mapping,
+        codes: Iterable[str] = ('zh-hans', 'en'),
+        default: str = 'zh-hans',
+    ) -> None:
+        self.codes = frozenset(codes)
+        self.default = default
+        self.__table = MappingProxyType({})
+        self.load(languages)
+
+    @staticmethod
+    def _freeze(value: Any) -> Any:
+        if isinstance(value, (list, tuple)):
+            return tuple(value)
+        return value
+
+    def load(self, languages: Mapping) -> None:
+        """由语言文件数据重新构建文本表, 构建完成后整体替换旧表
+
+        Parameters
+        ----------
+        languages : Mapping
+            语言文件数据, 形如`{topkey: {subkey: {language_code: text}}}`
+        """
+        table = {}
+        for topkey, subkeys in languages.items():
+            for subkey, texts in subkeys.items():
+                fallback = texts.get(self.default)
+                for code in self.codes:
+                    raw = self._freeze(texts.get(code, fallback))
+                    escaped = self._freeze(MarkdownV2.sub_auto(raw)) if raw is not None else None
+                    table[(topkey, subkey, code)] = (raw, escaped)
+        self.__table = MappingProxyType(table)
+
+    def get(self, topkey: str, subkey: str, language_code: str | None = None, escape: bool = False) -> Any:
+        """获取文本
+
+        Parameters
+        ----------
+        topkey : str
+            一级键
+        subkey : str
+            二级键
+        language_code : str, optional
+            语言代码, 不支持的语言使用默认语言, by default None
+        escape : bool, optional
+            是否返回经过`MarkdownV2.sub_auto`转义的文本, by default False
+
+        Returns
+        -------
+        str | tuple[str]
+            文本
+        """
+        if language_code not in self.codes:
+            language_code = self.default
+        return self.__table[(topkey, subkey, language_code)][escape]
 
 
 class MessageText:
@@ -166,18 +229,18 @@ class MessageText:
 
         """
         count = 0  # 字符数
-        lines = ''  # 长字符串
+        lines = []  # 组成长字符串的短字符串
         new_text = []  # 新文本
         for line in text:
             count += len(line)  # 不超过 limit 时, count 正常计数
             if count > limit:
-                new_text.append(lines)
+                new_text.append(''.join(lines))
                 count = len(line)  # 发送之后再重新记录此次循环时的字符数
-                lines = ''  # 重置长字符串
+                lines = []  # 重置长字符串
             if count <= limit:
-                lines += line
+                lines.append(line)
         # 完成 for 循环之后一般总有一条字符串
-        new_text.append(lines)
+        new_text.append(''.join(lines))
         return new_text
 
     @classmethod
@@ -218,7 +281,7 @@ class MessageText:
 
         itl_r = cls.is_too_long(text)
         if itl_r:  # text 含有过长字符串
-            too_long_index = itl_r[1]  # 过长字符串所在位置
+            too_long_index = set(itl_r[1])  # 过长字符串所在位置
             new_text = []
             # 构建新 text, 如果是过长字符串则按行分割后加入, 否则直接加入
             for index, value in enumerate(text):
@@ -239,5 +302,154 @@ class MessageText:
             return text
 
 
-if __name__ == '__main__':
-    pass
+class MessageChunker:
+    """流式分割超长消息
+
+    按 Telegram 的计数方式(UTF-16 码元)度量长度, 将字符串序列合并为不超过`limit`的消息.
+    过长的元素优先按行分割, 单行过长时在不拆开字素(组合字符、emoji 序列等)和 MarkdownV2 转义符的位置分割;
+    parse_mode 为 MarkdownV2 且元素整体为一个实体时, 分割后的每一段都重新加上实体修饰符.
+    输入可以是生成器, 逐条产生消息, 内存占用与`limit`相关而与输入总长度无关
+
+    Parameters
+    ----------
+    limit : int, optional
+        每条消息的最大长度(UTF-16 码元), 必须大于 0, by default 4000
+    joiner : str, optional
+        各元素之间的连接符, by default ''
+    parse_mode : str | None, optional
+        为 MarkdownV2 时处理实体和转义符, by default None
+    """
+    # 由长到短排列, 优先匹配最长的修饰符
+    MDV2_MARKERS = ('```', '*__', '__~', '__', '*_', '*~', '_~', '*', '_', '~', '`')
+    ZWJ = '\u200d'
+
+    def __init__(self, limit: int = 4000, joiner: str = '', parse_mode: str | None = None) -> None:
+        if limit <= 0:
+            raise ValueError(f'limit 必须大于 0, 实际为 {limit}')
+        self.limit = limit
+        self.joiner = joiner
+        self.markdown = parse_mode == 'MarkdownV2'
+
+    @staticmethod
+    def utf16_len(text: str) -> int:
+        if text.isascii():
+            return len(text)
+        return len(text.encode('utf-16-le')) // 2
+
+    @staticmethod
+    def _closing(marker: str) -> str:
+        """嵌套实体的结束修饰符与开始修饰符顺序相反, 如`*__`对应`__*`"""
+        if marker == '```':
+            return marker
+        tokens = re.findall(r'__|.', marker)
+        return ''.join(reversed(tokens))
+
+    def _entity(self, text: str) -> tuple[str, str, str] | None:
+        """元素整体为一个 MarkdownV2 实体时, 返回(开始修饰符, 内容, 结束修饰符)"""
+        for marker in self.MDV2_MARKERS:
+            closing = self._closing(marker)
+            if len(text) > len(marker) + len(closing) and text.startswith(marker) and text.endswith(closing):
+                opening, inner = marker, text[len(marker):-len(closing)]
+                if marker == '```':  # 代码块的语言需要在每一段重复
+                    lang = re.match(r'[^\s`]*\n', inner)
+                    if lang is not None:
+                        opening, inner = opening + lang.group(0), inner[lang.end():]
+                return opening, inner, closing
+        return None
+
+    def _is_boundary(self, text: str, i: int) -> bool:
+        """text[i-1] 和 text[i] 之间是否可以分割"""
+        prev, char = text[i - 1], text[i]
+        code = ord(char)
+        if prev == self.ZWJ or char == self.ZWJ or (prev == '\r' and char == '\n'):
+            return False
+        if unicodedata.category(char) in ('Mn', 'Mc', 'Me'):
+            return False
+        if 0xFE00 <= code <= 0xFE0F or 0xE0100 <= code <= 0xE01EF:  # 变体选择符
+            return False
+        if 0x1F3FB <= code <= 0x1F3FF or 0xE0020 <= code <= 0xE007F:  # 肤色修饰符, 标签字符
+            return False
+        if 0x1F1E6 <= code <= 0x1F1FF:  # 区域指示符两两组成旗帜
+            j = i
+            while j > 0 and 0x1F1E6 <= ord(text[j - 1]) <= 0x1F1FF:
+                j -= 1
+            if (i - j) % 2:
+                return False
+        if self.markdown:  # 不拆开转义符和被转义的字符
+            j = i
+            while j > 0 and text[j - 1] == '\\':
+                j -= 1
+            if (i - j) % 2:
+                return False
+        return True
+
+    def _split(self, text: str, limit: int) -> Iterator[str]:
+        """将`text`分割为不超过`limit`的若干段"""
+        pos, end = 0, len(text)
+        while pos < end:
+            window = text[pos:pos + limit]
+            size, n = self.utf16_len(window), len(window)
+            while size > limit and n > 1:  # 含有需要 2 个码元的字符, 按码元宽度逐个回退
+                n -= 1
+                size -= 2 if ord(window[n]) > 0xFFFF else 1
+            window = window[:n]  # 至少保留一个字符, 保证每次都向前推进
+            if pos + len(window) >= end:
+                yield window
+                return
+            cut = window.rfind('\n') + 1
+            if cut == 0:
+                cut = len(window)
+                while cut > 0 and not self._is_boundary(text, pos + cut):
+                    cut -= 1
+                if cut == 0:  # 没有合适的位置, 只能强制分割
+                    cut = len(window)
+            yield text[pos:pos + cut]
+            pos += cut
+
+    def _units(self, text: Iterable[str]) -> Iterator[str]:
+        """产生不超过`limit`的片段, 每个元素的最后一个片段带有连接符"""
+        joiner, joiner_len = self.joiner, self.utf16_len(self.joiner)
+        for value in text:
+            if self.utf16_len(value) + joiner_len <= self.limit:
+                yield value + joiner
+                continue
+            entity = self._entity(value) if self.markdown else None
+            if entity is None:
+                opening, inner, closing = '', value, ''
+            else:
+                opening, inner, closing = entity
+            limit = self.limit - self.utf16_len(opening) - self.utf16_len(closing) - joiner_len
+            if limit <= 0:  # 修饰符本身已占满`limit`, 放弃实体, 直接分割原文
+                opening, inner, closing = '', value, ''
+                limit = max(self.limit - joiner_len, 1)
+            pieces = self._split(inner, limit)
+            piece = next(pieces, '')
+            for next_piece in pieces:
+                yield opening + piece + closing
+                piece = next_piece
+            yield opening + piece + closing + joiner
+
+    def chunks(self, text: Iterable[str]) -> Iterator[str]:
+        """逐条产生合并后的消息
+
+        Parameters
+        ----------
+        text : Iterable[str]
+            要发送的文本, 可以是列表或生成器
+
+        Yields
+        ------
+        str
+            不超过`limit`的消息
+        """
+        buffer, size = [], 0
+        for unit in self._units(text):
+            n = self.utf16_len(unit)
+            if buffer and size + n > self.limit:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+            buffer.append(unit)
+            size += n
+        if buffer:
+            yield ''.join(buffer)
+
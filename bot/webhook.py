@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Filename    :  webhook.py
+@Datatime    :  2021/11/23 20:41:18
+@Author      :  Kiyan Yang
+@Contact     :  KiyanYang@outlook.com
+@Version     :  v1.0
+@Description :  webhook 入口: 收到 update 后写入日志文件立即返回, 按 update_id 去重, 重启后重放未处理的 update
+"""
+import json
+import os
+import queue
+import ssl
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+import tornado.web
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import CallbackContext, TypeHandler, Updater
+from telegram.ext.utils.webhookhandler import WebhookHandler, WebhookServer
+
+from .tools import get_logger, is_ephemeral, pending_work
+
+logger = get_logger(__name__)
+
+
+class UpdateJournal:
+    """update 日志
+
+    收到的 update 追加写入日志文件(每个 update 一次顺序写), 再由后台线程交给 dispatcher;
+    处理完后由`handler`或`ack`追加一条确认记录(`handler`等待`pending_work`中登记的后台工作结束).
+    启动时重放没有确认记录的 update, 最近`window`个 update_id 内重复的 update 直接丢弃.
+    日志超过`max_size`时改写为最近`window`个 update_id 和未确认的 update, 去重在改写和重启后仍然有效.
+    日志位于临时文件系统(heroku dyno 且未设置`DATA_DIR`)时, 重启后无法重放, `require_durable`决定是否拒绝启动.
+    启动后每`report_interval`秒在日志中记录一次`stats`
+
+    日志格式为每行一条记录: `U\\t<update json>`, `A\\t<update_id>`或`S\\t<最近 update_id 的 json 列表>`
+
+    Parameters
+    ----------
+    path : str
+        日志文件路径
+    window : int, optional
+        去重的 update_id 数量, by default 10000
+    fsync : bool, optional
+        每次写入后是否调用 fsync, by default False
+    max_size : int, optional
+        日志文件超过此大小(字节)时改写日志, by default 4 MiB
+    group : int, optional
+        `handler`所在的 handler 组, 应大于其他所有组, by default 100
+    require_durable : bool | None, optional
+        日志位于临时文件系统时是否抛出`RuntimeError`, 为 None 时在 heroku dyno 中为 True, by default None
+    report_interval : float, optional
+        记录`stats`的间隔(秒), 为 0 时不记录, by default 300
+    """
+    def __init__(
+        self,
+        path: str,
+        window: int = 10000,
+        fsync: bool = False,
+        max_size: int = 4 * 1024 * 1024,
+        group: int = 100,
+        require_durable: bool | None = None,
+        report_interval: float = 300,
+    ) -> None:
+        if is_ephemeral():
+            message = f'update 日志 {path} 位于临时文件系统, dyno 重启后未处理的 update 会丢失, 需设置 DATA_DIR'
+            if require_durable is not False:
+                raise RuntimeError(message)
+            logger.warning(message)
+        self.path = path
+        self.window = window
+        self.fsync = fsync
+        self.max_size = max_size
+        self.group = group
+        self.report_interval = report_interval
+        self.__lock = threading.Lock()
+        self.__seen = OrderedDict()  # 最近的 update_id, 用于去重
+        self.__unacked = OrderedDict()  # 已写入但 dispatcher 尚未处理完的 update_id: update
+        self.__queue = queue.SimpleQueue()  # 等待交给 dispatcher 的 update
+        self.__counts = {'received': 0, 'duplicates': 0, 'replayed': 0}
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.__recover()
+        self.handler = TypeHandler(Update, self.__ack)
+
+    def __recover(self) -> None:
+        """读取日志, 重放未确认的 update, 并改写日志"""
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    kind, _, value = line.rstrip('\n').partition('\t')
+                    try:
+                        if kind == 'U':
+                            data = json.loads(value)
+                            self.__unacked[data['update_id']] = data
+                            self.__remember(data['update_id'])
+                        elif kind == 'A':
+                            self.__unacked.pop(int(value), None)
+                        elif kind == 'S':
+                            for update_id in json.loads(value):
+                                self.__remember(update_id)
+                    except (ValueError, KeyError, TypeError):
+                        logger.warning(f'忽略损坏的日志记录: {line[:80]!r}')  # 进程在写入途中退出
+        self.__file = None
+        self.__compact()
+        for data in self.__unacked.values():
+            self.__queue.put(data)
+        self.__counts['replayed'] = len(self.__unacked)
+        if self.__unacked:
+            logger.info(f'重放 {len(self.__unacked)} 个未处理的 update')
+
+    def __compact(self) -> None:
+        """以最近`window`个 update_id 和未确认的 update 替换原日志"""
+        if self.__file is not None:
+            self.__file.close()  # Windows 下无法替换已打开的文件
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(f'S\t{self.dumps(list(self.__seen))}\n')
+            for data in self.__unacked.values():
+                f.write(f'U\t{self.dumps(data)}\n')
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.__file = open(self.path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def dumps(data: dict | list) -> str:
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+    def __remember(self, update_id: int) -> None:
+        self.__seen[update_id] = None
+        if len(self.__seen) > self.window:
+            self.__seen.popitem(last=False)
+
+    def __write(self, line: str) -> None:
+        self.__file.write(line)
+        self.__file.flush()
+        if self.fsync:
+            os.fsync(self.__file.fileno())
+
+    def append(self, data: dict) -> bool:
+        """写入 update 并排队交给 dispatcher, 重复的 update 返回 False"""
+        update_id = data['update_id']
+        with self.__lock:
+            self.__counts['received'] += 1
+            if update_id in self.__seen:
+                self.__counts['duplicates'] += 1
+                return False
+            self.__remember(update_id)
+            self.__write(f'U\t{self.dumps(data)}\n')
+            self.__unacked[update_id] = data
+        self.__queue.put(data)
+        return True
+
+    def ack(self, update_id: int) -> None:
+        """确认 update 已处理"""
+        with self.__lock:
+            if self.__unacked.pop(update_id, None) is None:
+                return
+            if self.__file.tell() > self.max_size:
+                self.__compact()  # 改写后的日志不含此 update, 无需确认记录
+            else:
+                self.__write(f'A\t{update_id}\n')
+
+    def __ack(self, update: Update, context: CallbackContext) -> None:
+        update_id = update.update_id
+        pending_work(context).when_done(lambda: self.ack(update_id))
+
+    def start(self, sink: Callable[[dict], None]) -> None:
+        """启动后台线程, 将日志中的 update 按顺序交给 sink"""
+        def feed() -> None:
+            while True:
+                data = self.__queue.get()
+                try:
+                    sink(data)
+                except Exception:
+                    logger.exception(f'update 处理失败: {data.get("update_id")}')
+
+        def report() -> None:
+            while True:
+                time.sleep(self.report_interval)
+                logger.info(f'update 日志: {self.stats()}')
+
+        threading.Thread(target=feed, name='UpdateJournal', daemon=True).start()
+        if self.report_interval > 0:
+            threading.Thread(target=report, name='UpdateJournal-stats', daemon=True).start()
+
+    def stats(self) -> dict[str, int]:
+        """`queued` 等待交给 dispatcher 的数量, `pending` 尚未处理完的数量"""
+        with self.__lock:
+            return self.__counts | {'queued': self.__queue.qsize(), 'pending': len(self.__unacked)}
+
+
+class JournalWebhookHandler(WebhookHandler):
+    """将 update 写入`UpdateJournal`后立即返回 200, 不在请求中解析 update"""
+    def initialize(self, journal: UpdateJournal) -> None:
+        self.journal = journal
+
+    def post(self) -> None:
+        self._validate_post()
+        try:
+            data = json.loads(self.request.body)
+            data['update_id']
+        except (ValueError, KeyError, TypeError):
+            raise tornado.web.HTTPError(400)
+        self.journal.append(data)
+        self.set_status(200)
+
+
+class JournalWebhookApp(tornado.web.Application):
+    def __init__(self, webhook_path: str, journal: UpdateJournal) -> None:
+        handlers = [(rf'{webhook_path}/?', JournalWebhookHandler, {'journal': journal})]
+        super().__init__(handlers)
+
+    def log_request(self, handler: tornado.web.RequestHandler) -> None:
+        pass
+
+
+class JournalUpdater(Updater):
+    """webhook 经由`UpdateJournal`接收 update 的 Updater, 其余与 Updater 相同
+
+    Parameters
+    ----------
+    journal : UpdateJournal
+        update 日志
+    sink : Callable[[dict], None] | None, optional
+        接收日志中 update 的函数, 由 sink 负责调用`journal.ack`;
+        为 None 时交给本进程的 dispatcher, 并将日志的确认 handler 加入 dispatcher, by default None
+    """
+    def __init__(self, *args, journal: UpdateJournal, sink: Callable[[dict], None] | None = None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.journal = journal
+        if sink is None:
+            self.dispatcher.add_handler(journal.handler, group=journal.group)
+            sink = self.put_update
+        journal.start(sink)
+
+    def put_update(self, data: dict) -> None:
+        self.update_queue.put(Update.de_json(data, self.bot))
+
+    def _start_webhook(
+        self,
+        listen,
+        port,
+        url_path,
+        cert,
+        key,
+        bootstrap_retries,
+        drop_pending_updates,
+        webhook_url,
+        allowed_updates,
+        ready=None,
+        ip_address=None,
+        max_connections: int = 40,
+    ):
+        # 与 Updater._start_webhook 相同, 只替换 tornado 应用
+        use_ssl = cert is not None and key is not None
+        if not url_path.startswith('/'):
+            url_path = f'/{url_path}'
+        app = JournalWebhookApp(url_path, self.journal)
+        if use_ssl:
+            try:
+                ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+                ssl_ctx.load_cert_chain(cert, key)
+            except ssl.SSLError as exc:
+                raise TelegramError('Invalid SSL Certificate') from exc
+        else:
+            ssl_ctx = None
+        self.httpd = WebhookServer(listen, port, app, ssl_ctx)
+        if not webhook_url:
+            webhook_url = self._gen_webhook_url(listen, port, url_path)
+        cert_file = open(cert, 'rb') if cert is not None else None
+        self._bootstrap(
+            max_retries=bootstrap_retries,
+            drop_pending_updates=drop_pending_updates,
+            webhook_url=webhook_url,
+            allowed_updates=allowed_updates,
+            cert=cert_file,
+            ip_address=ip_address,
+            max_connections=max_connections,
+        )
+        if cert_file is not None:
+            cert_file.close()
+        self.httpd.serve_forever(ready=ready)
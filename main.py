@@ -9,26 +9,29 @@
 @Description :  telegram bot 主文件
 """
 import os
+from functools import partial
+from queue import Queue
+from typing import Callable
 
-from telegram.ext import Updater
+from telegram.ext import Dispatcher, JobQueue
 
 from bot import (
     CFG,
     LOCAL,
-    comm_handler_bingimage,
-    comm_handler_cancel,
-    comm_handler_echo,
-    comm_handler_hello,
-    comm_handler_help,
-    comm_handler_hhsh,
-    comm_handler_start,
+    BotPlus,
+    command_router,
     conv_handler_fund,
     conv_handler_settings,
     error_handler,
     get_logger,
-    mess_handler_unknown,
+    install_log_filters,
+    start_fund_prefetch,
     test_handler,
 )
+from bot.persistence import SQLitePersistence
+from bot.sharding import ShardSupervisor
+from bot.tools import data_path
+from bot.webhook import JournalUpdater, UpdateJournal
 
 logger = get_logger(__name__)
 
@@ -41,38 +44,104 @@ $Env:TOKEN_GITHUB = "Personal access token"  # 适用于 Github API v4 的 TOKEN
 $Env:DEVELOPER_TOKEN = "TG_BOT_TOKEN_3" # 向开发者发生错误日志的机器人的 TOKEN
 $Env:DEVELOPER_CHAT_ID = "DEVELOPER_CHAT_ID"  # 开发者的 ID
 $Env:LOCAL = 'True' # 是否使用本地环境，用于测试以及代理等相关内容，'True' 为开启，其他情况下均为关闭
+$Env:DATA_DIR = "data" # 可选, 状态数据(持久化数据库、update 日志)所在目录, 部署到 heroku 时需为挂载的持久存储
 """
 
-def main():
+# run_async 线程数. Request 连接池需覆盖 Updater 自身(workers + 4)、耗时 handler 线程池和发送队列的线程
+WORKERS = 4
+
+
+def create_bot(token: str) -> BotPlus:
+    con_pool_size = WORKERS + 4 + CFG[0]['HANDLER_POOL']['workers'] + CFG[0]['OUTBOUND']['workers']
+    return BotPlus(token, con_pool_size=con_pool_size)
+
+
+def create_persistence(**kwargs) -> SQLitePersistence:
+    """数据库位于`DATA_DIR`中, 在 heroku dyno 中未设置`DATA_DIR`时默认拒绝启动"""
+    cfg = CFG[0]['PERSISTENCE']
+    return SQLitePersistence(**cfg | {'path': data_path(cfg['path'])}, **kwargs)
+
+
+def create_updater(token: str, journal: UpdateJournal, sink: Callable[[dict], None] | None = None) -> JournalUpdater:
+    """创建 Updater, 创建后即开始将 journal 中的 update 交给 dispatcher 或 sink;
+    sink 不为 None 时 update 交给 sink(多进程模式), 本进程不处理 update
+    """
+    return JournalUpdater(
+        bot=create_bot(token),
+        workers=WORKERS,
+        persistence=create_persistence() if sink is None else None,
+        journal=journal,
+        sink=sink,
+    )
+
+
+def add_handlers(dispatcher: Dispatcher) -> None:
+    """添加 handler, 并在 dispatcher 的 JobQueue 中定时预取基金行情"""
     if LOCAL:
-        bot_token = os.environ['TOKEN_BOT_TEST']
-        updater = Updater(token=bot_token, request_kwargs=CFG[0]['REQUEST_KWARGS'])
-        dispatcher = updater.dispatcher
         dispatcher.add_handler(test_handler, group=10)
-    else:
-        bot_token = os.environ['TOKEN_BOT']
-        updater = Updater(token=bot_token)
-        dispatcher = updater.dispatcher
 
     # ConversationHandler 一般放在CommandHandler之前
     dispatcher.add_handler(conv_handler_fund, group=1)
     dispatcher.add_handler(conv_handler_settings, group=1)
 
-    # CommandHandler
-    dispatcher.add_handler(comm_handler_bingimage, group=1)
-    dispatcher.add_handler(comm_handler_cancel, group=1)
-    dispatcher.add_handler(comm_handler_echo, group=1)
-    dispatcher.add_handler(comm_handler_hello, group=1)
-    dispatcher.add_handler(comm_handler_help, group=1)
-    dispatcher.add_handler(comm_handler_hhsh, group=1)
-    dispatcher.add_handler(comm_handler_start, group=1)
-
-    # MessageHandler, 一般在其他Handler之后
-    dispatcher.add_handler(mess_handler_unknown, group=1)
+    # 命令路由, 包含所有 CommandHandler 和未知命令的处理, 放在 ConversationHandler 之后
+    dispatcher.add_handler(command_router, group=1)
 
     # error_handler 记录错误日志并向开发者发送 Telegram 消息
     dispatcher.add_error_handler(error_handler)
 
+    # 交易时间内定时预取基金行情. 行情缓存在各进程的内存中, 多进程时每个 worker 都预取,
+    # 否则分配到其他 worker 的对话每次查询都会请求网络
+    start_fund_prefetch(dispatcher.job_queue)
+
+
+def setup_worker(token: str, index: int) -> Dispatcher:
+    """多进程模式下 worker 在 fork 后调用, 建立自己的 bot、连接池和 dispatcher"""
+    install_log_filters()
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(
+        create_bot(token),
+        Queue(),
+        workers=WORKERS,
+        job_queue=job_queue,
+        # 同一 chat 的 update 总由同一 worker 处理, 对话状态和 chat_data 可以安全地共用一个数据库;
+        # 同一用户在不同 chat 中的 user_data 和全局的 bot_data 会分散在各 worker 中互相覆盖, 不持久化
+        persistence=create_persistence(store_user_data=False, store_bot_data=False),
+    )
+    job_queue.set_dispatcher(dispatcher)
+    job_queue.start()
+    add_handlers(dispatcher)
+    return dispatcher
+
+
+def create_worker(token: str) -> Callable[[int], Dispatcher]:
+    # 传给 forkserver 的函数需要能够 pickle
+    return partial(setup_worker, token)
+
+
+def main():
+    install_log_filters()
+    bot_token = os.environ['TOKEN_BOT_TEST'] if LOCAL else os.environ['TOKEN_BOT']
+    cfg = CFG[0]['SHARDING']
+    cfg_journal = CFG[0]['WEBHOOK_JOURNAL']
+    journal = UpdateJournal(**cfg_journal | {'path': data_path(cfg_journal['path'])})
+    if cfg['processes'] > 1:
+        # 多进程模式: 本进程只接收 update, 按 chat_id 分配给 worker 进程处理.
+        # worker 由单线程的 forkserver 进程 fork, forkserver 预先读取配置、语言文本并创建 handler(本地环境除外, 见`bot.preload`)
+        supervisor = ShardSupervisor(
+            cfg['processes'],
+            create_worker(bot_token),
+            on_ack=journal.ack,  # 在 journal 开始交出 update(包括重放的 update)之前设置, 不会漏掉确认
+            health_interval=cfg['health_interval'],
+            health_timeout=cfg['health_timeout'],
+            preload=['bot.preload', 'bot.persistence'],
+        )
+        supervisor.start()
+        updater = create_updater(bot_token, journal, sink=supervisor.put)
+    else:
+        updater = create_updater(bot_token, journal)
+        add_handlers(updater.dispatcher)
+
     if LOCAL:
         # 使用前打开 ngrok 所在目录并输入 `./ngrok http 5000` 获取 ngrok_https 注意要以 `/` 结尾
         ngrok_https = 'https://627b-2001-250-4000-821b-bd2f-8ff7-8c74-f0c5.ngrok.io/'
@@ -92,6 +161,8 @@ def main():
         )
 
     updater.idle()
+    if updater.dispatcher.persistence is not None:
+        updater.dispatcher.persistence.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,14 @@
+import pytest
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: 耗时的基准测试, 只在使用 `-m benchmark` 时运行')
+
+
+def pytest_collection_modifyitems(config, items):
+    if 'benchmark' in (config.getoption('markexpr') or ''):
+        return
+    skip = pytest.mark.skip(reason='基准测试, 使用 `-m benchmark` 运行')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
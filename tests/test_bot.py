@@ -0,0 +1,82 @@
+import threading
+import time
+from unittest import mock
+
+import pytest
+from telegram import Bot
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import Dispatcher
+
+from bot.bot import BotPlus, OutboundQueue
+
+
+def failing_send(self, chat_id, text, **kwargs):
+    raise BadRequest("Can't parse entities")
+
+
+def test_send_message_raises(monkeypatch):
+    monkeypatch.setattr(Bot, 'send_message', failing_send)
+    with pytest.raises(BadRequest):
+        BotPlus('123:abc').send_message(1, 'text')
+
+
+def test_send_message_async_dispatches_error(monkeypatch):
+    monkeypatch.setattr(Bot, 'send_message', failing_send)
+    dispatcher = mock.Mock()
+    monkeypatch.setattr(Dispatcher, 'get_instance', classmethod(lambda cls: dispatcher))
+    future = BotPlus('123:abc').send_message_async(1, 'text')
+    assert isinstance(future.exception(timeout=5), BadRequest)
+    for _ in range(50):  # done-callback 在发送线程中, 设置结果之后调用
+        if dispatcher.dispatch_error.called:
+            break
+        time.sleep(0.01)
+    dispatcher.dispatch_error.assert_called_once_with(None, future.exception())
+
+
+def test_outbound_queue_prunes_idle_chats(monkeypatch):
+    monkeypatch.setattr(OutboundQueue, 'PRUNE_INTERVAL', 0)
+    outbound = OutboundQueue(global_rate=1000, chat_rate=1000, workers=2)
+    futures = [outbound.put(chat_id, lambda: chat_id) for chat_id in range(100)]
+    for future in futures:
+        future.result(timeout=5)
+    assert outbound.stats()['chats'] > 0
+    time.sleep(0.05)  # 令牌桶补满
+    outbound.put(-1, lambda: None).result(timeout=5)
+    assert outbound.stats()['chats'] <= 1
+
+
+def test_same_token_shares_outbound_queue():
+    high = BotPlus('123:same', dispatch_errors=False)
+    low = BotPlus('123:same', priority=OutboundQueue.LOW, dispatch_errors=False)
+    other = BotPlus('456:other', dispatch_errors=False)
+    assert high.outbound is low.outbound
+    assert other.outbound is not high.outbound
+
+
+def test_retry_after_pauses_and_resends():
+    outbound = OutboundQueue(global_rate=1000, chat_rate=1000, workers=2)
+    attempts = []
+
+    def send():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise RetryAfter(0.2)
+        return 'sent'
+
+    assert outbound.put(1, send).result(timeout=5) == 'sent'
+    assert len(attempts) == 2
+    assert attempts[1] - attempts[0] >= 0.2
+    assert outbound.stats()['retry_after'] == 1
+
+
+def test_high_priority_sent_before_low():
+    outbound = OutboundQueue(global_rate=1000, chat_rate=1000, workers=1)
+    release = threading.Event()
+    order = []
+    busy = outbound.put(0, release.wait)  # 占住唯一的发送线程
+    low = outbound.put(1, order.append, 'low', priority=OutboundQueue.LOW)
+    high = outbound.put(2, order.append, 'high', priority=OutboundQueue.HIGH)
+    release.set()
+    for future in (busy, low, high):
+        future.result(timeout=5)
+    assert order == ['high', 'low']
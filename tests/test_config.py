@@ -0,0 +1,72 @@
+import time
+
+from bot.tools import config
+
+
+def test_snapshot_invalidated_by_version(tmp_path, monkeypatch):
+    path = tmp_path / 'config.yaml'
+    path.write_text('a: 1\n', encoding='UTF-8')
+    cache_dir = tmp_path / '.cache'
+    assert config.load_snapshot(path, cache_dir) == {'a': 1}
+    old = list(cache_dir.glob('*.pickle'))
+
+    monkeypatch.setattr(config, 'SNAPSHOT_VERSION', config.SNAPSHOT_VERSION + 1)
+    assert config.load_snapshot(path, cache_dir) == {'a': 1}
+    new = list(cache_dir.glob('*.pickle'))
+    assert len(old) == len(new) == 1 and old != new
+
+
+def test_invalid_yaml_keeps_old_config(tmp_path):
+    path = tmp_path / 'config.yaml'
+    path.write_text('a: 1\nb: 2\n', encoding='UTF-8')
+    cfg = config.Configs({0: str(path)}, hot=True)
+    calls = []
+    cfg.subscribe(0, lambda: calls.append(dict(cfg[0])))
+
+    path.write_text('a: [1\n', encoding='UTF-8')  # 写入途中的文件
+    time.sleep(1)
+    assert cfg[0] == {'a': 1, 'b': 2} and calls == []
+
+    path.write_text('a: 1\nb: 3\n', encoding='UTF-8')
+    for _ in range(300):
+        if calls:
+            break
+        time.sleep(0.01)
+    assert calls == [{'a': 1, 'b': 3}]
+
+
+def wait_for(predicate, timeout: float = 3) -> None:
+    for _ in range(int(timeout * 100)):
+        if predicate():
+            return
+        time.sleep(0.01)
+    assert predicate()
+
+
+def test_subscribers_notified_only_for_changed_sections(tmp_path):
+    path = tmp_path / 'config.yaml'
+    path.write_text('A: 1\nB: 1\n', encoding='UTF-8')
+    cfg = config.Configs({0: str(path)}, hot=True)
+    calls = []
+    cfg.subscribe(0, lambda: calls.append('A'), sections=('A',))
+    cfg.subscribe(0, lambda: calls.append('B'), sections=('B',))
+    cfg.subscribe(0, lambda: calls.append('any'))
+
+    path.write_text('A: 2\nB: 1\n', encoding='UTF-8')
+    wait_for(lambda: len(calls) == 2)
+    assert sorted(calls) == ['A', 'any']
+    assert config._BaseConfig.diff({'A': 1, 'B': 1}, {'A': 1, 'C': 1}) == {'B', 'C'}
+
+
+def test_command_router_rebuilds_on_reload(tmp_path, monkeypatch):
+    from bot import handlers
+
+    path = tmp_path / 'config.yaml'
+    text = 'GitHub: {fund: https://example.com/fund.yaml}\nMY_COMMANDS_1:\n  - [/start, a]\n'
+    path.write_text(text, encoding='UTF-8')
+    monkeypatch.setattr(handlers, 'CFG', config.Configs({0: str(path)}, hot=True))
+    router = handlers.create_command_router()
+    assert 'start' in router.known and 'newcmd' not in router.known
+
+    path.write_text(text + '  - [/newcmd, b]\n', encoding='UTF-8')
+    wait_for(lambda: 'newcmd' in router.known)
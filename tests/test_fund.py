@@ -0,0 +1,55 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from bot.tools import fund
+from bot.tools.fund import Fund, FundQuotes
+
+
+def test_get_many_batches_stale_codes(monkeypatch):
+    batches = []
+
+    def batch(codes, source=1):
+        batches.append(list(codes))
+        return [(code, [code, 'new'], None) for code in codes]
+
+    def single(code):
+        raise AssertionError(f'{code} 应在批量请求中获取')
+
+    monkeypatch.setattr(Fund, 'get_fund_info_batch', batch)
+    monkeypatch.setattr(Fund, 'get_fund_info_hedged', single)
+    quotes = FundQuotes()
+    now = fund.datetime_now()
+    quotes._FundQuotes__store('000001', ['000001', 'old'], now - timedelta(days=30))
+    quotes._FundQuotes__store('000002', ['000002', 'cached'], now)
+    res = quotes.get_many(['000001', '000002', '000003'])
+    assert batches == [['000001', '000003']]
+    assert [info for _, info, _ in res] == [['000001', 'new'], ['000002', 'cached'], ['000003', 'new']]
+    assert quotes.stats()['misses'] == 2 and quotes.stats()['hits'] == 1
+
+
+def test_hedged_raises_primary_error(monkeypatch):
+    def get_fund_info_1(code):
+        time.sleep(0.3)  # 首选数据源晚于对冲数据源失败
+        raise ValueError('primary')
+
+    def get_fund_info_2(code):
+        raise ValueError('hedge')
+
+    monkeypatch.setattr(Fund, 'LATENCY', {1: None, 2: None})
+    monkeypatch.setattr(Fund, 'get_fund_info_1', get_fund_info_1)
+    monkeypatch.setattr(Fund, 'get_fund_info_2', get_fund_info_2)
+    with pytest.raises(ValueError, match='primary'):
+        Fund.get_fund_info_hedged('000001', delay=0)
+
+
+def test_close_estimate_expires_after_nav_time():
+    quotes = FundQuotes()
+    close = datetime(2024, 1, 3, 15, 0, 5)  # 周三收盘时获取的估值
+    assert quotes.is_fresh(close, datetime(2024, 1, 3, 18, 0))
+    assert not quotes.is_fresh(close, datetime(2024, 1, 3, 21, 30))
+    nav = datetime(2024, 1, 3, 21, 30)  # 公布净值后重新获取
+    assert quotes.is_fresh(nav, datetime(2024, 1, 4, 8, 0))
+    friday = datetime(2024, 1, 5, 21, 30)
+    assert quotes.is_fresh(friday, datetime(2024, 1, 7, 12, 0))  # 周末
@@ -0,0 +1,122 @@
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from bot.tools.github import GitHubAPIv4, RateBudget
+
+
+def exhausted_budget(**kwargs):
+    budget = RateBudget(reserve=500, **kwargs)
+    budget.remaining = 10
+    budget.reset_at = time.time() + 3600
+    return budget
+
+
+def test_low_priority_wait_is_bounded():
+    budget = exhausted_budget(max_wait=0.2)
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        budget.acquire(RateBudget.LOW)
+    assert time.monotonic() - start < 2
+    budget.acquire(RateBudget.HIGH)  # 高优先级调用不等待
+
+
+def test_limit_wait_wakes_waiting_calls():
+    budget = exhausted_budget()
+    errors = []
+
+    def acquire():
+        try:
+            budget.acquire(RateBudget.LOW)
+        except TimeoutError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    time.sleep(0.1)
+    budget.limit_wait(0)
+    thread.join(2)
+    assert not thread.is_alive() and len(errors) == 1
+
+
+def test_add_text_logs_failed_commit(caplog):
+    github = GitHubAPIv4('token', commit_window=60)
+    github.add_files = mock.Mock(side_effect=RuntimeError('boom'))
+    future = github.add_text('owner', 'repo', 'main', 'a.txt', 'text', 'update a')
+    github.commit_queue.flush()
+    assert isinstance(future.exception(timeout=1), RuntimeError)
+    assert "未写入: ['a.txt']" in caplog.text
+    assert len(caplog.records) == 1  # 同一失败只记录一次
+
+
+def test_query_updates_budget_from_alias_and_probes_when_unknown():
+    github = GitHubAPIv4('token')
+    rate_limit = {'cost': 1, 'remaining': 4000, 'resetAt': '2030-01-01T00:00:00Z'}
+    response = mock.Mock(status_code=200)
+    response.json.side_effect = lambda: {'data': {'viewer': {}, '_rate_limit': dict(rate_limit)}}
+    github._post = mock.Mock(return_value=response)
+    res = github.query('mutation { viewer }', priority=RateBudget.LOW)
+    first, second = [call.kwargs['json']['query'] for call in github._post.call_args_list]
+    assert GitHubAPIv4.RATE_LIMIT_FIELD in first and second == 'mutation { viewer }'
+    assert '_rate_limit' not in res['data']
+    assert github.budget.remaining == 4000
+
+
+def test_get_texts_splits_failed_batches():
+    github = GitHubAPIv4('token')
+    sizes = []
+
+    def chunk(chunk, results):
+        sizes.append(len(chunk))
+        if len(chunk) > 2 or any(target[2] == 'main:bad' for _, target in chunk):
+            raise RuntimeError('response too large')
+        for i, target in chunk:
+            results[i] = {'text': target[2]}
+
+    github._get_texts_chunk = chunk
+    targets = [('o', 'r', f'main:{x}') for x in ('a', 'b', 'c', 'bad', 'd')]
+    results = github.get_texts(targets, max_targets=4)
+    texts = [r['text'] if isinstance(r, dict) else 'error' for r in results]
+    assert texts == ['main:a', 'main:b', 'main:c', 'error', 'main:d']
+    assert sizes == [4, 2, 2, 1, 1, 1]
+
+
+def test_get_texts_batches_by_estimated_size():
+    github = GitHubAPIv4('token')
+    github.text_cache[('o', 'r', 'main:big')] = {'byteSize': 900}
+    batches = []
+    github._get_texts_chunk = lambda chunk, results: batches.append([t[2] for _, t in chunk])
+    github.get_texts([('o', 'r', 'main:big'), ('o', 'r', 'main:a'), ('o', 'r', 'main:b')], max_bytes=1000)
+    assert batches == [['main:big'], ['main:a'], ['main:b']]
+
+
+def test_get_raw_revalidates_with_etag():
+    github = GitHubAPIv4('token')
+    ok = mock.Mock(status_code=200, ok=True, headers={'ETag': '"v1"'}, text='a: 1\n')
+    not_modified = mock.Mock(status_code=304, ok=False, headers={'ETag': '"v1"'})
+    github._get = mock.Mock(side_effect=[ok, not_modified])
+    first = github.get_raw('https://example.com/a.yaml', type='yaml')
+    second = github.get_raw('https://example.com/a.yaml', type='yaml')
+    assert first == {'a': 1} and second is first  # 未更新时返回缓存中解析后的数据
+    assert github._get.call_args_list[0].kwargs['headers'] == {}
+    assert github._get.call_args_list[1].kwargs['headers'] == {'If-None-Match': '"v1"'}
+
+
+def test_get_text_trusts_cache_until_ttl(monkeypatch):
+    github = GitHubAPIv4('token')
+    obj = {'byteSize': 1, 'text': 'a', 'oid': 'o1'}
+    github.query = mock.Mock(return_value={'data': {'repository': {'object': obj}}})
+    github.get_oid = mock.Mock(return_value='o1')
+    assert github.get_text('o', 'r', 'main:a') == obj
+    assert github.get_text('o', 'r', 'main:a') == obj  # TTL 内不发送请求
+    assert github.query.call_count == 1 and github.get_oid.call_count == 0
+
+    monkeypatch.setattr(GitHubAPIv4, 'TEXT_CACHE_TTL', 0)
+    assert github.get_text('o', 'r', 'main:a') == obj  # 过期后只查询 oid
+    assert github.query.call_count == 1 and github.get_oid.call_count == 1
+
+    github.get_oid.return_value = 'o2'  # 文件已更新
+    github.get_text('o', 'r', 'main:a')
+    assert github.query.call_count == 2
@@ -0,0 +1,162 @@
+import threading
+import time
+from queue import Queue
+from unittest import mock
+
+import pytest
+from telegram import Update
+from telegram.error import BadRequest
+from telegram.ext import CommandHandler, ConversationHandler, Dispatcher, Filters, MessageHandler
+
+from bot import handlers
+from bot.bot import BotPlus
+from bot.persistence import SQLitePersistence
+from bot.tools import ChatExecutor
+
+
+def make_update(bot: BotPlus, text: str, update_id: int = 1, chat_id: int = 1) -> Update:
+    data = {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'a', 'language_code': 'zh-hans'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+            if text.startswith('/') else [],
+        },
+    }
+    return Update.de_json(data, bot)
+
+
+@pytest.fixture
+def dispatcher(monkeypatch):
+    bot = mock.Mock(spec=BotPlus, username='test_bot', defaults=None)
+    dispatcher = Dispatcher(bot, Queue(), workers=1)
+    monkeypatch.setattr(handlers, 'HANDLER_POOL', ChatExecutor(workers=2))
+    yield dispatcher
+
+
+def wait_for(predicate, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class PooledConversation:
+    STEP, DONE = range(2)
+
+    def __init__(self) -> None:
+        self.release = threading.Event()
+        self.handler = ConversationHandler(
+            entry_points=[CommandHandler('start', self.start)],
+            states={self.STEP: [MessageHandler(Filters.text, self.step)], self.DONE: []},
+            fallbacks=[],
+        )
+
+    def start(self, update, context):
+        return self.STEP
+
+    @handlers.run_in_pool
+    def step(self, update, context):
+        self.release.wait(5)
+        return self.DONE
+
+
+def test_pooled_step_resolves_conversation_state(dispatcher):
+    conversation = PooledConversation()
+    dispatcher.add_handler(conversation.handler)
+    dispatcher.process_update(make_update(dispatcher.bot, '/start', 1))
+    dispatcher.process_update(make_update(dispatcher.bot, 'next', 2))  # 交给线程池, 不阻塞 dispatcher
+    state = conversation.handler.conversations[(1, 1)]
+    assert state[0] == PooledConversation.STEP
+    conversation.release.set()
+    wait_for(lambda: state[1].done.is_set())
+    # 下一个 update 到达时 ConversationHandler 切换到步骤返回的状态
+    conversation.handler.check_update(make_update(dispatcher.bot, 'again', 3))
+    assert conversation.handler.conversations[(1, 1)] == PooledConversation.DONE
+
+
+def test_pool_full_replies_busy(dispatcher, monkeypatch):
+    monkeypatch.setattr(handlers, 'HANDLER_POOL', ChatExecutor(workers=1, max_pending=1))
+    conversation = PooledConversation()
+    dispatcher.add_handler(conversation.handler)
+    for chat_id in (1, 2):
+        dispatcher.process_update(make_update(dispatcher.bot, '/start', chat_id, chat_id))
+        dispatcher.process_update(make_update(dispatcher.bot, 'next', 10 + chat_id, chat_id))
+    assert conversation.handler.conversations[(2, 2)] == PooledConversation.STEP  # 被拒绝时保持原来的状态
+    busy = handlers.get_text('busy', 'busy', language_code='zh-hans')
+    dispatcher.bot.send_message_async.assert_called_once_with(2, busy)
+    conversation.release.set()
+
+
+def test_entering_a_conversation_ends_the_others(tmp_path, monkeypatch):
+    monkeypatch.setattr(handlers, 'CONVERSATIONS', handlers.ConversationRegistry())
+    bot = mock.Mock(spec=BotPlus, username='test_bot', defaults=None)
+    persistence = SQLitePersistence(str(tmp_path / 'state.sqlite3'))
+    dispatcher = Dispatcher(bot, Queue(), workers=1, persistence=persistence)
+    settings, fund = handlers.ConvHandlerSettings(), handlers.ConvHandlerFund()
+    dispatcher.add_handler(settings.handler)
+    dispatcher.add_handler(fund.handler)
+
+    dispatcher.process_update(make_update(bot, '/settings', 1))
+    persistence.flush()
+    assert persistence.get_conversations('settings') == {(1, 1): settings.SETTINGS}
+
+    dispatcher.process_update(make_update(bot, '/fund', 2))
+    persistence.flush()
+    assert (1, 1) not in settings.handler.conversations
+    assert persistence.get_conversations('settings') == {}
+    assert fund.handler.conversations[(1, 1)] == fund.CHOOSING
+    persistence.close()
+
+
+def bing_handler() -> handlers.CommHandlerBingimage:
+    handler = handlers.CommHandlerBingimage()
+    today = handlers.datetime_now().strftime('%Y%m%d')
+    handler.get_bingimage = mock.Mock(return_value=(today, 'url', 'url_uhd', 'copyright'))
+    return handler
+
+
+def send_bing_image(handler: handlers.CommHandlerBingimage, context) -> None:
+    update = mock.Mock(**{'effective_message.chat_id': 1, 'effective_user.language_code': 'zh-hans'})
+    handlers.CommHandlerBingimage.bing_image.__wrapped__.__wrapped__(handler, update, context)  # 不经过线程池
+
+
+def test_bing_image_cached_per_day_and_resent_by_file_id():
+    handler = bing_handler()
+    context = mock.Mock()
+    context.bot.send_photo.side_effect = [mock.Mock(photo=[mock.Mock(file_id=x)]) for x in ('f1', 'f2')]
+    send_bing_image(handler, context)
+    send_bing_image(handler, context)
+    assert handler.get_bingimage.call_count == 1  # 当日图片只请求一次 Bing
+    photos = [call.args[1] for call in context.bot.send_photo.call_args_list]
+    assert photos == ['url', 'f1']  # 第二次使用 Telegram 的 file_id
+
+
+def test_bing_image_falls_back_to_url_when_file_id_is_rejected():
+    handler = bing_handler()
+    handler.cache = handler.get_bingimage_cached() | {'file_id': 'expired'}
+    context = mock.Mock()
+    sent = mock.Mock(photo=[mock.Mock(file_id='f2')])
+    context.bot.send_photo.side_effect = [BadRequest('Wrong file identifier'), sent]
+    send_bing_image(handler, context)
+    photos = [call.args[1] for call in context.bot.send_photo.call_args_list]
+    assert photos == ['expired', 'url']
+    assert handler.cache['file_id'] == 'f2'
+
+
+def test_hhsh_caches_terms_and_batches_misses(monkeypatch):
+    handler = handlers.CommHandlerHhsh()
+    posts = []
+
+    def post(url, json, idempotent):
+        posts.append(json['text'])
+        return mock.Mock(**{'json.return_value': [{'name': x, 'trans': [x.upper()]} for x in json['text'].split(',')]})
+
+    monkeypatch.setattr(handlers.HTTP, 'post', post)
+    assert [x['name'] for x in handler.get_nbnhhsh(['yyds', 'xswl', 'yyds'])] == ['yyds', 'xswl']
+    assert [x['name'] for x in handler.get_nbnhhsh(['xswl', 'nsdd', 'yyds'])] == ['xswl', 'nsdd', 'yyds']
+    assert posts == ['yyds,xswl', 'nsdd']  # 缓存缺失的缩写合并为一次请求
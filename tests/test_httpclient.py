@@ -0,0 +1,61 @@
+import io
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from unittest import mock
+
+import pytest
+import requests
+
+from bot.tools import httpclient
+from bot.tools.httpclient import HTTPClient
+
+
+def response(status_code: int, headers: dict | None = None) -> requests.Response:
+    res = requests.Response()
+    res.status_code = status_code
+    res.raw = io.BytesIO()
+    res.headers.update(headers or {})
+    return res
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(httpclient.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def test_idempotent_requests_retry_with_jitter(monkeypatch, sleeps):
+    send = mock.Mock(side_effect=[response(503), response(502), response(200)])
+    monkeypatch.setattr(requests.Session, 'request', send)
+    client = HTTPClient(retries=2, backoff=0.3)
+    assert client.get('https://example.com/a').status_code == 200
+    assert len(sleeps) == 2 and 0 <= sleeps[0] < 0.3 and 0 <= sleeps[1] < 0.6
+    assert client.stats()['example.com'] == {'requests': 1, 'retries': 2, 'errors': 0}
+
+
+def test_post_is_not_retried(monkeypatch, sleeps):
+    monkeypatch.setattr(requests.Session, 'request', mock.Mock(return_value=response(503)))
+    assert HTTPClient().post('https://example.com/a').status_code == 503
+    assert sleeps == []
+
+
+def test_429_honours_retry_after(monkeypatch, sleeps):
+    send = mock.Mock(side_effect=[response(429, {'Retry-After': '2'}), response(200)])
+    monkeypatch.setattr(requests.Session, 'request', send)
+    assert HTTPClient().get('https://example.com/a').status_code == 200
+    assert sleeps == [2.0]
+
+
+def test_long_retry_after_is_returned(monkeypatch, sleeps):
+    send = mock.Mock(return_value=response(429, {'Retry-After': str(HTTPClient.MAX_RETRY_AFTER + 1)}))
+    monkeypatch.setattr(requests.Session, 'request', send)
+    assert HTTPClient().get('https://example.com/a').status_code == 429
+    assert sleeps == [] and send.call_count == 1
+
+
+def test_retry_after_http_date():
+    date = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=10), usegmt=True)
+    assert 8 < HTTPClient.retry_after(response(429, {'Retry-After': date})) <= 10
+    assert HTTPClient.retry_after(response(429, {'Retry-After': 'soon'})) is None
+    assert HTTPClient.retry_after(response(429)) is None
@@ -0,0 +1,39 @@
+import pickle
+from unittest import mock
+
+import main
+from bot import handlers
+
+
+def test_import_main():
+    # forkserver 中的 worker 需要导入 main 来还原 create_worker 的结果
+    worker = pickle.loads(pickle.dumps(main.create_worker('123:abc')))
+    assert worker.func is main.setup_worker
+    assert main.error_handler is handlers.error_handler
+
+
+def test_error_handler_notifies_developer(monkeypatch):
+    monkeypatch.setenv('DEVELOPER_CHAT_ID', '42')
+    bot = mock.Mock()
+    monkeypatch.setattr(handlers, 'BOT', bot)
+    try:
+        raise ValueError('boom')
+    except ValueError as e:
+        context = mock.Mock(error=e)
+    handlers.error_handler(None, context)
+    chat_id, text = bot.send_message_async.call_args.args
+    assert chat_id == '42'
+    assert 'boom' in text
+
+
+def test_send_action_logs_filtered_by_job(caplog):
+    handlers.install_log_filters()
+    scheduler = handlers.logging.getLogger('apscheduler.scheduler')
+    with caplog.at_level('INFO', logger='apscheduler.scheduler'):
+        scheduler.info('Removed job %s', f'{handlers.SEND_ACTION_JOB}1-abc')
+        scheduler.info('Removed job %s', 'refresh_fund_quotes')
+        scheduler.warning('Removed job %s', f'{handlers.SEND_ACTION_JOB}1-abc')
+    assert [(r.levelname, r.args[0]) for r in caplog.records] == [
+        ('INFO', 'refresh_fund_quotes'),
+        ('WARNING', f'{handlers.SEND_ACTION_JOB}1-abc'),
+    ]
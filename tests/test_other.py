@@ -0,0 +1,72 @@
+import threading
+import time
+
+import pytest
+
+from bot.tools import ChatExecutor, FileWatcher
+
+
+def test_chat_executor_keeps_order_per_chat():
+    executor = ChatExecutor(workers=4, max_pending=40, max_pending_per_chat=20)
+    done = {1: [], 2: []}
+    finished = threading.Event()
+
+    def task(chat_id, i):
+        time.sleep(0.001 * (i % 3))  # 打乱执行时间
+        done[chat_id].append(i)
+        if sum(map(len, done.values())) == 40:
+            finished.set()
+
+    for i in range(20):  # 两个对话的任务交替提交
+        assert executor.submit(1, task, 1, i)
+        assert executor.submit(2, task, 2, i)
+    assert finished.wait(5)
+    assert done == {1: list(range(20)), 2: list(range(20))}
+
+
+def test_chat_executor_rejects_when_full():
+    executor = ChatExecutor(workers=1, max_pending=3, max_pending_per_chat=2)
+    release = threading.Event()
+    assert executor.submit(1, release.wait)
+    assert executor.submit(1, release.wait)
+    assert not executor.submit(1, release.wait)  # 单个对话已满
+    assert executor.submit(2, release.wait)
+    assert not executor.submit(3, release.wait)  # 所有对话已满
+    assert executor.stats()['rejected'] == 2
+    release.set()
+    for _ in range(100):
+        if executor.stats()['pending'] == 0:
+            break
+        time.sleep(0.01)
+    assert executor.stats() == {'pending': 0, 'chats': 0, 'rejected': 2}
+
+
+def wait_until(predicate, timeout: float = 3) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.mark.parametrize('use_inotify', [True, False])
+def test_file_watcher_debounces_and_ignores_unchanged_content(tmp_path, use_inotify):
+    path = tmp_path / 'config.yaml'
+    path.write_text('a: 1\n')
+    watcher = FileWatcher(debounce=0.2, interval=0.02, use_inotify=use_inotify)
+    calls = []
+    watcher.watch(str(path), lambda: calls.append(path.read_text()))
+    if not use_inotify:
+        assert watcher.backend == 'polling'
+
+    for i in range(5):  # 连续写入只触发一次
+        path.write_text(f'a: {i + 2}\n')
+        time.sleep(0.02)
+    assert wait_until(lambda: calls)
+    time.sleep(0.3)
+    assert calls == ['a: 6\n']
+
+    path.write_text('a: 6\n')  # 内容未变化
+    time.sleep(0.5)
+    assert calls == ['a: 6\n']
@@ -0,0 +1,104 @@
+import threading
+
+import pytest
+
+from bot.persistence import SQLitePersistence
+
+
+def reopen(persistence, path):
+    persistence.flush()
+    return SQLitePersistence(str(path))
+
+
+def test_conversation_state_zero_is_persisted(tmp_path):
+    path = tmp_path / 'state.sqlite3'
+    persistence = SQLitePersistence(str(path))
+    persistence.update_conversation('fund', (1, 2), 0)
+    assert reopen(persistence, path).get_conversations('fund') == {(1, 2): 0}
+
+
+def test_conversation_end_deletes_row(tmp_path):
+    path = tmp_path / 'state.sqlite3'
+    persistence = SQLitePersistence(str(path))
+    persistence.update_conversation('fund', (1, 2), 1)
+    persistence.flush()
+    persistence.update_conversation('fund', (1, 2), None)
+    assert reopen(persistence, path).get_conversations('fund') == {}
+
+
+def test_empty_user_data_is_not_stored(tmp_path):
+    path = tmp_path / 'state.sqlite3'
+    persistence = SQLitePersistence(str(path))
+    persistence.update_user_data(1, {})
+    persistence.update_user_data(2, {'a': 1})
+    data = reopen(persistence, path).get_user_data()
+    assert data[1] == {}
+    assert data[2] == {'a': 1}
+
+
+def test_promise_state_stores_old_state(tmp_path):
+    from telegram.ext.utils.promise import Promise
+
+    path = tmp_path / 'state.sqlite3'
+    persistence = SQLitePersistence(str(path))
+    promise = Promise(lambda: 1, (), {})
+    persistence.update_conversation('fund', (1, 2), (0, promise))
+    persistence.update_conversation('fund', (3, 4), ((1, promise), promise))
+    persistence.update_conversation('fund', (5, 6), ((None, promise), promise))
+    assert reopen(persistence, path).get_conversations('fund') == {(1, 2): 0, (3, 4): 1}
+
+
+def test_finished_promise_state_is_stored(tmp_path):
+    from telegram.ext import ConversationHandler
+    from telegram.ext.utils.promise import Promise
+
+    path = tmp_path / 'state.sqlite3'
+    persistence = SQLitePersistence(str(path))
+    promises = [Promise(lambda state=state: state, (), {}) for state in (2, ConversationHandler.END, 3)]
+    persistence.update_conversation('fund', (1, 2), (0, promises[0]))
+    persistence.update_conversation('fund', (3, 4), ((1, promises[1]), promises[1]))
+    persistence.update_conversation('fund', (5, 6), (0, promises[2]))
+    persistence.update_conversation('fund', (5, 6), 1)  # 执行期间对话已切换到新状态
+    for promise in promises:
+        promise.run()
+    assert reopen(persistence, path).get_conversations('fund') == {(1, 2): 2, (5, 6): 1}
+
+
+def test_two_writers_share_database(tmp_path):
+    # 多进程模式下各 worker 以各自的连接写入同一个数据库
+    path = tmp_path / 'state.sqlite3'
+    writers = [SQLitePersistence(str(path), busy_timeout=10) for _ in range(2)]
+
+    def write(persistence, offset):
+        for i in range(50):
+            persistence.update_chat_data(offset + i, {'i': i})
+            persistence.flush()
+
+    threads = [threading.Thread(target=write, args=(p, n * 1000)) for n, p in enumerate(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for persistence in writers:
+        persistence.close()
+    chat_data = SQLitePersistence(str(path)).get_chat_data()
+    assert all(chat_data[n * 1000 + i] == {'i': i} for n in range(2) for i in range(50))
+
+
+def test_close_flushes_and_stops(tmp_path):
+    path = tmp_path / 'state.sqlite3'
+    persistence = SQLitePersistence(str(path))
+    persistence.update_chat_data(1, {'a': 1})
+    persistence.close()
+    persistence.close()
+    assert SQLitePersistence(str(path)).get_chat_data()[1] == {'a': 1}
+
+
+def test_require_durable_on_ephemeral_filesystem(tmp_path, monkeypatch):
+    monkeypatch.setenv('DYNO', 'web.1')
+    monkeypatch.delenv('DATA_DIR', raising=False)
+    with pytest.raises(RuntimeError):
+        SQLitePersistence(str(tmp_path / 'state.sqlite3'))  # dyno 中默认拒绝启动
+    SQLitePersistence(str(tmp_path / 'state.sqlite3'), require_durable=False)  # 只发出警告
+    monkeypatch.setenv('DATA_DIR', str(tmp_path))  # 挂载的持久存储
+    SQLitePersistence(str(tmp_path / 'state.sqlite3'), require_durable=True)
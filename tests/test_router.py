@@ -0,0 +1,64 @@
+from unittest import mock
+
+from telegram import Bot, MessageEntity, Update
+from telegram.ext import CommandHandler, Filters, MessageHandler
+
+from bot.router import CommandRouter, TextRouter, parse_command
+
+
+def make_update(text: str, chat_type: str = 'private') -> Update:
+    bot = mock.Mock(spec=Bot, username='test_bot')
+    entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else []
+    data = {
+        'update_id': 1,
+        'message': {
+            'message_id': 1,
+            'date': 0,
+            'chat': {'id': 1, 'type': chat_type},
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'a'},
+            'text': text,
+            'entities': entities,
+        },
+    }
+    return Update.de_json(data, bot)
+
+
+def test_parse_command():
+    assert parse_command(make_update('/Fund 1 2').message) == ('fund', ['1', '2'])
+    assert parse_command(make_update('/fund@Test_Bot').message) == ('fund', [])
+    assert parse_command(make_update('/fund@other_bot').message) is None  # 指向其他 bot
+    assert parse_command(make_update('fund').message) is None
+    assert parse_command(None) is None
+
+
+def test_parse_command_ignores_command_not_at_start():
+    message = make_update('hi /fund').message
+    message.entities = [MessageEntity('bot_command', offset=3, length=5)]
+    assert parse_command(message) is None
+
+
+def test_command_router_dispatch():
+    echo, unknown = mock.Mock(), mock.Mock()
+    router = CommandRouter(
+        [CommandHandler('echo', echo)],
+        unknown=MessageHandler(Filters.command & Filters.chat_type.private, unknown),
+        known={'fund'},
+    )
+    context = mock.Mock()
+    router.route(make_update('/echo a b'), context)
+    echo.assert_called_once()
+    assert context.args == ['a', 'b']
+
+    assert router.check_update(make_update('/fund')) is None  # 由其他 handler 处理
+    assert router.check_update(make_update('/nope', chat_type='group')) is None  # 未知命令的 filters 不满足
+    router.route(make_update('/nope'), context)
+    unknown.assert_called_once()
+    assert router.check_update(make_update('echo')) is None
+
+
+def test_text_router_looks_up_whole_text():
+    info, income = mock.Mock(return_value=1), mock.Mock(return_value=2)
+    router = TextRouter({'基金信息': info, '估计收益': income})
+    assert router.check_update(make_update('估计收益')) is income
+    assert router.check_update(make_update('估计收益 ')) is None
+    assert router.route(make_update('基金信息'), mock.Mock()) == 1
@@ -0,0 +1,15 @@
+import statistics
+
+import pytest
+
+from bot.__main__ import COLD_START_BUDGET, COLD_START_SCRIPT, IMPORT_BUDGET, IMPORT_SCRIPT, measure
+
+
+@pytest.mark.benchmark
+def test_import_within_budget():
+    assert statistics.median(measure(IMPORT_SCRIPT, 3)) <= IMPORT_BUDGET
+
+
+@pytest.mark.benchmark
+def test_cold_start_within_budget():
+    assert statistics.median(measure(COLD_START_SCRIPT, 3)) <= COLD_START_BUDGET
@@ -0,0 +1,115 @@
+import re
+import timeit
+from pathlib import Path
+
+import pytest
+
+from bot.tools.config import ConfigManager
+from bot.tools.text import MarkdownV2, MessageChunker
+
+LANGUAGES = Path(__file__).parents[1] / 'bot' / 'configs' / 'languages.yaml'
+
+
+def sub_auto_legacy(text: str) -> str:
+    """旧版三次替换的 sub_auto, 用于对比结果与耗时"""
+    data_pre = {'\\' + c: f'To0g0o{i}' for i, c in enumerate('*_[]()~`', 1)}
+    data_post = {v: k[1] for k, v in data_pre.items()}
+    repl = {
+        lambda m: data_pre[m.group(0)]: data_pre.keys(),
+        lambda m: '\\' + m.group(0): r'\_*[]()~`>#+-=|{}.!',
+        lambda m: data_post[m.group(0)]: data_post.keys(),
+    }
+    for i in repl:
+        text = re.sub('|'.join(map(re.escape, repl[i])), i, text)
+    return text
+
+
+def walk(node):
+    if isinstance(node, str):
+        yield node
+    elif isinstance(node, dict):
+        for v in node.values():
+            yield from walk(v)
+    elif isinstance(node, list):
+        for v in node:
+            yield from walk(v)
+
+
+def sub_auto_samples() -> list[str]:
+    samples = list(walk(ConfigManager().yaml_load(path=str(LANGUAGES))))
+    return samples + ['\\\\*', '\\', 'a\\', '\\\\\\_', '[a](b)', r'\[a\]\(b\)', '*bold* _it_ 1.5-2=3!']
+
+
+def test_sub_auto_matches_legacy():
+    samples = sub_auto_samples()
+    for sample in samples:
+        assert MarkdownV2.sub_auto(sample) == sub_auto_legacy(sample), sample
+    assert MarkdownV2.sub_auto_batch(samples) == [sub_auto_legacy(x) for x in samples]
+
+
+@pytest.mark.benchmark
+def test_sub_auto_benchmark():
+    samples = sub_auto_samples()
+    number = 200
+    legacy = timeit.timeit(lambda: [sub_auto_legacy(x) for x in samples], number=number)
+    single = timeit.timeit(lambda: [MarkdownV2.sub_auto(x) for x in samples], number=number)
+    batch = timeit.timeit(lambda: MarkdownV2.sub_auto_batch(samples), number=number)
+    print(f'legacy: {legacy:.4f}s  single: {single:.4f}s  batch: {batch:.4f}s  ({number} rounds)')
+    assert batch < legacy
+
+
+def test_split_astral_only():
+    chunker = MessageChunker(limit=10)
+    pieces = list(chunker._split('😀' * 20, 10))
+    assert ''.join(pieces) == '😀' * 20
+    assert all(0 < chunker.utf16_len(x) <= 10 for x in pieces)
+
+
+def test_split_mixed_bmp_and_astral():
+    chunker = MessageChunker(limit=10)
+    text = 'ab' + '😀' * 20 + 'cd'
+    pieces = list(chunker._split(text, 10))
+    assert ''.join(pieces) == text
+    assert all(0 < chunker.utf16_len(x) <= 10 for x in pieces)
+
+
+def test_split_limit_below_one_astral_char_still_advances():
+    pieces = list(MessageChunker(limit=1)._split('😀a😀', 1))
+    assert pieces == ['😀', 'a', '😀']
+
+
+def test_chunks_entity_wider_than_limit_falls_back_to_raw_split():
+    value = '```python\n' + 'x' * 30 + '```'
+    chunker = MessageChunker(limit=10, joiner='\n', parse_mode='MarkdownV2')
+    chunks = list(chunker.chunks([value]))
+    assert ''.join(chunks).rstrip('\n') == value
+    assert all(chunker.utf16_len(x) <= 10 for x in chunks)
+
+
+@pytest.mark.parametrize('opening, inner, closing', [
+    ('*', 'b' * 30, '*'),
+    ('`', 'c' * 30, '`'),
+    ('```python\n', 'print(1)\n' * 5, '```'),
+])
+def test_chunks_entity_across_boundary_is_closed_and_reopened(opening, inner, closing):
+    chunker = MessageChunker(limit=20, joiner='\n', parse_mode='MarkdownV2')
+    chunks = list(chunker.chunks(['head', opening + inner + closing, 'tail']))
+    assert chunks[0] == 'head\n' and chunks[-1] == 'tail\n'
+    pieces = [x.rstrip('\n') if x.endswith(closing + '\n') else x for x in chunks[1:-1]]
+    assert len(pieces) > 1
+    assert all(chunker.utf16_len(x) <= 20 for x in chunks)
+    assert all(x.startswith(opening) and x.endswith(closing) for x in pieces)
+    assert ''.join(x[len(opening):-len(closing)] for x in pieces) == inner
+
+
+def test_chunks_long_emoji_message():
+    chunker = MessageChunker(limit=4000, joiner='\n', parse_mode=None)
+    chunks = list(chunker.chunks(['😀' * 5000]))
+    assert ''.join(chunks).rstrip('\n') == '😀' * 5000
+    assert all(chunker.utf16_len(x) <= 4000 for x in chunks)
+
+
+@pytest.mark.parametrize('limit', [0, -1])
+def test_chunker_rejects_non_positive_limit(limit):
+    with pytest.raises(ValueError):
+        MessageChunker(limit=limit)
@@ -0,0 +1,64 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from telegram.ext import CallbackContext
+
+from bot.tools import pending_work
+from bot.webhook import UpdateJournal
+
+
+def make_context():
+    dispatcher = SimpleNamespace(use_context=True, bot=None, user_data={}, chat_data={}, bot_data={})
+    return CallbackContext(dispatcher)
+
+
+def test_ack_waits_for_pending_work(tmp_path):
+    journal = UpdateJournal(str(tmp_path / 'journal.log'))
+    journal.append({'update_id': 1})
+    context = make_context()
+    finish = pending_work(context).begin()
+    journal.handler.callback(SimpleNamespace(update_id=1), context)
+    assert journal.stats()['pending'] == 1
+    finish()
+    assert journal.stats()['pending'] == 0
+
+
+def test_ack_without_pending_work(tmp_path):
+    journal = UpdateJournal(str(tmp_path / 'journal.log'))
+    journal.append({'update_id': 1})
+    journal.handler.callback(SimpleNamespace(update_id=1), make_context())
+    assert journal.stats()['pending'] == 0
+
+
+def test_compaction_keeps_unacked_and_dedup(tmp_path):
+    path = str(tmp_path / 'journal.log')
+    journal = UpdateJournal(path, max_size=0)
+    journal.append({'update_id': 1})
+    journal.append({'update_id': 2})
+    journal.ack(1)  # 仍有未确认的 update 时也改写日志
+    with open(path, encoding='utf-8') as f:
+        assert [line.split('\t')[0] for line in f] == ['S', 'U']
+
+    restarted = UpdateJournal(path)
+    assert restarted.stats()['replayed'] == 1
+    assert not restarted.append({'update_id': 1})  # 已确认的 update 改写和重启后仍被去重
+    assert not restarted.append({'update_id': 2})
+    assert restarted.append({'update_id': 3})
+
+
+def test_require_durable_on_ephemeral_filesystem(tmp_path, monkeypatch):
+    monkeypatch.setenv('DYNO', 'web.1')
+    monkeypatch.delenv('DATA_DIR', raising=False)
+    with pytest.raises(RuntimeError):
+        UpdateJournal(str(tmp_path / 'journal.log'))
+    UpdateJournal(str(tmp_path / 'journal.log'), require_durable=False)
+
+
+def test_stats_are_reported(tmp_path, caplog):
+    journal = UpdateJournal(str(tmp_path / 'journal.log'), report_interval=0.01)
+    journal.append({'update_id': 1})
+    with caplog.at_level('INFO', logger='bot.webhook'):
+        journal.start(lambda data: None)
+        time.sleep(0.1)
+    assert any("'pending': 1" in r.getMessage() for r in caplog.records)